@@ -0,0 +1,248 @@
+# bench.py
+# -*- coding: utf-8 -*-
+"""بنچمارک مسیر پردازش آپدیت در دو پروفایل اجرا (RUNTIME_PROFILE=default و fast).
+
+    python bench.py                                   # parse و decode: پاسخ getUpdates -> Update
+    DATABASE_URL=postgresql://localhost/najva_bench python bench.py --pipeline 5000
+    CHANNEL_USERNAME=a CHANNEL_USERNAME_2=b python bench.py --templates 20000
+
+هر پروفایل در پردازه‌ی جدا اجرا می‌شود (انتخاب JSON هنگام import و حلقه پیش از
+asyncio.run انجام می‌شود) و دورها یک‌درمیان تکرار می‌شوند تا گرم بودن دیتابیس به
+نفع یکی نباشد. خروجی: توان عملیاتی (آپدیت در ثانیه) و زمان CPU به ازای هر آپدیت.
+
+مرحله‌ی pipeline همان Application واقعی را با fakebot.FakeRequest و Postgres
+محلی اجرا می‌کند؛ محدودیت نرخ ورودی و آهنگ صف‌ها برای بنچمارک باز می‌شوند.
+
+--templates به پروفایل وابسته نیست و در همین پردازه اجرا می‌شود: ساختن کیبورد و متن
+پاسخ در هر فراخوانی (رفتار قبلی) در برابر main.Templates، هر دو تا JSON پارامتر درخواست.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+
+# محدودیت نرخ ورودی و آهنگ صف‌های report/bulk زمان دیواری را تعیین می‌کنند، نه هزینه‌ی پردازش
+_UNLIMITED = {
+    **{f"RATE_{k}_BURST": "1000000000" for k in ("USER", "CHAT", "INLINE")},
+    **{f"LANE_RATE_{k}": "0" for k in ("INTERACTIVE", "USER", "REPORT", "BULK")},
+}
+
+def synthetic_updates(n: int, users: int = 2000, groups: int = 20, seed: int = 1) -> list:
+    """ترکیب گفتگوی گروهی، تریگر + متن خصوصی و تایپ اینلاین؛ با بذر ثابت برای هر دو پروفایل."""
+    from fakeapi import FakeBotAPI, LoadGenerator
+
+    random.seed(seed)
+    api = FakeBotAPI()
+    gen = LoadGenerator(api, users, groups, rate=1)
+    gen.install_bot_everywhere()
+    while len(api.updates) < n:
+        uid = random.choice(gen.users)
+        gid = gen.group_of[uid]
+        chat = gen.chat(gid)
+        r = random.random()
+        if r < 0.5:
+            gen.push("message", gen.message(chat, uid, "یه پیام معمولی"))
+        elif r < 0.6:
+            target = random.choice(gen.members[gid])
+            target_msg = gen.message(chat, target, "سلام")
+            gen.push("message", target_msg)
+            gen.push("message", gen.message(chat, uid, "نجوا", reply_to=target_msg))
+            private = {"id": uid, "type": "private", "first_name": f"user{uid}"}
+            gen.push("message", gen.message(private, uid, f"متن نجوا {random.randint(0, 10**6)}"))
+        else:
+            target = random.choice(gen.members[gid])
+            text = f"سلام خوبی @user{target}"
+            for i in range(4, len(text) + 1, 3):
+                gen.push("inline_query", {"id": f"{uid}-{len(api.updates)}", "from": gen.user(uid),
+                                          "query": text[:i], "offset": ""})
+    return api.updates[:n]
+
+def _measure(fn):
+    wall, cpu = time.perf_counter(), time.process_time()
+    fn()
+    return time.perf_counter() - wall, time.process_time() - cpu
+
+# ---------- مراحل (داخل پردازه‌ی فرزند) ----------
+def bench_decode(updates: list, rounds: int) -> dict:
+    """بدنه‌ی getUpdates (دسته‌های ۱۰۰تایی): parse فقط parse_json_payload، decode همراه Update.de_json."""
+    from telegram import Bot, Update
+    import main
+
+    bot = Bot("1:bench")
+    batches = [
+        json.dumps({"ok": True, "result": updates[i:i + 100]}, ensure_ascii=False).encode("utf-8")
+        for i in range(0, len(updates), 100)
+    ]
+
+    def parse_only():
+        for _ in range(rounds):
+            for raw in batches:
+                main.LaneRequest.parse_json_payload(raw)
+
+    def parse_and_build():
+        for _ in range(rounds):
+            for raw in batches:
+                for u in main.LaneRequest.parse_json_payload(raw)["result"]:
+                    Update.de_json(u, bot)
+
+    n = len(updates) * rounds
+    stages = {}
+    for name, fn in (("parse", parse_only), ("decode", parse_and_build)):
+        wall, cpu = _measure(fn)
+        stages[name] = {"n": n, "wall": wall, "cpu": cpu}
+    return stages
+
+async def _pipeline(updates: list) -> dict:
+    from telegram import Update
+    from telegram.ext import TypeHandler
+    import main
+    from fakebot import FakeRequest
+
+    class BenchRequest(FakeRequest):
+        parse_json_payload = staticmethod(main.decode_api_payload)
+
+    app = main.build_application(updater=False, token="1:bench", request=BenchRequest())
+    main.app = app
+    done = asyncio.Event()
+    processed = 0
+
+    async def count(update, context):
+        nonlocal processed
+        processed += 1
+        if processed == len(updates):
+            done.set()
+
+    # بعد از همه‌ی گروه‌های ربات؛ خطای هندلرها جلوی این گروه را نمی‌گیرد
+    app.add_handler(TypeHandler(Update, count), group=99)
+
+    objs = [Update.de_json(u, app.bot) for u in updates]  # پیش از شروع پایش تأخیر حلقه
+    await app.initialize()
+    await main.post_init(app)
+    await app.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    for u in objs:
+        await app.update_queue.put(u)
+    await done.wait()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    await app.stop()
+    await app.shutdown()
+    return {"n": len(updates), "wall": wall, "cpu": cpu, "max_lag_ms": main.lag_monitor.max_lag * 1000}
+
+def child(args):
+    import main
+
+    main.install_runtime_profile()
+    updates = synthetic_updates(args.updates)
+    result = {"profile": main.RUNTIME_PROFILE, **main.runtime_info, **bench_decode(updates, args.decode_rounds)}
+    if args.pipeline:
+        if not main.DATABASE_URL:
+            raise SystemExit("--pipeline به DATABASE_URL (Postgres محلی) نیاز دارد.")
+        result["pipeline"] = asyncio.run(_pipeline(synthetic_updates(args.pipeline, seed=2)))
+    print(json.dumps(result))
+
+def bench_templates(n: int) -> str:
+    """میکروثانیه و اوج تخصیص (tracemalloc) به ازای هر پاسخ در مسیرهای start، تریگر و تریگرِ نیازمند عضویت."""
+    import tracemalloc
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    from telegram.request._requestparameter import RequestParameter
+    import main
+
+    bot = "najva_fake_bot"
+    tpl = main.Templates(bot)
+
+    def wire(text, markup):
+        return RequestParameter.from_input("text", text).json_value, \
+            RequestParameter.from_input("reply_markup", markup).json_value
+
+    def join_markup(rows, i):
+        return InlineKeyboardMarkup([*rows, [InlineKeyboardButton("عضو شدم ✅", callback_data=f"gjchk:{i}:-1:2")]])
+
+    paths = {
+        "start": (lambda i: wire(main.INTRO_TEXT, main.start_keyboard_pre(bot)),
+                  lambda i: wire(main.INTRO_TEXT, tpl.start_pre)),
+        "trigger": (lambda i: wire(f"لطفاً متن نجوای خود را در خصوصی ربات ارسال کنید: @{bot}",
+                                   main.write_private_keyboard(bot)),
+                    lambda i: wire(tpl.guide_text, tpl.write_private)),
+        "trigger_join": (lambda i: wire("...", join_markup(main.channel_rows(), i)),
+                         lambda i: wire("...", join_markup(tpl.channel_rows, i))),
+    }
+    lines = [f"{'path':<14}{'variant':<9}{'µs/call':>9}{'peak B/call':>13}"]
+    for name, variants in paths.items():
+        for label, fn in zip(("rebuilt", "cached"), variants):
+            wall = time.perf_counter()
+            for i in range(n):
+                fn(i)
+            us = (time.perf_counter() - wall) / n * 1e6
+            # اوج حافظه‌ی ردیابی‌شده در طول هر فراخوانی، نسبت به پیش از آن: حجم تخصیص‌های گذرا
+            m, peak = max(n // 10, 1), 0
+            tracemalloc.start()
+            for i in range(m):
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+                fn(i)
+                peak += tracemalloc.get_traced_memory()[1] - base
+            tracemalloc.stop()
+            lines.append(f"{name:<14}{label:<9}{us:>9.1f}{peak / m:>13.0f}")
+    return "\n".join(lines)
+
+# ---------- اجرای مقایسه‌ای ----------
+STAGES = ("parse", "decode", "pipeline")
+
+def run_profile(profile: str, argv: list) -> dict:
+    env = dict(os.environ, RUNTIME_PROFILE=profile, **_UNLIMITED)
+    env.setdefault("CONCURRENT_UPDATES", "32")
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", *argv],
+                         env=env, stdout=subprocess.PIPE, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def report(results: dict) -> str:
+    lines = [f"{'stage':<10}{'profile':<9}{'runtime':<18}{'upd/s':>10}{'cpu µs/upd':>12}{'gain':>8}"]
+    for stage in STAGES:
+        base = None
+        for profile in ("default", "fast"):
+            r = results.get(profile)
+            if not r or stage not in r:
+                continue
+            s = r[stage]
+            rate, cpu_us = s["n"] / s["wall"], s["cpu"] / s["n"] * 1e6
+            base = base or rate
+            lines.append(f"{stage:<10}{profile:<9}{r['loop'] + '+' + r['json']:<18}{rate:>10.0f}{cpu_us:>12.1f}"
+                         f"{rate / base:>7.2f}x")
+    return "\n".join(lines)
+
+def cli(argv=None):
+    ap = argparse.ArgumentParser(description="بنچمارک پروفایل‌های اجرا روی مسیر پردازش آپدیت")
+    ap.add_argument("--updates", type=int, default=2000, help="آپدیت‌های مراحل parse و decode")
+    ap.add_argument("--decode-rounds", type=int, default=10)
+    ap.add_argument("--pipeline", type=int, default=0, help="آپدیت‌های مرحله‌ی Application + DB؛ 0 یعنی خاموش")
+    ap.add_argument("--rounds", type=int, default=2, help="تکرار یک‌درمیان هر پروفایل؛ بهترین دور گزارش می‌شود")
+    ap.add_argument("--templates", type=int, default=0, help="فراخوانی‌های مقایسه‌ی کیبورد ساخته‌شده/آماده؛ فقط همین مرحله")
+    ap.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args, _ = ap.parse_known_args(argv)
+    if args.templates:
+        print(bench_templates(args.templates))
+        return
+    if args.child:
+        child(args)
+        return
+    child_argv = [a for a in (argv or []) if a != "--child"]
+    best = {}
+    for _ in range(args.rounds):
+        for profile in ("default", "fast"):
+            r = run_profile(profile, child_argv)
+            prev = best.get(profile)
+            if prev is None:
+                best[profile] = r
+                continue
+            for stage in STAGES:
+                if stage in r and r[stage]["wall"] < prev[stage]["wall"]:
+                    prev[stage] = r[stage]
+    print(report(best))
+
+if __name__ == "__main__":
+    cli(sys.argv[1:])
@@ -0,0 +1,342 @@
+# fakeapi.py
+# -*- coding: utf-8 -*-
+"""سرور HTTP جعلی Bot API به‌همراه تولیدکننده‌ی بار برای تست سرتاسری.
+
+ربات واقعی با getUpdates از همین سرور آپدیت می‌گیرد و پاسخ‌هایش را به آن می‌فرستد؛
+پس هزینه‌ی استخر اتصال و سریال‌سازی HTTP هم اندازه‌گیری می‌شود:
+
+    python fakeapi.py --port 8081 --users 3000 --groups 60 --rate 150 --duration 120 \\
+        --latency-ms 40 --error-rate 0.01 --retry-after-rate 0.005
+    BOT_API_BASE_URL=http://127.0.0.1:8081/bot BOT_TOKEN=1:load ADMIN_ID=1 \\
+        DATABASE_URL=postgresql://localhost/najva_load python main.py
+
+تولیدکننده‌ی بار به خروجی ربات واکنش نشان می‌دهد: روی دکمه‌ی «نمایش پیام» اعلان‌ها
+کلیک می‌کند و نتیجه‌های اینلاین را انتخاب می‌کند. در پایان تعداد متدها، خطاهای تزریقی
+و تأخیر پاسخ ربات (callback / inline / خصوصی) چاپ می‌شود.
+"""
+
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from collections import Counter, defaultdict
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qs
+
+from fakebot import BOT_USER, fake_result
+
+def _decode_value(v: str):
+    if v[:1] in ("{", "[") or v in ("true", "false"):
+        try:
+            return json.loads(v)
+        except ValueError:
+            pass
+    return v
+
+def parse_params(headers: dict, body: bytes) -> dict:
+    ctype = headers.get("content-type", "")
+    if not body:
+        return {}
+    if ctype.startswith("application/json"):
+        return json.loads(body)
+    if ctype.startswith("multipart/form-data"):
+        msg = BytesParser(policy=HTTP).parsebytes(b"Content-Type: " + ctype.encode() + b"\r\n\r\n" + body)
+        params = {}
+        for part in msg.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if name and not part.get_filename():
+                params[name] = _decode_value(part.get_content())
+        return params
+    return {k: _decode_value(v[0]) for k, v in parse_qs(body.decode("utf-8")).items()}
+
+def _percentiles(xs) -> str:
+    if not xs:
+        return "—"
+    xs = sorted(xs)
+    p = lambda q: xs[min(len(xs) - 1, int(q * len(xs)))] * 1000
+    return f"n={len(xs)} p50={p(0.5):.0f}ms p95={p(0.95):.0f}ms max={xs[-1] * 1000:.0f}ms"
+
+class FakeBotAPI:
+    def __init__(self, latency_ms: float = 0.0, error_rate: float = 0.0, retry_after_rate: float = 0.0,
+                 retry_after: int = 1):
+        self.latency = latency_ms / 1000.0
+        self.error_rate = error_rate
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.updates = []  # آپدیت‌های تحویل‌نشده (به ترتیب update_id)
+        self.update_event = asyncio.Event()
+        self.next_update_id = 1
+        self.calls = Counter()
+        self.injected = Counter()
+        self.observers = []  # callback(method, params)
+
+    # ---------- صف آپدیت‌ها ----------
+    def push_update(self, kind: str, obj: dict) -> int:
+        uid = self.next_update_id
+        self.next_update_id += 1
+        self.updates.append({"update_id": uid, kind: obj})
+        self.update_event.set()
+        return uid
+
+    async def _get_updates(self, params: dict):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        if offset:
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            self.update_event.clear()
+            try:
+                await asyncio.wait_for(self.update_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:limit]
+
+    # ---------- متدها ----------
+    async def call(self, method: str, params: dict):
+        """(کد HTTP، بدنه‌ی JSON)"""
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": await self._get_updates(params)}
+        if self.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if method != "getMe":
+            r = random.random()
+            if r < self.retry_after_rate:
+                self.injected["retry_after"] += 1
+                return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry later",
+                             "parameters": {"retry_after": self.retry_after}}
+            if r < self.retry_after_rate + self.error_rate:
+                self.injected["error"] += 1
+                return 502, {"ok": False, "error_code": 502, "description": "Bad Gateway"}
+        result = fake_result(method, params)
+        for obs in self.observers:
+            obs(method, params, result)
+        return 200, {"ok": True, "result": result}
+
+    # ---------- HTTP ----------
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                request_line, *lines = head.decode("latin-1").split("\r\n")
+                _, path, _ = request_line.split(" ", 2)
+                headers = {}
+                for line in lines:
+                    k, _, v = line.partition(":")
+                    if k:
+                        headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                m = re.match(r"^/bot[^/]+/(\w+)", path)
+                if not m:
+                    status, payload = 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+                else:
+                    status, payload = await self.call(m.group(1), parse_params(headers, body))
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode()
+                    + data
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # CancelledError: بسته‌شدن سرور در پایان اجرای بار
+            pass
+        finally:
+            writer.close()
+
+    def report(self) -> str:
+        return (
+            "API calls: " + ", ".join(f"{m}={c}" for m, c in self.calls.most_common()) + "\n"
+            f"injected: {dict(self.injected) or '—'}"
+        )
+
+class LoadGenerator:
+    """کاربران شبیه‌سازی‌شده: گفتگوی گروهی، تریگر + متن خصوصی، تایپ اینلاین و کلیک روی دکمه‌ها."""
+
+    MIX = (("chatter", 0.55), ("trigger", 0.15), ("inline", 0.25), ("help", 0.05))
+
+    def __init__(self, api: FakeBotAPI, users: int, groups: int, rate: float):
+        self.api = api
+        self.rate = rate
+        self.users = list(range(10_000, 10_000 + users))
+        self.groups = [-1_000_000_000_000 - i for i in range(groups)]
+        self.group_of = {u: random.choice(self.groups) for u in self.users}
+        self.members = defaultdict(list)
+        for u, g in self.group_of.items():
+            self.members[g].append(u)
+        self.message_ids = Counter()
+        self.injected = Counter()
+        self.pending = {}  # کلید رویداد -> زمان تزریق
+        self.latencies = defaultdict(list)
+        api.observers.append(self.on_bot_call)
+
+    # ---------- ساخت آپدیت ----------
+    @staticmethod
+    def user(uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"user{uid}", "username": f"user{uid}"}
+
+    @staticmethod
+    def chat(gid: int) -> dict:
+        return {"id": gid, "type": "supergroup", "title": f"group {gid}"}
+
+    def message(self, chat: dict, uid: int, text: str, reply_to: dict | None = None) -> dict:
+        self.message_ids[chat["id"]] += 1
+        m = {"message_id": self.message_ids[chat["id"]], "date": int(time.time()), "chat": chat,
+             "from": self.user(uid), "text": text}
+        if reply_to:
+            m["reply_to_message"] = reply_to
+        return m
+
+    def push(self, kind: str, obj: dict, track: str | None = None):
+        self.injected[kind] += 1
+        if track:
+            self.pending[track] = time.monotonic()
+        self.api.push_update(kind, obj)
+
+    def install_bot_everywhere(self):
+        bot = dict(BOT_USER)
+        for g in self.groups:
+            self.push("my_chat_member", {
+                "chat": self.chat(g), "from": self.user(self.members[g][0] if self.members[g] else self.users[0]),
+                "date": int(time.time()),
+                "old_chat_member": {"status": "left", "user": bot},
+                "new_chat_member": {"status": "member", "user": bot},
+            })
+
+    # ---------- رفتار کاربران ----------
+    async def _trigger_flow(self, uid: int, gid: int):
+        others = [u for u in self.members[gid] if u != uid] or [uid]
+        target = random.choice(others)
+        target_msg = self.message(self.chat(gid), target, "سلام")
+        self.push("message", target_msg)
+        self.push("message", self.message(self.chat(gid), uid, "نجوا", reply_to=target_msg))
+        await asyncio.sleep(random.uniform(1, 4))
+        private = {"id": uid, "type": "private", "first_name": f"user{uid}"}
+        self.push("message", self.message(private, uid, f"متن نجوا {random.randint(0, 10**6)}"), track=f"pm:{uid}")
+
+    async def _inline_flow(self, uid: int):
+        others = self.members[self.group_of[uid]]
+        target = random.choice(others)
+        text = f"سلام خوبی @user{target}"
+        for i in range(4, len(text) + 1, random.randint(2, 5)):
+            qid = f"{uid}-{time.monotonic_ns()}"
+            self.push("inline_query", {"id": qid, "from": self.user(uid), "query": text[:i], "offset": ""}, track=f"iq:{qid}")
+            await asyncio.sleep(random.uniform(0.05, 0.3))
+
+    def _one(self):
+        uid = random.choice(self.users)
+        gid = self.group_of[uid]
+        kind = random.choices([k for k, _ in self.MIX], [w for _, w in self.MIX])[0]
+        if kind == "chatter":
+            self.push("message", self.message(self.chat(gid), uid, "یه پیام معمولی"))
+        elif kind == "help":
+            self.push("message", self.message(self.chat(gid), uid, "راهنما"))
+        elif kind == "trigger":
+            asyncio.get_running_loop().create_task(self._trigger_flow(uid, gid))
+        else:
+            asyncio.get_running_loop().create_task(self._inline_flow(uid))
+
+    async def run(self, duration: float):
+        self.install_bot_everywhere()
+        end = time.monotonic() + duration
+        interval = 1.0 / self.rate
+        next_at = time.monotonic()
+        while time.monotonic() < end:
+            self._one()
+            next_at += interval
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    # ---------- واکنش به خروجی ربات ----------
+    def _observe_latency(self, key: str, kind: str):
+        t = self.pending.pop(key, None)
+        if t is not None:
+            self.latencies[kind].append(time.monotonic() - t)
+
+    def on_bot_call(self, method: str, params: dict, result):
+        if method == "answerCallbackQuery":
+            self._observe_latency(f"cq:{params.get('callback_query_id')}", "callback")
+        elif method == "answerInlineQuery":
+            self._observe_latency(f"iq:{params.get('inline_query_id')}", "inline")
+            results = params.get("results") or []
+            if results and random.random() < 0.1:
+                asyncio.get_running_loop().create_task(self._choose_inline(params, results[0]))
+        elif method == "sendMessage":
+            chat_id = int(params.get("chat_id") or 0)
+            if chat_id > 0:
+                self._observe_latency(f"pm:{chat_id}", "private")
+            markup = params.get("reply_markup") or {}
+            for row in markup.get("inline_keyboard", []):
+                for btn in row:
+                    data = btn.get("callback_data") or ""
+                    if data.startswith("showid:"):
+                        m = re.search(r"tg://user\?id=(\d+)", params.get("text") or "")
+                        clicker = int(m.group(1)) if m else random.choice(self.users)
+                        asyncio.get_running_loop().create_task(self._click(chat_id, result["message_id"], clicker, data))
+
+    async def _click(self, chat_id: int, message_id: int, uid: int, data: str):
+        await asyncio.sleep(random.uniform(0.5, 3))
+        cq_id = f"{uid}-{time.monotonic_ns()}"
+        msg = {"message_id": message_id, "date": int(time.time()), "chat": self.chat(chat_id)}
+        self.push("callback_query", {"id": cq_id, "from": self.user(uid), "chat_instance": "1",
+                                     "data": data, "message": msg}, track=f"cq:{cq_id}")
+
+    async def _choose_inline(self, params: dict, result: dict):
+        iq_uid = int(str(params.get("inline_query_id")).split("-")[0])
+        await asyncio.sleep(random.uniform(0.2, 1))
+        self.push("chosen_inline_result", {"result_id": result["id"], "from": self.user(iq_uid), "query": ""})
+        data = ((result.get("reply_markup") or {}).get("inline_keyboard") or [[{}]])[0][0].get("callback_data")
+        if data:
+            gid = self.group_of[iq_uid]
+            self.message_ids[gid] += 1
+            await self._click(gid, self.message_ids[gid], random.choice(self.members[gid]), data)
+
+    def report(self) -> str:
+        lines = ["injected: " + ", ".join(f"{k}={v}" for k, v in self.injected.items())]
+        for kind in ("callback", "inline", "private"):
+            lines.append(f"bot response {kind:<9} {_percentiles(self.latencies[kind])}")
+        lines.append(f"unanswered tracked events: {len(self.pending)}")
+        return "\n".join(lines)
+
+async def serve(args):
+    api = FakeBotAPI(args.latency_ms, args.error_rate, args.retry_after_rate, args.retry_after)
+    server = await asyncio.start_server(api.handle, args.host, args.port)
+    print(f"fake Bot API on http://{args.host}:{args.port}/bot", flush=True)
+    gen = None
+    async with server:
+        if args.users:
+            gen = LoadGenerator(api, args.users, args.groups, args.rate)
+            await asyncio.sleep(args.warmup)
+            await gen.run(args.duration)
+            await asyncio.sleep(args.drain)
+        else:
+            await server.serve_forever()
+    print(api.report())
+    if gen is not None:
+        print(gen.report())
+
+def cli(argv=None):
+    ap = argparse.ArgumentParser(description="سرور جعلی Bot API و تولیدکننده‌ی بار")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--latency-ms", type=float, default=0.0, help="تأخیر میانگین هر متد")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="کسر پاسخ‌های 502")
+    ap.add_argument("--retry-after-rate", type=float, default=0.0, help="کسر پاسخ‌های 429 با retry_after")
+    ap.add_argument("--retry-after", type=int, default=1)
+    ap.add_argument("--users", type=int, default=0, help="تعداد کاربران شبیه‌سازی‌شده؛ 0 یعنی فقط سرور")
+    ap.add_argument("--groups", type=int, default=20)
+    ap.add_argument("--rate", type=float, default=50.0, help="رویداد کاربر در ثانیه")
+    ap.add_argument("--duration", type=float, default=60.0)
+    ap.add_argument("--warmup", type=float, default=3.0, help="مهلت اتصال ربات پیش از شروع بار")
+    ap.add_argument("--drain", type=float, default=5.0, help="مهلت پاسخ‌های باقی‌مانده پس از پایان بار")
+    asyncio.run(serve(ap.parse_args(argv)))
+
+if __name__ == "__main__":
+    cli(sys.argv[1:])
@@ -0,0 +1,91 @@
+# fakebot.py
+# -*- coding: utf-8 -*-
+"""Bot API جعلی برای بازپخش، بنچمارک و تست بار؛ بدون شبکه.
+
+`fake_result` پاسخ معتبرِ هر متدی را که این ربات استفاده می‌کند می‌سازد و
+`FakeRequest` آن را به‌جای HTTPXRequest به Application می‌دهد.
+"""
+
+import json
+import time
+import asyncio
+import hashlib
+import itertools
+
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 1000000001, "is_bot": True, "first_name": "Najva", "username": "najva_fake_bot"}
+
+_message_ids = itertools.count(1)
+
+def _id_for_username(username: str) -> int:
+    return int(hashlib.sha1(username.lstrip("@").lower().encode()).hexdigest()[:10], 16)
+
+def _chat(chat_id) -> dict:
+    if isinstance(chat_id, str) and chat_id.startswith("@"):
+        uid = _id_for_username(chat_id)
+        return {"id": uid, "type": "private", "first_name": chat_id[1:], "username": chat_id[1:]}
+    chat_id = int(chat_id or 0)
+    if chat_id < 0:
+        return {"id": chat_id, "type": "supergroup", "title": f"group {chat_id}"}
+    return {"id": chat_id, "type": "private", "first_name": f"user{chat_id}"}
+
+def _message(params: dict) -> dict:
+    return {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": _chat(params.get("chat_id")),
+        "from": BOT_USER,
+        "text": params.get("text") or "",
+    }
+
+def fake_result(method: str, params: dict):
+    """نتیجه‌ی موفق یک فراخوانی Bot API (فیلد `result` پاسخ)."""
+    if method == "getMe":
+        return dict(BOT_USER, can_join_groups=True, can_read_all_group_messages=False, supports_inline_queries=True)
+    if method in ("sendMessage", "forwardMessage", "sendDocument", "copyMessage"):
+        return _message(params)
+    if method in ("editMessageText", "editMessageReplyMarkup"):
+        return _message(params) if params.get("chat_id") else True
+    if method == "getChat":
+        return _chat(params.get("chat_id"))
+    if method == "getChatMember":
+        uid = int(params.get("user_id") or 0)
+        return {"status": "member", "user": {"id": uid, "is_bot": False, "first_name": f"user{uid}"}}
+    if method == "getChatMemberCount":
+        return 42
+    if method == "getChatAdministrators":
+        return [{"status": "creator", "is_anonymous": False,
+                 "user": {"id": 1, "is_bot": False, "first_name": "owner"}}]
+    if method == "getUpdates":
+        return []
+    if method == "getFile":
+        return {"file_id": params.get("file_id", ""), "file_unique_id": "x", "file_size": 0, "file_path": "f"}
+    # answerCallbackQuery, answerInlineQuery, deleteMessage, leaveChat, setWebhook, ...
+    return True
+
+class FakeRequest(BaseRequest):
+    """لایه‌ی درخواست درون‌پردازه‌ای؛ هر فراخوانی به `on_call(method)` هم گزارش می‌شود."""
+
+    def __init__(self, latency: float = 0.0, on_call=None):
+        self.latency = latency
+        self.on_call = on_call
+
+    @property
+    def read_timeout(self):
+        return 5.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        if self.on_call is not None:
+            self.on_call(api_method)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        return 200, json.dumps({"ok": True, "result": fake_result(api_method, params)}).encode("utf-8")
@@ -1,12 +1,34 @@
 # main.py
 # -*- coding: utf-8 -*-
 
+import io
 import os
 import re
+import sys
+import json
+import gzip
+import hmac
+import html
+import time
+import queue
+import fcntl
+import atexit
+import hashlib
+import random
+import logging
+import cProfile
+import marshal
+import threading
+import traceback
+import signal
 import asyncio
+import contextlib
+import contextvars
+import multiprocessing as mp
+from collections import Counter
 from secrets import token_urlsafe
 from urllib.parse import quote as urlquote
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 
 from telegram import (
     Update,
@@ -25,16 +47,41 @@ from telegram.ext import (
     InlineQueryHandler,
     ChosenInlineResultHandler,
     ChatMemberHandler,
+    TypeHandler,
+    BaseRateLimiter,
     filters,
 )
+from telegram.request import BaseRequest, HTTPXRequest
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
 import asyncpg
 
+try:
+    import orjson
+except ImportError:  # پروفایل fast بدون آن به json استاندارد برمی‌گردد
+    orjson = None
+
 # --------- تنظیمات از محیط ---------
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
+# برای تست بار می‌توان به سرور جعلی اشاره کرد: http://127.0.0.1:8081/bot
+BOT_API_BASE_URL = os.environ.get("BOT_API_BASE_URL", "https://api.telegram.org/bot")
 ADMIN_ID = int(os.environ.get("ADMIN_ID", "0"))
 DATABASE_URL = os.environ.get("DATABASE_URL", "")
-
-# سقف نصب در گروه‌ها
+DATABASE_REPLICA_URL = os.environ.get("DATABASE_REPLICA_URL", "")
+# مدتی که پس از نوشتن، خواندنِ همان کلید از primary انجام می‌شود (read-your-writes)
+READ_YOUR_WRITES_SEC = float(os.environ.get("READ_YOUR_WRITES_SEC", "10"))
+# حالت افت: نوشتن‌های غیرحیاتی هنگام قطعی دیتابیس به ژورنال محلی می‌روند
+DB_CONNECT_TIMEOUT_SEC = float(os.environ.get("DB_CONNECT_TIMEOUT_SEC", "5"))
+DB_PROBE_SEC = float(os.environ.get("DB_PROBE_SEC", "5"))
+DB_JOURNAL_DIR = os.environ.get("DB_JOURNAL_DIR", "journal")
+# خروجی/ورود CSV فشرده با COPY (دستورهای ادمین «خروجی …» و «ورود …»)
+EXPORT_DIR = os.environ.get("EXPORT_DIR", "exports")
+EXPORT_MAX_SEND_BYTES = 50 * 1024 * 1024  # سقف sendDocument در Bot API
+EXPORT_WRITE_CHUNK = 1024 * 1024  # خروجی COPY این‌قدر جمع می‌شود و بعد در نخ جدا فشرده و نوشته می‌شود
+
+# چند ربات در یک پردازه: توکن‌های بیشتر با ویرگول (ربات اصلی همان BOT_TOKEN می‌ماند)
+BOT_TOKENS = [t.strip() for t in os.environ.get("BOT_TOKENS", "").split(",") if t.strip()]
+
+# سقف نصب در گروه‌ها؛ برای هر ربات با MAX_GROUPS_<bot id> و SUPPORT_CONTACT_<bot id> قابل تغییر
 MAX_GROUPS = int(os.environ.get("MAX_GROUPS", "100"))
 SUPPORT_CONTACT = os.environ.get("SUPPORT_CONTACT", "soulsownerbot")  # بدون @
 
@@ -51,6 +98,18 @@ if _norm(CHANNEL_USERNAME):
 if _norm(CHANNEL_USERNAME_2) and _norm(CHANNEL_USERNAME_2).lower() != _norm(CHANNEL_USERNAME).lower():
     MANDATORY_CHANNELS.append(_norm(CHANNEL_USERNAME_2))
 
+# چند پردازه: آپدیت‌ها بر اساس user_id بین WORKERS پردازه پخش می‌شوند
+WORKERS = max(1, int(os.environ.get("WORKERS", "1")))
+CONCURRENT_UPDATES = max(1, int(os.environ.get("CONCURRENT_UPDATES", "1")))
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")  # با WEBHOOK_URL اجباری است
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_MAX_BODY = int(os.environ.get("WEBHOOK_MAX_BODY", str(1 << 20)))  # آپدیت تلگرام چند KB است
+PORT = int(os.environ.get("PORT", "8080"))
+# پروفایل اجرا: default یا fast (uvloop + orjson در صورت نصب بودن)
+RUNTIME_PROFILE = os.environ.get("RUNTIME_PROFILE", "default").strip().lower()
+WORKER_ID = f"{os.uname().nodename}:{os.getpid()}"
+
 # ---------- ثوابت ----------
 TRIGGERS = {"نجوا", "درگوشی", "سکرت"}
 KEEP_TRIGGER_MESSAGE = True  # ✅ پیام دستور در گروه پاک نشود
@@ -60,7 +119,135 @@ ALERT_SNIPPET = 190
 # تاریخ خیلی دور برای «بدون انقضا»
 FAR_FUTURE = datetime(2099, 1, 1, tzinfo=timezone.utc)
 
-broadcast_wait_for_banner = set()
+# مهلت فرستادن متن پس از تریگر در گروه
+PENDING_TTL_SEC = int(os.environ.get("PENDING_TTL_SEC", "3600"))
+PENDING_SWEEP_SEC = 60
+
+# مکث اینلاین: هر کاربر پس از این مدت بی‌تایپی جواب می‌گیرد؛ کوئری‌های قدیمی‌تر لغو می‌شوند (۰ یعنی بدون مکث)
+INLINE_DEBOUNCE_MS = float(os.environ.get("INLINE_DEBOUNCE_MS", "300"))
+
+# جستجوی ادمین: ردیف در هر صفحه و عمر جلسه‌ی صفحه‌بندی
+SEARCH_PAGE_SIZE = 8
+SEARCH_SESSION_TTL = 3600
+
+# بودجه‌ی زمانی هر آپدیت بر اساس نوع (ثانیه)؛ قدم‌های غیرضروری پس از آن لغو یا پس‌زمینه می‌شوند
+UPDATE_BUDGETS = {
+    "callback": float(os.environ.get("BUDGET_CALLBACK_SEC", "1.5")),
+    "inline": float(os.environ.get("BUDGET_INLINE_SEC", "2")),
+    "message": float(os.environ.get("BUDGET_MESSAGE_SEC", "4")),
+    "other": float(os.environ.get("BUDGET_OTHER_SEC", "10")),
+}
+# زمانی که برای قدم ضروری بعدی (answer / ارسال) کنار گذاشته می‌شود
+BUDGET_RESERVE_SEC = float(os.environ.get("BUDGET_RESERVE_SEC", "0.5"))
+
+JOB_POLL_SEC = float(os.environ.get("JOB_POLL_SEC", "1"))
+JOB_CLAIM_TIMEOUT_SEC = 300
+# پایش پردازه‌های کارگر (WORKERS>1): فاصله‌ی بررسی و حداکثر راه‌اندازی دوباره‌ی هر کارگر در یک دقیقه
+WORKER_CHECK_SEC = 5
+WORKER_MAX_RESTARTS_PER_MIN = 3
+CAPACITY_LOCK_KEY = 0x6E6A7761  # کلید قفل مشورتی ظرفیت نصب
+
+# کش‌های درون‌حافظه (ثانیه)
+NAME_CACHE_TTL = int(os.environ.get("NAME_CACHE_TTL", "3600"))
+TITLE_CACHE_TTL = int(os.environ.get("TITLE_CACHE_TTL", "3600"))
+WATCHERS_CACHE_TTL = int(os.environ.get("WATCHERS_CACHE_TTL", "3600"))
+MEMBER_CACHE_TTL = int(os.environ.get("MEMBER_CACHE_TTL", "600"))
+MEMBER_NEG_CACHE_TTL = int(os.environ.get("MEMBER_NEG_CACHE_TTL", "30"))
+# تازه‌سازی پیش‌دستانه‌ی عضویت فرستنده‌های اخیر: چند ثانیه پیش از انقضا، پنجره‌ی «اخیر»،
+# حداکثر بررسی هم‌زمان و سقف فراخوانی getChatMember در ثانیه
+MEMBER_REFRESH_AHEAD_SEC = float(os.environ.get("MEMBER_REFRESH_AHEAD_SEC", "120"))
+MEMBER_ACTIVE_WINDOW_SEC = float(os.environ.get("MEMBER_ACTIVE_WINDOW_SEC", "1800"))
+MEMBER_REFRESH_CONCURRENCY = int(os.environ.get("MEMBER_REFRESH_CONCURRENCY", "4"))
+MEMBER_REFRESH_RATE = float(os.environ.get("MEMBER_REFRESH_RATE", "5"))
+MEMBER_REFRESH_SCAN_SEC = 15
+INVALIDATION_CHANNEL = "najva_inval"
+
+# صف‌های اولویت برای ترافیک خروجی: (نرخ مجاز در ثانیه؛ ۰ یعنی بدون محدودیت، اندازه‌ی استخر اتصال)
+LANES = {
+    "interactive": (float(os.environ.get("LANE_RATE_INTERACTIVE", "0")), int(os.environ.get("LANE_POOL_INTERACTIVE", "16"))),
+    "user": (float(os.environ.get("LANE_RATE_USER", "0")), int(os.environ.get("LANE_POOL_USER", "32"))),
+    "report": (float(os.environ.get("LANE_RATE_REPORT", "10")), int(os.environ.get("LANE_POOL_REPORT", "4"))),
+    "bulk": (float(os.environ.get("LANE_RATE_BULK", "20")), int(os.environ.get("LANE_POOL_BULK", "4"))),
+}
+INTERACTIVE_METHODS = {"answerCallbackQuery", "answerInlineQuery"}
+
+# تلاش مجدد برای هر صف: (حداکثر تلاش، سقف کل زمان انتظار به ثانیه)
+RETRY_BUDGETS = {"interactive": (2, 1.5), "user": (3, 5.0), "report": (4, 30.0), "bulk": (5, 60.0)}
+RETRY_BASE_DELAY = 0.5
+# متدهایی که تکرارشان پس از timeout پیام تکراری نمی‌سازد
+IDEMPOTENT_PREFIXES = ("get", "answer", "delete", "edit", "leave", "set")
+BREAKER_THRESHOLD = int(os.environ.get("BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN_SEC = float(os.environ.get("BREAKER_COOLDOWN_SEC", "15"))
+
+log = logging.getLogger("najva")
+
+# پایش تأخیر حلقه‌ی رویداد و پروفایلر
+LOOP_LAG_TICK_SEC = float(os.environ.get("LOOP_LAG_TICK_SEC", "0.25"))
+LOOP_LAG_WARN_MS = float(os.environ.get("LOOP_LAG_WARN_MS", "250"))
+PROFILE_MAX_SEC = 120
+PROFILE_SAMPLE_SEC = 0.005
+
+# ضبط آپدیت‌های ورودی (ناشناس‌شده) برای بازپخش؛ خالی یعنی خاموش
+RECORD_UPDATES_DIR = os.environ.get("RECORD_UPDATES_DIR", "")
+RECORD_MAX_BYTES = int(os.environ.get("RECORD_MAX_BYTES", str(50 * 1024 * 1024)))
+RECORD_KEEP = int(os.environ.get("RECORD_KEEP", "5"))
+# کلید HMAC ناشناس‌سازی؛ با RECORD_UPDATES_DIR اجباری است (شناسه‌ها و یوزرنیم‌ها با کلید معلوم برگشت‌پذیرند)
+RECORD_SALT = os.environ.get("RECORD_SALT", "").encode()
+RECORD_FLUSH_SEC = 2.0
+
+# ردیابی هر آپدیت (DB / API / کش)؛ خالی یعنی خاموش. آپدیت‌های کندتر از آستانه همیشه
+# و بقیه با احتمال TRACE_SAMPLE در فایل JSONL نوشته می‌شوند
+TRACE_FILE = os.environ.get("TRACE_FILE", "")
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", "500"))
+TRACE_SAMPLE = float(os.environ.get("TRACE_SAMPLE", "0.01"))
+
+# محدودیت نرخ: ظرفیت انفجاری (burst) و نرخ پرشدن (توکن در ثانیه)
+RATE_USER_BURST = float(os.environ.get("RATE_USER_BURST", "5"))
+RATE_USER_REFILL = float(os.environ.get("RATE_USER_REFILL", "0.5"))
+RATE_CHAT_BURST = float(os.environ.get("RATE_CHAT_BURST", "20"))
+RATE_CHAT_REFILL = float(os.environ.get("RATE_CHAT_REFILL", "2"))
+RATE_INLINE_BURST = float(os.environ.get("RATE_INLINE_BURST", "15"))
+RATE_INLINE_REFILL = float(os.environ.get("RATE_INLINE_REFILL", "3"))
+
+# ---------- پروفایل اجرا (uvloop / orjson) ----------
+FAST_JSON = RUNTIME_PROFILE == "fast" and orjson is not None
+runtime_info = {"loop": "asyncio", "json": "orjson" if FAST_JSON else "json"}
+
+def json_loads(data):
+    return orjson.loads(data) if FAST_JSON else json.loads(data)
+
+def json_dumps_bytes(obj) -> bytes:
+    if FAST_JSON:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+def decode_api_payload(payload: bytes):
+    """جایگزین BaseRequest.parse_json_payload؛ بایت خام را مستقیم به orjson می‌دهد."""
+    try:
+        return json_loads(payload)
+    except ValueError:
+        pass
+    # UTF-8 نامعتبر: مثل PTB با errors="replace" دوباره تلاش می‌کنیم
+    decoded = payload.decode("utf-8", "replace")
+    try:
+        return json.loads(decoded)
+    except ValueError as exc:
+        log.error("invalid JSON from Bot API: %r", decoded[:200])
+        raise TelegramError("Invalid server response") from exc
+
+def install_runtime_profile():
+    """پیش از ساختن حلقه‌ی رویداد صدا زده می‌شود (در main و هر پردازه‌ی worker)."""
+    if RUNTIME_PROFILE != "fast":
+        return
+    try:
+        import uvloop
+    except ImportError:
+        log.warning("RUNTIME_PROFILE=fast but uvloop is not installed; using the default asyncio loop")
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        runtime_info["loop"] = "uvloop"
+    if orjson is None:
+        log.warning("RUNTIME_PROFILE=fast but orjson is not installed; using the standard json module")
 
 # ---------- ابزارک‌های عمومی ----------
 def sanitize(name: str) -> str:
@@ -75,28 +262,918 @@ def group_link_title(title: str) -> str:
 def avatar_url(label: str) -> str:
     return f"https://api.dicebear.com/7.x/initials/svg?seed={urlquote(label or 'user')}"
 
-async def safe_delete(bot, chat_id: int, message_id: int, attempts: int = 3, delay: float = 0.6):
-    for _ in range(attempts):
-        try:
-            await bot.delete_message(chat_id, message_id)
+async def _delete_quietly(bot, chat_id: int, message_id: int):
+    try:
+        await bot.delete_message(chat_id, message_id)
+    except Exception:
+        pass
+
+def safe_delete(bot, chat_id: int, message_id: int):
+    # حذف در پس‌زمینه؛ تلاش مجدد را لایه‌ی درخواست‌ها انجام می‌دهد و هندلر منتظر نمی‌ماند
+    return spawn_background(_delete_quietly(bot, chat_id, message_id))
+
+# ---------- کش‌ها ----------
+class TTLCache:
+    """کش ساده با انقضا؛ با پر شدن، قدیمی‌ترین کلیدها بیرون می‌روند.
+
+    کش‌های نام‌دار (`name`) برخورد/خطای خود را در ردیابی آپدیت جاری ثبت می‌کنند.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 50000, name: str = ""):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.name = name
+        self.data = {}  # key -> (expires_at, value)
+
+    def get(self, key, default=None, stale: bool = False):
+        """stale=True مقدار منقضی را هم برمی‌گرداند (وقتی دیتابیس در دسترس نیست)."""
+        item = self.data.get(key)
+        if item is None:
+            result = "miss"
+        elif item[0] >= time.monotonic():
+            result = "hit"
+        else:
+            result = "stale" if stale else "miss"
+        if self.name:
+            trace_event("cache", self.name, result=result)
+        return default if result == "miss" else item[1]
+
+    def set(self, key, value, ttl: float | None = None):
+        if key not in self.data and len(self.data) >= self.maxsize:
+            self.data.pop(next(iter(self.data)), None)
+        self.data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+
+    def pop(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+name_cache = TTLCache(NAME_CACHE_TTL, name="names")              # user_id -> (first_name, username)
+title_cache = TTLCache(TITLE_CACHE_TTL, name="titles")            # chat_id -> title
+watchers_cache = TTLCache(WATCHERS_CACHE_TTL, name="watchers")    # (bot key, group_id) -> tuple(watcher_id)
+member_cache = TTLCache(MEMBER_CACHE_TTL, name="member")          # user_id -> bool
+
+# نام هر نوع پیام ابطال -> کشی که باید از آن حذف شود. member_cache اینجا نیست: همه‌ی آپدیت‌های یک کاربر
+# (و chat_member او در کانال‌ها) به یک پردازه می‌روند، پس فقط همان پردازه عضویتش را کش می‌کند
+CACHES = {"users": name_cache, "chats": title_cache, "watchers": watchers_cache}
+
+# ---------- محدودیت نرخ (token bucket) ----------
+class TokenBucketLimiter:
+    """یک سطل توکن برای هر کلید؛ رد کردن درخواست بدون هیچ I/O انجام می‌شود."""
+
+    def __init__(self, burst: float, refill: float, max_keys: int = 50000):
+        self.burst = burst
+        self.refill = refill
+        self.max_keys = max_keys
+        self.buckets = {}  # key -> [tokens, last_ts]
+
+    def peek(self, key) -> bool:
+        """آیا allow() الان توکن می‌دهد؛ بدون برداشتن توکن."""
+        b = self.buckets.get(key)
+        return b is None or min(self.burst, b[0] + (time.monotonic() - b[1]) * self.refill) >= 1
+
+    def allow(self, key) -> bool:
+        now = time.monotonic()
+        b = self.buckets.get(key)
+        if b is None:
+            if len(self.buckets) >= self.max_keys:
+                self._prune(now)
+            self.buckets[key] = [self.burst - 1, now]
             return True
-        except Exception:
-            await asyncio.sleep(delay)
-    return False
+        tokens = min(self.burst, b[0] + (now - b[1]) * self.refill)
+        b[1] = now
+        if tokens < 1:
+            b[0] = tokens
+            return False
+        b[0] = tokens - 1
+        return True
+
+    def _prune(self, now: float):
+        # سطل‌هایی که تا الان دوباره پر شده‌اند اطلاعاتی ندارند
+        full_after = self.burst / self.refill if self.refill > 0 else float("inf")
+        for k in [k for k, b in self.buckets.items() if now - b[1] >= full_after]:
+            del self.buckets[k]
+
+user_limiter = TokenBucketLimiter(RATE_USER_BURST, RATE_USER_REFILL)
+chat_limiter = TokenBucketLimiter(RATE_CHAT_BURST, RATE_CHAT_REFILL)
+inline_limiter = TokenBucketLimiter(RATE_INLINE_BURST, RATE_INLINE_REFILL)
+shed_stats = Counter()
 
-# --- زمان‌بندی بدون JobQueue (با asyncio) ---
-async def _delete_after(bot, chat_id: int, message_id: int, delay_sec: int):
+def allow_event(kind: str, user_id: int | None, chat_id: int | None = None, limiter: TokenBucketLimiter = None) -> bool:
+    if user_id == ADMIN_ID:
+        return True
+    limiter = limiter or user_limiter
+    # اول هر دو سطل بررسی می‌شوند تا رویداد ردشده توکن سطل دیگر را مصرف نکند
+    if user_id and not limiter.peek(user_id):
+        shed_stats[f"{kind}:user"] += 1
+        return False
+    if chat_id and not chat_limiter.peek(chat_id):
+        shed_stats[f"{kind}:chat"] += 1
+        return False
+    if user_id:
+        limiter.allow(user_id)
+    if chat_id:
+        chat_limiter.allow(chat_id)
+    return True
+
+# ---------- صف‌های اولویت درخواست‌های خروجی تلگرام ----------
+_api_lane = contextvars.ContextVar("api_lane", default="user")
+
+@contextlib.contextmanager
+def api_lane(name: str):
+    """همه‌ی فراخوانی‌های ربات داخل این بلوک در صف `name` ارسال می‌شوند."""
+    token = _api_lane.set(name)
+    try:
+        yield
+    finally:
+        _api_lane.reset(token)
+
+class LanePacer:
+    """فاصله‌گذاری FIFO بین درخواست‌های یک صف، به‌همراه عمق صف و زمان انتظار."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_at = 0.0
+        self.waiting = 0
+        self.count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def acquire(self):
+        start = time.monotonic()
+        if self.interval:
+            slot = max(start, self.next_at)
+            self.next_at = slot + self.interval
+            if slot > start:
+                self.waiting += 1
+                try:
+                    await asyncio.sleep(slot - start)
+                finally:
+                    self.waiting -= 1
+        waited = time.monotonic() - start
+        self.count += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+    def summary(self) -> str:
+        avg = (self.wait_total / self.count * 1000) if self.count else 0.0
+        return f"صف={self.waiting} تعداد={self.count} انتظار میانگین={avg:.0f}ms بیشینه={self.wait_max * 1000:.0f}ms"
+
+api_stats = Counter()
+
+class CircuitOpenError(NetworkError):
+    """مدار این متد باز است؛ تا پایان زمان خنک‌شدن درخواستی به تلگرام نمی‌رود."""
+
+class CircuitBreaker:
+    """بسته -> (threshold خطای پیاپی) باز -> (پس از cooldown) نیمه‌باز: فقط یک درخواست آزمایشی عبور
+    می‌کند و بقیه تا نتیجه‌ی آن رد می‌شوند؛ موفقیتش مدار را می‌بندد و شکستش دوباره باز می‌کند."""
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    def check(self, endpoint: str):
+        if self.failures < self.threshold:
+            return
+        if self.probing or time.monotonic() < self.open_until:
+            raise CircuitOpenError(f"circuit open for {endpoint}")
+        self.probing = True
+
+    def success(self):
+        self.failures = 0
+        self.probing = False
+
+    def release(self):
+        # درخواست آزمایشی بدون نتیجه لغو شد؛ درخواست بعدی آزمایش می‌کند
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.failures >= self.threshold:
+            self.open_until = time.monotonic() + self.cooldown
+
+def is_transport_error(exc: Exception) -> bool:
+    """خطای شبکه (timeout، قطع اتصال)؛ BadRequest هم زیرکلاس NetworkError است ولی پاسخ خود تلگرام است."""
+    return isinstance(exc, NetworkError) and not isinstance(exc, (BadRequest, CircuitOpenError))
+
+def classify_error(exc: Exception, endpoint: str) -> str:
+    """'rate_limited' | 'retryable' | 'permanent'"""
+    if isinstance(exc, RetryAfter):
+        return "rate_limited"
+    if is_transport_error(exc):
+        # شاید درخواست به تلگرام رسیده باشد؛ تکرار sendMessage و مانند آن پیام تکراری می‌سازد
+        return "retryable" if endpoint.startswith(IDEMPOTENT_PREFIXES) else "permanent"
+    return "permanent"
+
+class LaneRateLimiter(BaseRateLimiter):
+    """همه‌ی فراخوانی‌های Bot از اینجا می‌گذرند: انتخاب صف، سهم نرخ، تلاش مجدد و قطع‌کننده‌ی مدار.
+
+    سقف نرخ تلگرام برای هر ربات جداست، پس هر ربات صف‌های (`pacers`) خودش را دارد.
+    """
+
+    def __init__(self, pacers: dict):
+        self.pacers = pacers
+        self.breakers = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _breaker(self, endpoint: str) -> CircuitBreaker:
+        b = self.breakers.get(endpoint)
+        if b is None:
+            b = self.breakers[endpoint] = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN_SEC)
+        return b
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        lane = "interactive" if endpoint in INTERACTIVE_METHODS else _api_lane.get()
+        max_attempts, max_delay = RETRY_BUDGETS[lane]
+        breaker = self._breaker(endpoint)
+        slept = 0.0
+        token = _api_lane.set(lane)
+        try:
+            with trace_span("api", endpoint, lane=lane) as span:
+                for attempt in range(1, max_attempts + 1):
+                    try:
+                        breaker.check(endpoint)
+                    except CircuitOpenError:
+                        api_stats["circuit_open"] += 1
+                        raise
+                    try:
+                        await self.pacers[lane].acquire()
+                        result = await callback(*args, **kwargs)
+                    except asyncio.CancelledError:
+                        breaker.release()
+                        raise
+                    except Exception as exc:
+                        kind = classify_error(exc, endpoint)
+                        if is_transport_error(exc):
+                            breaker.failure()
+                        else:
+                            breaker.success()  # تلگرام پاسخ داده (حتی با خطا)؛ مسیر سالم است
+                        if kind == "retryable":
+                            delay = random.uniform(0, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+                        elif kind == "rate_limited":
+                            delay = float(exc.retry_after)
+                        else:
+                            api_stats["permanent"] += 1
+                            raise
+                        api_stats[kind] += 1
+                        if attempt == max_attempts or slept + delay > max_delay:
+                            log.warning("%s failed after %d attempt(s) in lane %s: %r", endpoint, attempt, lane, exc)
+                            raise
+                        slept += delay
+                        api_stats["retries"] += 1
+                        await asyncio.sleep(delay)
+                        continue
+                    breaker.success()
+                    if span is not None and attempt > 1:
+                        span["attempts"] = attempt
+                    return result
+        finally:
+            _api_lane.reset(token)
+
+class LaneRequest(BaseRequest):
+    """برای هر صف یک استخر اتصال HTTP جدا؛ ترافیک انبوه اتصال‌های تعاملی را اشغال نمی‌کند."""
+
+    parse_json_payload = staticmethod(decode_api_payload)
+
+    def __init__(self):
+        self.requests = {
+            name: HTTPXRequest(connection_pool_size=size, pool_timeout=(1.0 if name == "interactive" else 10.0))
+            for name, (_, size) in LANES.items()
+        }
+
+    @property
+    def read_timeout(self):
+        return self.requests["user"].read_timeout
+
+    async def initialize(self):
+        for r in self.requests.values():
+            await r.initialize()
+
+    async def shutdown(self):
+        for r in self.requests.values():
+            await r.shutdown()
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        return await self.requests[_api_lane.get()].do_request(url, method, request_data, **kwargs)
+
+# --- زمان‌بندی بدون JobQueue ---
+# یک پردازه: task درون‌حافظه (بدون I/O دیتابیس در مسیر تریگر)؛ چند پردازه: جدول scheduled_jobs
+# که هر پردازه ردیف‌های سررسید را claim می‌کند
+async def _delete_after(bot, chat_id: int, message_id: int, delay_sec: float):
     try:
         await asyncio.sleep(delay_sec)
         await bot.delete_message(chat_id, message_id)
     except Exception:
         pass
 
-def schedule_delete(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, delay_sec: int):
-    context.application.create_task(_delete_after(context.bot, chat_id, message_id, delay_sec))
+async def schedule_delete(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, delay_sec: int):
+    if WORKERS == 1:
+        spawn_background(_delete_after(context.bot, chat_id, message_id, delay_sec))
+        return
+    try:
+        async with pool.acquire() as con:
+            await con.execute(
+                """INSERT INTO scheduled_jobs (bot_id, kind, chat_id, message_id, run_at)
+                   VALUES ($1,'delete',$2,$3,NOW() + make_interval(secs => $4));""",
+                tenant().key, chat_id, message_id, float(delay_sec)
+            )
+    except Exception:
+        pass
+
+async def claim_due_jobs(limit: int = 50):
+    async with pool.acquire() as con:
+        return await con.fetch(
+            """UPDATE scheduled_jobs SET claimed_by=$1, claimed_at=NOW()
+               WHERE id IN (
+                 SELECT id FROM scheduled_jobs
+                 WHERE run_at<=NOW() AND bot_id = ANY($4::bigint[])
+                   AND (claimed_by IS NULL OR claimed_at < NOW() - make_interval(secs => $3))
+                 ORDER BY run_at LIMIT $2
+                 FOR UPDATE SKIP LOCKED)
+               RETURNING id, bot_id, kind, chat_id, message_id;""",
+            WORKER_ID, limit, float(JOB_CLAIM_TIMEOUT_SEC), list(tenants)
+        )
+
+async def job_runner():
+    """یک حلقه برای همه‌ی ربات‌های این پردازه؛ هر کار با ربات صاحبش (bot_id) اجرا می‌شود."""
+    while True:
+        await asyncio.sleep(JOB_POLL_SEC)
+        try:
+            jobs = await claim_due_jobs()
+        except Exception:
+            continue
+        for j in jobs:
+            t = tenants.get(int(j["bot_id"]))
+            if t is None or t.app is None:
+                continue
+            if j["kind"] == "delete":
+                try:
+                    await t.app.bot.delete_message(int(j["chat_id"]), int(j["message_id"]))
+                except Exception:
+                    pass
+        if jobs:
+            try:
+                async with pool.acquire() as con:
+                    await con.execute("DELETE FROM scheduled_jobs WHERE id = ANY($1::bigint[]);", [int(j["id"]) for j in jobs])
+            except Exception:
+                pass
+
+async def adopt_scheduled_jobs():
+    """WORKERS=1: کارهای مانده از اجرای چندپردازه‌ای قبلی به زمان‌بند درون‌پردازه منتقل می‌شوند."""
+    try:
+        async with pool.acquire() as con:
+            jobs = await con.fetch(
+                """DELETE FROM scheduled_jobs WHERE bot_id = ANY($1::bigint[])
+                   RETURNING bot_id, kind, chat_id, message_id,
+                             GREATEST(EXTRACT(EPOCH FROM run_at - NOW()), 0)::float8 AS delay;""",
+                list(tenants)
+            )
+    except Exception:
+        return
+    for j in jobs:
+        t = tenants.get(int(j["bot_id"]))
+        if j["kind"] == "delete" and t is not None and t.app is not None:
+            spawn_background(_delete_after(t.app.bot, int(j["chat_id"]), int(j["message_id"]), j["delay"]))
+
+# کارهای پس‌زمینه‌ی سراسری (حلقه‌های دوره‌ای) — نگه‌داشتن ارجاع تا GC آن‌ها را جمع نکند
+_bg_tasks = set()
+
+def spawn_background(coro):
+    task = asyncio.get_running_loop().create_task(coro)
+    _bg_tasks.add(task)
+    task.add_done_callback(_bg_tasks.discard)
+    return task
+
+# ---------- بودجه‌ی زمانی هر آپدیت ----------
+class UpdateBudget:
+    __slots__ = ("kind", "deadline")
+
+    def __init__(self, kind: str, deadline: float):
+        self.kind = kind
+        self.deadline = deadline  # time.monotonic()
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+_update_budget = contextvars.ContextVar("update_budget", default=None)
+budget_stats = Counter()  # "نوع:قدم:background|cancelled" و "نوع:overrun"
+
+def update_kind(update) -> str:
+    if not isinstance(update, Update):
+        return "other"
+    if update.callback_query:
+        return "callback"
+    if update.inline_query:
+        return "inline"
+    if update.message or update.edited_message:
+        return "message"
+    return "other"
+
+def _log_background_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        log.warning("backgrounded step failed: %r", task.exception())
+
+async def budgeted(coro, label: str, fallback=None, reserve: float = 0.0, background: bool = False):
+    """قدم غیرضروری زیر بودجه‌ی آپدیت جاری؛ `reserve` ثانیه برای قدم‌های ضروری بعدی کنار می‌ماند.
+
+    اگر به‌موقع تمام نشود: با background=True در پس‌زمینه ادامه می‌یابد (بدون مهلت)،
+    وگرنه لغو می‌شود؛ در هر دو حالت `fallback` برمی‌گردد.
+    """
+    b = _update_budget.get()
+    if b is None:
+        return await coro
+    timeout = b.remaining() - reserve
+    if timeout <= 0 and not background:
+        coro.close()
+        budget_stats[f"{b.kind}:{label}:cancelled"] += 1
+        return fallback
+    child = UpdateBudget(b.kind, b.deadline)
+
+    async def run():
+        _update_budget.set(child)  # در کانتکست کپی‌شده‌ی همین تسک
+        with trace_span("step", label):
+            return await coro
+
+    task = asyncio.ensure_future(run())
+    if timeout > 0:
+        try:
+            done, _ = await asyncio.wait((task,), timeout=timeout)
+        except asyncio.CancelledError:
+            # asyncio.wait فرزند را لغو نمی‌کند؛ هندلر لغوشده (مثلاً کوئری اینلاین جایگزین‌شده) قدم یتیم نگذارد
+            task.cancel()
+            raise
+        if done:
+            return task.result()
+    if background:
+        child.deadline = float("inf")
+        _bg_tasks.add(task)
+        task.add_done_callback(_bg_tasks.discard)
+        task.add_done_callback(_log_background_failure)
+        budget_stats[f"{b.kind}:{label}:background"] += 1
+    else:
+        task.cancel()
+        budget_stats[f"{b.kind}:{label}:cancelled"] += 1
+    return fallback
+
+# ---------- نوشتن فایل در نخ پس‌زمینه ----------
+class BackgroundLineWriter:
+    """I/O دیسک خارج از حلقه‌ی رویداد: put() فقط خط را در صف می‌گذارد و یک نخ خط‌های رسیده را
+    دسته‌ای با `write(lines)` می‌نویسد و هر `flush_sec` یک بار `flush()` می‌کند. اگر صف پر
+    باشد خط دور ریخته می‌شود (فقط شمرده می‌شود)؛ هنگام خروج پردازه باقی صف نوشته و `finish()`
+    (مثلاً بستن فایل) صدا زده می‌شود."""
+
+    _STOP = object()
+
+    def __init__(self, name: str, write, flush, flush_sec: float, finish=None, maxsize: int = 10000):
+        self.name = name
+        self.write = write
+        self.flush = flush
+        self.finish = finish
+        self.flush_sec = flush_sec
+        self.q = queue.Queue(maxsize)
+        self.thread = None
+        self.dropped = 0
+
+    def put(self, line: bytes) -> bool:
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+        try:
+            self.q.put_nowait(line)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _run(self):
+        next_flush = time.monotonic() + self.flush_sec
+        while True:
+            try:
+                batch = [self.q.get(timeout=max(next_flush - time.monotonic(), 0.01))]
+            except queue.Empty:
+                batch = []
+            while len(batch) < 1000:
+                try:
+                    batch.append(self.q.get_nowait())
+                except queue.Empty:
+                    break
+            stop = self._STOP in batch
+            lines = [b for b in batch if b is not self._STOP]
+            try:
+                if lines:
+                    self.write(lines)
+                if stop or time.monotonic() >= next_flush:
+                    self.flush()
+                    next_flush = time.monotonic() + self.flush_sec
+                if stop and self.finish is not None:
+                    self.finish()
+            except Exception:
+                self.dropped += len(lines)
+                log.exception("%s: write failed", self.name)
+            if stop:
+                return
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.q.put(self._STOP)
+            self.thread.join(timeout=5)
+
+# ---------- ردیابی آپدیت‌ها ----------
+class UpdateTrace:
+    """درخت span‌های یک آپدیت؛ `at` و `ms` نسبت به شروع آپدیت و بر حسب میلی‌ثانیه‌اند."""
+
+    __slots__ = ("update_id", "kind", "t0", "spans", "ms")
+
+    def __init__(self, update_id, kind: str):
+        self.update_id = update_id
+        self.kind = kind
+        self.t0 = time.perf_counter()
+        self.spans = []
+        self.ms = None  # پس از پایان آپدیت؛ span‌های دیرتر (کارهای پس‌زمینه) ثبت نمی‌شوند
+
+    def now(self) -> float:
+        return (time.perf_counter() - self.t0) * 1000
+
+    def add(self, kind: str, name: str, at: float, ms: float | None = None, **extra) -> dict | None:
+        if self.ms is not None:
+            return None
+        span = {"id": len(self.spans) + 1, "p": _trace_parent.get(), "type": kind, "name": name,
+                "at": round(at, 2), "ms": None if ms is None else round(ms, 2), **extra}
+        self.spans.append(span)
+        return span
+
+    def to_dict(self) -> dict:
+        return {"t": time.time(), "update_id": self.update_id, "kind": self.kind,
+                "ms": round(self.ms, 2), "spans": self.spans}
+
+_trace = contextvars.ContextVar("update_trace", default=None)
+_trace_parent = contextvars.ContextVar("trace_parent", default=0)
+trace_stats = Counter()  # slow / sampled / dropped
+
+@contextlib.contextmanager
+def trace_span(kind: str, name: str, **extra):
+    """span تو در تو در ردیابی آپدیت جاری؛ بیرون از آپدیت یا با ردیابی خاموش، None می‌دهد."""
+    tr = _trace.get()
+    span = tr.add(kind, name, tr.now(), **extra) if tr is not None else None
+    if span is None:
+        yield None
+        return
+    token = _trace_parent.set(span["id"])
+    try:
+        yield span
+    except BaseException as e:
+        span["error"] = type(e).__name__
+        raise
+    finally:
+        _trace_parent.reset(token)
+        span["ms"] = round(tr.now() - span["at"], 2)
+
+def trace_event(kind: str, name: str, **extra):
+    tr = _trace.get()
+    if tr is not None:
+        tr.add(kind, name, tr.now(), 0.0, **extra)
+
+_sql_names = {}
+
+def sql_name(query: str) -> str:
+    """نام کوتاه یک دستور برای ردیابی: فعل + اولین جدول (مثل «INSERT whispers»)."""
+    name = _sql_names.get(query)
+    if name is None:
+        words = re.findall(r"[A-Za-z_][A-Za-z0-9_]*", query[:200])
+        verb = words[0].upper() if words else "?"
+        m = re.search(r"\b(?:FROM|INTO|UPDATE|TABLE)\s+([A-Za-z_][A-Za-z0-9_.]*)", query, re.IGNORECASE)
+        # بدون جدول (BEGIN، SELECT pg_notify(...)): فعل + کلمه‌ی بعدی
+        name = f"{verb} {m.group(1)}" if m else " ".join([verb] + words[1:2])
+        if len(_sql_names) < 2000:
+            _sql_names[query] = name
+    return name
+
+def trace_query(record):
+    """شنونده‌ی asyncpg (query_listeners)؛ با call_soon در کانتکست همان تسک صدا زده می‌شود."""
+    tr = _trace.get()
+    if tr is not None:
+        ms = record.elapsed * 1000
+        extra = {"error": type(record.exception).__name__} if record.exception is not None else {}
+        tr.add("db", sql_name(record.query), tr.now() - ms, ms, **extra)
+
+class TraceLog:
+    """هر ردیابی یک خط JSONL؛ با O_APPEND تا چند پردازه بتوانند در یک فایل بنویسند.
+
+    نوشتن در نخ BackgroundLineWriter انجام می‌شود تا ثبت ردیابی خودش به تأخیر حلقه اضافه نکند.
+    """
+
+    def __init__(self, path: str, slow_ms: float, sample: float):
+        self.path = path
+        self.slow_ms = slow_ms
+        self.sample = sample
+        self.fd = None
+        self.writer = BackgroundLineWriter("trace-log", self._write_lines, lambda: None, 1.0)
+
+    def _write_lines(self, lines: list):
+        # نخ نویسنده؛ یک write با O_APPEND برای هر دسته
+        if self.fd is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.write(self.fd, b"".join(lines))
+
+    def finish(self, tr: UpdateTrace):
+        tr.ms = tr.now()
+        if tr.ms >= self.slow_ms:
+            reason = "slow"
+        elif random.random() < self.sample:
+            reason = "sampled"
+        else:
+            return
+        if self.writer.put(json_dumps_bytes({**tr.to_dict(), "reason": reason}) + b"\n"):
+            trace_stats[reason] += 1
+
+    def summary(self) -> str:
+        # dropped: صف پر یا خطای نوشتن فایل
+        return f"{dict(trace_stats) or '—'} dropped={self.writer.dropped} → {self.path}"
+
+trace_log = TraceLog(TRACE_FILE, TRACE_SLOW_MS, TRACE_SAMPLE) if TRACE_FILE else None
+
+def _traced(callback):
+    name = callback.__name__
+
+    async def wrapper(update, context):
+        with trace_span("handler", name):
+            return await callback(update, context)
+
+    wrapper.__name__ = name
+    return wrapper
+
+def trace_handlers(app_):
+    for handlers in app_.handlers.values():
+        for h in handlers:
+            h.callback = _traced(h.callback)
+
+# ---------- پروفایل و پایش تأخیر حلقه ----------
+def _frame_label(f) -> str:
+    return f"{os.path.basename(f.f_code.co_filename)}:{f.f_code.co_name}:{f.f_lineno}"
+
+def _stack_of(thread_id: int) -> list:
+    frame = sys._current_frames().get(thread_id)
+    stack = []
+    while frame is not None:
+        stack.append(frame)
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+class LoopLagMonitor:
+    """ضربان حلقه را هر LOOP_LAG_TICK_SEC ثبت می‌کند؛ یک نخ ناظر اگر ضربان عقب بیفتد،
+    پشته‌ی کدی را که حلقه را مسدود کرده لاگ می‌کند. در حالت بیکار فقط دو بیدارشدن کوچک دارد."""
+
+    def __init__(self, tick: float, warn_ms: float):
+        self.tick = tick
+        self.warn = warn_ms / 1000.0
+        self.last_beat = time.monotonic()
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.loop_thread = None
+
+    async def heartbeat(self):
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.tick)
+            now = time.monotonic()
+            self.max_lag = max(self.max_lag, now - before - self.tick)
+            self.last_beat = now
+
+    def _watch(self):
+        reported = False
+        while True:
+            time.sleep(self.tick)
+            lag = time.monotonic() - self.last_beat - self.tick
+            if lag < self.warn:
+                reported = False
+                continue
+            if reported:
+                continue
+            reported = True
+            self.stalls += 1
+            stack = _stack_of(self.loop_thread)
+            log.warning(
+                "event loop blocked for %.0fms; running:\n%s",
+                lag * 1000, "".join(traceback.format_list(traceback.extract_stack(stack[-1]))[-12:]) if stack else "?"
+            )
+
+    def start(self):
+        self.loop_thread = threading.get_ident()
+        spawn_background(self.heartbeat())
+        threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True).start()
+
+lag_monitor = LoopLagMonitor(LOOP_LAG_TICK_SEC, LOOP_LAG_WARN_MS)
+
+def _sample_stacks(thread_id: int, seconds: float, counts: Counter):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        stack = _stack_of(thread_id)
+        if stack:
+            counts[";".join(_frame_label(f) for f in stack)] += 1
+        time.sleep(PROFILE_SAMPLE_SEC)
+
+async def profile_loop(seconds: float, mode: str = "collapsed") -> tuple:
+    """(نام فایل، محتوا) — نمونه‌برداری از پشته‌ی نخ حلقه یا cProfile روی همان نخ."""
+    if mode == "pstats":
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            prof.disable()
+        prof.create_stats()
+        return f"profile-{int(time.time())}.pstats", marshal.dumps(prof.stats)
+    counts = Counter()
+    await asyncio.get_running_loop().run_in_executor(None, _sample_stacks, threading.get_ident(), seconds, counts)
+    body = "\n".join(f"{stack} {n}" for stack, n in counts.most_common())
+    return f"profile-{int(time.time())}.collapsed.txt", body.encode("utf-8")
+
+async def _profile_and_send(bot, chat_id: int, seconds: float, mode: str):
+    try:
+        name, data = await profile_loop(seconds, mode)
+        await bot.send_document(chat_id, document=io.BytesIO(data), filename=name,
+                                caption=f"پروفایل {seconds:.0f} ثانیه‌ای ({mode})")
+    except Exception as e:
+        try:
+            await bot.send_message(chat_id, f"❌ خطا در پروفایل: {e!r}")
+        except Exception:
+            pass
+
+# ---------- ضبط آپدیت‌ها برای بازپخش ----------
+# کلمات دستوری دست‌نخورده می‌مانند تا بازپخش همان مسیرهای هندلر را طی کند
+RECORD_KEEP_TEXTS = TRIGGERS | {"راهنما", "help", "Help", "/start", "/start go"}
+_ID_KEYS = {"id", "user_id", "chat_id", "sender_chat_id", "migrate_to_chat_id", "migrate_from_chat_id"}
+_NAME_KEYS = {"first_name", "last_name", "title"}
+_TEXT_KEYS = {"text", "caption", "query"}
+
+def _anon_hash(value: str) -> str:
+    return hmac.new(RECORD_SALT, value.encode("utf-8"), hashlib.sha256).hexdigest()
+
+def _anon_id(value: int) -> int:
+    # علامت حفظ می‌شود (گروه‌ها منفی‌اند) و نگاشت پایدار است تا رفتار تکراری کاربران حفظ شود
+    h = int(_anon_hash(str(abs(value)))[:12], 16) % 10**12 + 1
+    return -h if value < 0 else h
+
+def _anon_username(name: str) -> str:
+    return "u" + _anon_hash(name.lstrip("@").lower())[:10]
+
+def _anon_text(text: str) -> str:
+    if text.strip() in RECORD_KEEP_TEXTS:
+        return text
+
+    def token(m):
+        t = m.group(0)
+        if t.startswith("@") and len(t) > 3:
+            return "@" + _anon_username(t)
+        return (_anon_hash(t) * (len(t) // 64 + 1))[:len(t)]
+    return re.sub(r"\S+", token, text)
+
+def _anon_callback(data: str) -> str:
+    prefix, _, rest = data.partition(":")
+    if not rest:
+        return data
+    parts = [str(_anon_id(int(p))) if re.fullmatch(r"-?\d+", p) and prefix != "showid" else p for p in rest.split(":")]
+    if prefix == "iws":
+        parts = [_anon_hash(rest)[:16]]
+    return ":".join([prefix] + parts)
+
+def anonymize_update(obj, key: str = ""):
+    if isinstance(obj, dict):
+        return {k: anonymize_update(v, k) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [anonymize_update(v, key) for v in obj]
+    if isinstance(obj, bool) or obj is None:
+        return obj
+    if isinstance(obj, int) and key in _ID_KEYS:
+        return _anon_id(obj)
+    if isinstance(obj, str):
+        if key == "username":
+            return _anon_username(obj)
+        if key in _NAME_KEYS:
+            return "n" + _anon_hash(obj)[:8]
+        if key in _TEXT_KEYS:
+            return _anon_text(obj)
+        if key == "data":
+            return _anon_callback(obj)
+        if key in ("result_id", "inline_message_id", "file_id", "file_unique_id", "phone_number"):
+            return _anon_hash(obj)[:16]
+    return obj
+
+class UpdateRecorder:
+    """آپدیت‌های ناشناس‌شده را به‌صورت JSONL فشرده (gzip) با چرخش بر اساس اندازه ذخیره می‌کند.
+
+    حلقه فقط خط را می‌سازد؛ فشرده‌سازی و نوشتن در نخ BackgroundLineWriter است و flush دوره‌ای
+    (نه هر خط) بلوک‌های gzip را بزرگ نگه می‌دارد. اندازه‌ی چرخش، بایت فشرده‌ی روی دیسک است.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, keep: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.path = os.path.join(directory, "updates.jsonl.gz")
+        self.fh = None
+        self.writer = BackgroundLineWriter("update-recorder", self._write_lines, self._flush, RECORD_FLUSH_SEC,
+                                           finish=self._close)
+
+    @property
+    def written(self) -> int:
+        return self.fh.fileobj.tell() if self.fh is not None else 0
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.fh = gzip.open(self.path, "ab")  # fileobj.tell() از انتهای فایل موجود شروع می‌شود
+
+    def _rotate(self):
+        self.fh.close()
+        for i in range(self.keep - 1, 0, -1):
+            src = os.path.join(self.directory, f"updates.{i}.jsonl.gz")
+            if os.path.exists(src):
+                os.replace(src, os.path.join(self.directory, f"updates.{i + 1}.jsonl.gz"))
+        os.replace(self.path, os.path.join(self.directory, "updates.1.jsonl.gz"))
+        self._open()
+
+    def _write_lines(self, lines: list):
+        # نخ نویسنده
+        if self.fh is None:
+            self._open()
+        self.fh.write(b"".join(lines))
+        if self.written >= self.max_bytes:
+            self._rotate()
+
+    def _flush(self):
+        if self.fh is not None:
+            self.fh.flush()
+
+    def _close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+    def write(self, data: dict):
+        self.writer.put(json_dumps_bytes({"t": time.time(), "u": anonymize_update(data)}) + b"\n")
+
+# بدون RECORD_SALT ضبط نمی‌شود (main() هم با خطا متوقف می‌شود)
+recorder = UpdateRecorder(RECORD_UPDATES_DIR, RECORD_MAX_BYTES, RECORD_KEEP) if RECORD_UPDATES_DIR and RECORD_SALT else None
+
+async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        recorder.write(update.to_dict())
+    except Exception:
+        log.exception("recording update failed")
 
 # ---------- دیتابیس ----------
 pool: asyncpg.Pool = None
+replica_pool: asyncpg.Pool = None
+recent_writes = TTLCache(READ_YOUR_WRITES_SEC)
+
+def db(intent: str = "write", key=None) -> asyncpg.Pool:
+    """استخر مناسب برای یک پرس‌وجو.
+
+    intent='read' به replica می‌رود، مگر replica تنظیم نشده باشد یا `key` همین تازگی
+    نوشته شده باشد (نجوا/مخاطب تازه) که در آن صورت primary خوانده می‌شود.
+    """
+    if intent == "read" and replica_pool is not None and (key is None or recent_writes.get(key) is None):
+        return replica_pool
+    return pool
+
+def note_write(key):
+    recent_writes.set(key, True)
+
+replica_stats = Counter()
+
+async def fetchrow_read(query: str, *args, key=None):
+    """یک ردیف با intent=read. اگر replica ردیفی نداشت از primary دوباره خوانده می‌شود: نوشتن ممکن است
+    در پردازه‌ی دیگری بوده باشد (WORKERS>1؛ recent_writes محلی است) یا هنوز به replica نرسیده باشد."""
+    p = db("read", key)
+    async with p.acquire() as con:
+        row = await con.fetchrow(query, *args)
+    if row is None and p is not pool:
+        replica_stats["miss_to_primary"] += 1
+        async with pool.acquire() as con:
+            row = await con.fetchrow(query, *args)
+    return row
+
+# شنونده‌های پرس‌وجو (LoggedQuery) که روی هر اتصال تازه نصب می‌شوند؛ برای بازپخش و ردیابی
+query_listeners = []
+if trace_log is not None:
+    query_listeners.append(trace_query)
+
+async def _init_connection(con):
+    for cb in query_listeners:
+        con.add_query_logger(cb)
 
 CREATE_SQL = """
 CREATE TABLE IF NOT EXISTS users (
@@ -155,6 +1232,25 @@ CREATE TABLE IF NOT EXISTS iwhispers (
   reported BOOLEAN NOT NULL DEFAULT FALSE
 );
 
+CREATE TABLE IF NOT EXISTS admin_state (
+  user_id BIGINT NOT NULL,
+  flag TEXT NOT NULL,
+  created_at TIMESTAMPTZ DEFAULT NOW(),
+  PRIMARY KEY (user_id, flag)
+);
+
+CREATE TABLE IF NOT EXISTS scheduled_jobs (
+  id BIGSERIAL PRIMARY KEY,
+  kind TEXT NOT NULL,
+  chat_id BIGINT NOT NULL,
+  message_id INTEGER,
+  run_at TIMESTAMPTZ NOT NULL,
+  claimed_by TEXT,
+  claimed_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS idx_jobs_due ON scheduled_jobs(run_at);
+
 CREATE TABLE IF NOT EXISTS whisper_contacts (
   owner_id BIGINT NOT NULL,
   peer_key TEXT NOT NULL,
@@ -173,69 +1269,860 @@ ALTER TABLE pending ADD COLUMN IF NOT EXISTS reply_to_msg_id BIGINT;
 ALTER TABLE iwhispers ADD COLUMN IF NOT EXISTS receiver_id BIGINT;
 ALTER TABLE iwhispers ADD COLUMN IF NOT EXISTS receiver_username TEXT;
 ALTER TABLE iwhispers ADD COLUMN IF NOT EXISTS reported BOOLEAN NOT NULL DEFAULT FALSE;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS reachable BOOLEAN NOT NULL DEFAULT TRUE;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS unreachable_at TIMESTAMPTZ;
+CREATE INDEX IF NOT EXISTS idx_chats_reachable_groups ON chats(chat_id)
+  WHERE reachable AND is_active AND type IN ('group','supergroup');
+ALTER TABLE pending ADD COLUMN IF NOT EXISTS state TEXT NOT NULL DEFAULT 'created';
+UPDATE pending SET state='guide' WHERE guide_message_id IS NOT NULL AND state='created';
+-- جستجوی متن: یکسان‌سازی ی/ک عربی، همزه‌ها، ۀ و نیم‌فاصله؛ حذف اعراب و کشیده
+CREATE OR REPLACE FUNCTION najva_fts_norm(t TEXT) RETURNS TEXT
+  LANGUAGE sql IMMUTABLE PARALLEL SAFE
+  AS $$ SELECT translate(lower(t), 'يكىۀأإ\u200c\u064b\u064c\u064d\u064e\u064f\u0650\u0651\u0652\u0640', 'یکیهاا ') $$;
+ALTER TABLE whispers ADD COLUMN IF NOT EXISTS text_tsv TSVECTOR
+  GENERATED ALWAYS AS (to_tsvector('simple', najva_fts_norm(text))) STORED;
+CREATE INDEX IF NOT EXISTS idx_whispers_tsv ON whispers USING GIN (text_tsv);
+CREATE INDEX IF NOT EXISTS idx_whispers_receiver ON whispers(receiver_id);
+CREATE INDEX IF NOT EXISTS idx_whispers_created ON whispers(created_at);
+-- صفحه‌های جستجو به ترتیب همین ایندکس خوانده می‌شوند (keyset روی created_at, id)
+CREATE INDEX IF NOT EXISTS idx_whispers_bot_created ON whispers(bot_id, created_at DESC, id DESC);
+-- چند ربات: داده‌ی هر ربات با bot_id جدا می‌شود؛ ردیف‌های قدیمی (۰) مال ربات اصلی‌اند
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS bot_id BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE pending ADD COLUMN IF NOT EXISTS bot_id BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE watchers ADD COLUMN IF NOT EXISTS bot_id BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE admin_state ADD COLUMN IF NOT EXISTS bot_id BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE scheduled_jobs ADD COLUMN IF NOT EXISTS bot_id BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE whispers ADD COLUMN IF NOT EXISTS bot_id BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE iwhispers ADD COLUMN IF NOT EXISTS bot_id BIGINT NOT NULL DEFAULT 0;
+DO $$
+DECLARE t TEXT; cols TEXT;
+BEGIN
+  FOR t, cols IN SELECT * FROM (VALUES ('chats', 'bot_id, chat_id'), ('pending', 'bot_id, sender_id'),
+                                       ('watchers', 'bot_id, group_id, watcher_id'),
+                                       ('admin_state', 'bot_id, user_id, flag')) v LOOP
+    IF NOT EXISTS (SELECT 1 FROM pg_index i JOIN pg_attribute a ON a.attrelid=i.indrelid AND a.attnum=i.indkey[0]
+                   WHERE i.indrelid=t::regclass AND i.indisprimary AND a.attname='bot_id') THEN
+      EXECUTE format('ALTER TABLE %I DROP CONSTRAINT %I, ADD PRIMARY KEY (%s)', t, t || '_pkey', cols);
+    END IF;
+  END LOOP;
+END $$;
+-- بلاک‌کردن ربات مخصوص همان ربات است؛ users فقط پروفایل مشترک را نگه می‌دارد
+CREATE TABLE IF NOT EXISTS bot_users (
+  bot_id BIGINT NOT NULL,
+  user_id BIGINT NOT NULL,
+  reachable BOOLEAN NOT NULL DEFAULT TRUE,
+  unreachable_at TIMESTAMPTZ,
+  PRIMARY KEY (bot_id, user_id)
+);
+-- ارسال همگانی فقط ردیف‌های زنده را از این ایندکس می‌خواند
+CREATE INDEX IF NOT EXISTS idx_bot_users_reachable ON bot_users(bot_id, user_id) WHERE reachable;
+-- نصب‌های قدیمی: وضعیت users.reachable یک بار به ربات اصلی (۰) منتقل و ستون‌ها حذف می‌شوند
+DO $$
+BEGIN
+  IF EXISTS (SELECT 1 FROM information_schema.columns
+             WHERE table_schema=current_schema() AND table_name='users' AND column_name='reachable') THEN
+    INSERT INTO bot_users (bot_id, user_id, reachable, unreachable_at)
+      SELECT 0, user_id, reachable, unreachable_at FROM users
+      ON CONFLICT (bot_id, user_id) DO NOTHING;
+    DROP INDEX IF EXISTS idx_users_reachable;
+    ALTER TABLE users DROP COLUMN reachable, DROP COLUMN unreachable_at;
+  END IF;
+END $$;
 """
 
 async def init_db():
-    global pool
-    pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=5)
+    global pool, replica_pool
+    pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=5, init=_init_connection,
+                                     timeout=DB_CONNECT_TIMEOUT_SEC)
+    if DATABASE_REPLICA_URL:
+        replica_pool = await asyncpg.create_pool(DATABASE_REPLICA_URL, min_size=1, max_size=5, init=_init_connection,
+                                                 timeout=DB_CONNECT_TIMEOUT_SEC)
     async with pool.acquire() as con:
         await con.execute(CREATE_SQL)
         await con.execute(ALTER_SQL)
 
-async def upsert_user(u):
-    async with pool.acquire() as con:
+# ---------- حالت افت: سلامت دیتابیس و ژورنال محلی نوشتن‌های غیرحیاتی ----------
+DB_UNAVAILABLE_TEXT = "⏳ سرویس موقتاً در دسترس نیست؛ چند لحظه‌ی دیگر دوباره تلاش کنید."
+
+_DB_OUTAGE_ERRORS = (
+    ConnectionError,  # ConnectionRefusedError، ConnectionResetError، ...
+    TimeoutError,     # مهلت اتصال (asyncio.TimeoutError هم همین است)
+    asyncpg.PostgresConnectionError,
+    asyncpg.CannotConnectNowError,
+    asyncpg.AdminShutdownError,
+    asyncpg.CrashShutdownError,
+    asyncpg.TooManyConnectionsError,
+)
+
+def is_db_outage(exc: BaseException) -> bool:
+    return isinstance(exc, _DB_OUTAGE_ERRORS)
+
+class DBHealth:
+    """ok یا degraded؛ با اولین خطای قطعی degraded می‌شود و فقط کاوشگر آن را برمی‌گرداند."""
+
+    def __init__(self):
+        self.ok = True
+        self.since = time.time()
+        self.outages = 0
+        self.last_error = ""
+
+    def failure(self, exc: BaseException):
+        self.last_error = repr(exc)[:200]
+        if self.ok:
+            self.ok = False
+            self.since = time.time()
+            self.outages += 1
+            log.warning("database unavailable, entering degraded mode: %r", exc)
+
+    def recovered(self):
+        if not self.ok:
+            log.warning("database reachable again after %.0fs", time.time() - self.since)
+            self.ok = True
+            self.since = time.time()
+
+    def summary(self) -> str:
+        state = "ok" if self.ok else "degraded"
+        s = f"{state} ({time.time() - self.since:.0f}s) | قطعی‌ها: {self.outages}"
+        return s if self.ok else f"{s} | {self.last_error}"
+
+health = DBHealth()
+
+class WriteJournal:
+    """ژورنال فقط-افزودنی (JSONL) برای نوشتن‌های غیرحیاتی؛ پس از برگشت دیتابیس به ترتیب اعمال می‌شود.
+
+    هر پردازه فایل خودش را با قفل flock نگه می‌دارد؛ فایل پردازه‌های مرده (قفل آزاد)
+    پیش از فایل خودی بازپخش می‌شوند. تا وقتی صفی باقی است نوشتن‌های تازه هم به ژورنال
+    می‌روند تا ترتیب به هم نخورد.
+    """
+
+    def __init__(self, directory: str):
+        self.dir = directory
+        self.path = os.path.join(directory, f"journal-{os.getpid()}.jsonl")
+        self.fh = None
+        self.pending = 0
+        self.orphans = []
+        self.stats = Counter()
+        self.lock = asyncio.Lock()
+
+    @property
+    def backlog(self) -> bool:
+        return bool(self.pending or self.orphans)
+
+    def _open(self):
+        os.makedirs(self.dir, exist_ok=True)
+        self.fh = open(self.path, "ab+")
+        fcntl.flock(self.fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.fh.seek(0)
+        self.pending = sum(1 for _ in self.fh)  # فایل هم‌نام از پردازه‌ی قبلی با همین pid
+
+    @staticmethod
+    def _is_orphan(path: str) -> bool:
+        try:
+            with open(path, "rb") as fh:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True  # قفل با بستن فایل آزاد می‌شود
+        except (BlockingIOError, FileNotFoundError):
+            return False
+
+    def scan(self):
+        """فایل‌های پردازه‌های مرده را پیدا می‌کند (هنگام راه‌اندازی و در هر کاوش).
+
+        فایل هم‌نامِ خودی هم همین‌جا باز و شمرده می‌شود: در کانتینر pid (معمولاً ۱) پس از هر
+        راه‌اندازی دوباره تکرار می‌شود و نباید تا اولین append منتظر بازپخش بماند.
+        """
+        try:
+            names = sorted(os.listdir(self.dir))
+        except FileNotFoundError:
+            names = []
+        paths = [os.path.join(self.dir, n) for n in names if n.startswith("journal-") and n.endswith(".jsonl")]
+        self.orphans = [p for p in paths if p != self.path and self._is_orphan(p)]
+        if self.fh is None and self.path in paths:
+            self._open()
+
+    def append(self, op: str, bot: int, args, t: float):
+        if self.fh is None:
+            self._open()
+        self.fh.write(json_dumps_bytes({"op": op, "b": bot, "a": list(args), "t": t}) + b"\n")
+        self.fh.flush()
+        self.pending += 1
+        self.stats["appended"] += 1
+
+    async def _apply(self, con, line: bytes):
+        try:
+            entry = json_loads(line)
+            fn = JOURNAL_OPS[entry["op"]]
+        except (ValueError, KeyError, TypeError):
+            self.stats["dropped"] += 1  # خط ناقص (کرش وسط نوشتن) یا عمل ناشناخته
+            return
+        try:
+            await fn(con, entry.get("b", 0), *entry["a"], entry["t"])
+            self.stats["replayed"] += 1
+        except Exception as e:
+            if is_db_outage(e):
+                raise
+            log.warning("dropping journal entry %s: %r", entry["op"], e)
+            self.stats["dropped"] += 1
+
+    def _drop_head(self, path: str, done: int, own: bool):
+        # بدون await: هیچ append دیگری بین خواندن و جایگزینی فایل اجرا نمی‌شود
+        with open(path, "rb") as fh:
+            rest = fh.readlines()[done:]
+        if own and self.fh is not None:
+            self.fh.close()
+            self.fh = None
+        if rest:
+            with open(path + ".tmp", "wb") as fh:
+                fh.writelines(rest)
+            os.replace(path + ".tmp", path)
+        else:
+            os.remove(path)
+        if own:
+            self.pending = len(rest)
+            if rest:
+                self._open()
+
+    async def _replay_file(self, path: str, own: bool) -> bool:
+        with open(path, "rb") as fh:
+            lines = fh.readlines()
+        done = 0
+        try:
+            async with pool.acquire() as con:
+                for line in lines:
+                    await self._apply(con, line)
+                    done += 1
+        except Exception as e:
+            if not is_db_outage(e):
+                raise
+            health.failure(e)
+        finally:
+            self._drop_head(path, done, own)
+        return done == len(lines)
+
+    async def replay(self) -> int:
+        async with self.lock:
+            before = self.stats["replayed"]
+            for path in list(self.orphans):
+                try:
+                    lock_fh = open(path, "rb")
+                except FileNotFoundError:
+                    self.orphans.remove(path)  # پردازه‌ی دیگری بازپخشش کرده
+                    continue
+                with lock_fh:
+                    try:
+                        fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    if not await self._replay_file(path, own=False):
+                        return self.stats["replayed"] - before
+                self.orphans.remove(path)
+            if self.pending:
+                await self._replay_file(self.path, own=True)
+            replayed = self.stats["replayed"] - before
+        if replayed:
+            log.warning("replayed %d journaled writes", replayed)
+            # وضعیت دسترسی کاربران/گروه‌ها ممکن است عوض شده باشد
+            await _reachability_changed()
+        return replayed
+
+    def summary(self) -> str:
+        return f"در صف: {self.pending} (+{len(self.orphans)} فایل یتیم) | {dict(self.stats) or '—'}"
+
+journal = WriteJournal(DB_JOURNAL_DIR)
+
+async def write_soft(op: str, *args):
+    """نوشتن غیرحیاتی: مستقیم در دیتابیس، یا هنگام قطعی/وجود صف در ژورنال محلی.
+
+    خروجی عمل را برمی‌گرداند؛ اگر به ژورنال رفته باشد None.
+    """
+    bot = tenant().key
+    if health.ok and not journal.backlog:
+        try:
+            async with pool.acquire() as con:
+                return await JOURNAL_OPS[op](con, bot, *args, None)
+        except Exception as e:
+            if not is_db_outage(e):
+                raise
+            health.failure(e)
+    journal.append(op, bot, args, time.time())
+    return None
+
+async def db_health_probe():
+    journal.scan()
+    while True:
+        await asyncio.sleep(DB_PROBE_SEC)
+        if health.ok and not journal.backlog:
+            continue
+        try:
+            async with pool.acquire() as con:
+                await con.fetchval("SELECT 1;")
+        except Exception as e:
+            health.failure(e)
+            continue
+        health.recovered()
+        try:
+            journal.scan()
+            await journal.replay()
+        except Exception:
+            log.exception("journal replay failed")
+
+# عمل‌های قابل ژورنال: (con, bot, *args, ts)؛ bot کلید ربات (tenant) و ts زمان ثبت در ژورنال
+# یا None برای نوشتن مستقیم. در بازپخش، ردیفی که پس از ts به‌روز شده بازنویسی نمی‌شود.
+async def _write_user(con, bot: int, user_id: int, username, first_name, private: bool, ts=None) -> bool:
+    row = await con.fetchrow(
+        """WITH old AS (SELECT username, first_name FROM users WHERE user_id=$2),
+           reach AS (SELECT reachable FROM bot_users WHERE bot_id=$1 AND user_id=$2),
+           up AS (
+             INSERT INTO users (user_id, username, first_name, last_seen)
+             VALUES ($2,$3,$4,COALESCE(to_timestamp($6), NOW()))
+             ON CONFLICT (user_id) DO UPDATE SET
+               username=EXCLUDED.username, first_name=EXCLUDED.first_name, last_seen=EXCLUDED.last_seen
+             WHERE $6 IS NULL OR users.last_seen IS NULL OR users.last_seen <= EXCLUDED.last_seen),
+           bu AS (
+             INSERT INTO bot_users (bot_id, user_id) VALUES ($1,$2)
+             ON CONFLICT (bot_id, user_id) DO UPDATE SET reachable=TRUE, unreachable_at=NULL
+             WHERE $5 AND NOT bot_users.reachable
+               AND ($6 IS NULL OR bot_users.unreachable_at <= to_timestamp($6)))
+           SELECT (SELECT NOT r.reachable AND $5 FROM reach r) AS revived,
+                  -- فقط وقتی نام یا یوزرنیم عوض شده به بقیه‌ی پردازه‌ها اطلاع داده می‌شود (در همین دستور)
+                  (SELECT pg_notify('""" + INVALIDATION_CHANNEL + """', 'users:' || $2::text) FROM old o
+                   WHERE o.username IS DISTINCT FROM $3 OR o.first_name IS DISTINCT FROM $4) AS notified;""",
+        bot, user_id, username, first_name, private, ts
+    )
+    return bool(row and row["revived"])
+
+# $5=NULL (پیام عادی گروه): فقط عنوان/last_seen؛ وضعیت فعال دست نمی‌خورد و ردیف تازه غیرفعال درج می‌شود
+UPSERT_CHAT_SQL = """WITH old AS (SELECT title, is_active FROM chats WHERE bot_id=$1 AND chat_id=$2),
+               up AS (
+                 INSERT INTO chats (bot_id, chat_id, title, type, is_active, last_seen)
+                 VALUES ($1,$2,$3,$4,COALESCE($5::boolean, FALSE),COALESCE(to_timestamp($6), NOW()))
+                 ON CONFLICT (bot_id, chat_id) DO UPDATE SET
+                   title=EXCLUDED.title, type=EXCLUDED.type, is_active=COALESCE($5, chats.is_active),
+                   last_seen=EXCLUDED.last_seen,
+                   reachable=(chats.reachable OR COALESCE($5, FALSE)),
+                   unreachable_at=CASE WHEN $5 THEN NULL ELSE chats.unreachable_at END
+                 WHERE $6 IS NULL OR chats.last_seen IS NULL OR chats.last_seen <= EXCLUDED.last_seen)
+               SELECT pg_notify('""" + INVALIDATION_CHANNEL + """', 'chats:' || $2::text) FROM old
+               WHERE old.title IS DISTINCT FROM $3 OR old.is_active IS DISTINCT FROM COALESCE($5, old.is_active);"""
+
+async def _write_chat(con, bot: int, chat_id: int, title, chat_type: str, active: bool | None, ts=None):
+    await con.execute(UPSERT_CHAT_SQL, bot, chat_id, title, chat_type, active, ts)
+
+async def _write_contact(con, bot: int, owner_id: int, key: str, peer_id, peer_username, peer_name, ts=None):
+    await con.execute(
+        """INSERT INTO whisper_contacts(owner_id, peer_key, peer_id, peer_username, peer_name, last_used)
+           VALUES ($1,$2,$3,$4,$5,COALESCE(to_timestamp($6), NOW()))
+           ON CONFLICT (owner_id, peer_key) DO UPDATE SET
+             peer_id=COALESCE(EXCLUDED.peer_id, whisper_contacts.peer_id),
+             peer_username=COALESCE(EXCLUDED.peer_username, whisper_contacts.peer_username),
+             peer_name=COALESCE(EXCLUDED.peer_name, whisper_contacts.peer_name),
+             last_used=GREATEST(EXCLUDED.last_used, whisper_contacts.last_used);""",
+        owner_id, key, peer_id, peer_username, peer_name, ts
+    )
+
+async def _write_read(con, bot: int, whisper_id: int, ts=None):
+    await con.execute("UPDATE whispers SET status='read' WHERE id=$1 AND status<>'read';", whisper_id)
+
+async def _write_unreachable(con, bot: int, users_: list, chats_: list, ts=None):
+    if users_:
+        await con.execute(
+            """INSERT INTO bot_users (bot_id, user_id, reachable, unreachable_at)
+               SELECT $1, u, FALSE, COALESCE(to_timestamp($3), NOW()) FROM unnest($2::bigint[]) AS u
+               ON CONFLICT (bot_id, user_id) DO UPDATE SET reachable=FALSE, unreachable_at=EXCLUDED.unreachable_at
+               WHERE bot_users.reachable;""", bot, users_, ts
+        )
+    if chats_:
         await con.execute(
-            """INSERT INTO users (user_id, username, first_name, last_seen)
-               VALUES ($1,$2,$3,NOW())
-               ON CONFLICT (user_id) DO UPDATE SET
-                 username=EXCLUDED.username, first_name=EXCLUDED.first_name, last_seen=NOW();""",
-            u.id, u.username, u.first_name or u.full_name
+            """UPDATE chats SET reachable=FALSE, unreachable_at=COALESCE(to_timestamp($3), NOW())
+               WHERE bot_id=$1 AND chat_id = ANY($2::bigint[]) AND reachable;""", bot, chats_, ts
         )
 
-async def upsert_chat(c, active: bool = True):
+JOURNAL_OPS = {
+    "user": _write_user,
+    "chat": _write_chat,
+    "contact": _write_contact,
+    "read": _write_read,
+    "unreachable": _write_unreachable,
+}
+
+async def upsert_user(u, private: bool = False):
+    """private=True یعنی کاربر در خصوصی با ربات تعامل کرده و دوباره قابل دسترسی است."""
+    first_name = u.first_name or u.full_name
+    name_cache.set(u.id, (first_name or "", u.username or ""))
+    if await write_soft("user", u.id, u.username, first_name, private):
+        await _reachability_changed()
+
+async def upsert_chat(c, active: bool | None = True):
+    """active=None: فقط ثبت عنوان و last_seen (پیام‌های گروه)؛ فعال شدن گروه فقط از admit یا mark_chat_active."""
+    title = getattr(c, "title", None)
+    await write_soft("chat", c.id, title, c.type, active)
+    if title:
+        title_cache.set(c.id, title)
+    if active is False and c.type in (ChatType.GROUP, ChatType.SUPERGROUP):
+        tenant().capacity.note(c.id, False)
+
+async def mark_chat_active(chat_id: int, active: bool):
+    t = tenant()
     async with pool.acquire() as con:
         await con.execute(
-            """INSERT INTO chats (chat_id, title, type, is_active, last_seen)
-               VALUES ($1,$2,$3,$4,NOW())
-               ON CONFLICT (chat_id) DO UPDATE SET
-                 title=EXCLUDED.title, type=EXCLUDED.type, is_active=$4, last_seen=NOW();""",
-            c.id, getattr(c, "title", None), c.type, active
+            """WITH old AS (SELECT is_active FROM chats WHERE bot_id=$4 AND chat_id=$2),
+               up AS (UPDATE chats SET is_active=$1, last_seen=NOW() WHERE bot_id=$4 AND chat_id=$2)
+               SELECT pg_notify($3, 'chats:' || $2::text) FROM old WHERE old.is_active IS DISTINCT FROM $1;""",
+            active, chat_id, INVALIDATION_CHANNEL, t.key
         )
+    t.capacity.note(chat_id, active)
 
-async def mark_chat_active(chat_id: int, active: bool):
+async def publish_invalidation(kind: str, key):
+    try:
+        async with pool.acquire() as con:
+            await con.execute("SELECT pg_notify($1, $2);", INVALIDATION_CHANNEL, f"{kind}:{key}")
+    except Exception as e:
+        # پیام از دست رفته مهم نیست: InvalidationBus پس از وصل دوباره همه‌ی کش‌ها را خالی می‌کند
+        if not is_db_outage(e):
+            raise
+        health.failure(e)
+
+# ---------- مقصدهای غیرقابل دسترس (بلاک/حذف ربات) ----------
+def is_unreachable_error(exc: Exception) -> bool:
+    if isinstance(exc, Forbidden):
+        return True
+    return isinstance(exc, BadRequest) and "chat not found" in str(exc).lower()
+
+async def _reachability_changed():
+    # فهرست گیرنده‌های گزارش به وضعیت دسترسی وابسته است
+    watchers_cache.clear()
+    await publish_invalidation("watchers", "*")
+
+async def mark_unreachable(ids):
+    users_ = [i for i in ids if i > 0]
+    chats_ = [i for i in ids if i < 0]
+    if not users_ and not chats_:
+        return
+    await write_soft("unreachable", users_, chats_)
+    await _reachability_changed()
+
+# ---------- ظرفیت نصب (شمارنده‌ی درون‌حافظه) ----------
+CAPACITY_RECONCILE_SEC = int(os.environ.get("CAPACITY_RECONCILE_SEC", "600"))
+
+class GroupCapacity:
+    """مجموعه‌ی گروه‌های فعال در حافظه؛ تصمیم پذیرش زیر قفل گرفته می‌شود.
+
+    شمارش کامل فقط هنگام راه‌اندازی و در هم‌سان‌سازی دوره‌ای اجرا می‌شود؛
+    هر جوین فقط یک دستور upsert هزینه دارد.
+    """
+
+    def __init__(self, limit: int, bot: int = 0):
+        self.limit = limit
+        self.bot = bot
+        self.active: set = set()
+        self.changes = None  # در حین load: chat_id -> active؛ روی عکس دیتابیس دوباره اعمال می‌شود
+        self.lock = asyncio.Lock()
+
+    @property
+    def count(self) -> int:
+        return len(self.active)
+
+    def note(self, chat_id: int, active: bool):
+        if self.changes is not None:
+            self.changes[chat_id] = active
+        if active:
+            self.active.add(chat_id)
+        else:
+            self.active.discard(chat_id)
+
+    async def load(self):
+        # تغییرهایی که هم‌زمان با کوئری ثبت می‌شوند (مثلاً admit چند پردازه‌ای یا خروج) از دست نمی‌روند
+        self.changes = {}
+        try:
+            async with pool.acquire() as con:
+                rows = await con.fetch(
+                    "SELECT chat_id FROM chats WHERE bot_id=$1 AND type IN ('group','supergroup') AND is_active=TRUE;",
+                    self.bot
+                )
+        finally:
+            changes, self.changes = self.changes, None
+        active = {int(r["chat_id"]) for r in rows}
+        for chat_id, on in changes.items():
+            if on:
+                active.add(chat_id)
+            else:
+                active.discard(chat_id)
+        self.active = active
+
+    async def admit(self, chat) -> tuple:
+        """(پذیرفته؟, تعداد فعال) — بررسی و ثبت اتمیک است؛ جوین‌های هم‌زمان از سقف رد نمی‌شوند."""
+        async with self.lock:
+            if WORKERS > 1:
+                return await self._admit_shared(chat)
+            if chat.id not in self.active and len(self.active) >= self.limit:
+                return False, len(self.active)
+            await upsert_chat(chat, active=True)
+            self.note(chat.id, True)
+            return True, len(self.active)
+
+    async def _admit_shared(self, chat) -> tuple:
+        # چند پردازه: شمارش و درج زیر قفل مشورتی Postgres در یک تراکنش
+        async with pool.acquire() as con:
+            async with con.transaction():
+                await con.execute("SELECT pg_advisory_xact_lock($1);", CAPACITY_LOCK_KEY ^ self.bot)
+                n = await con.fetchval(
+                    """SELECT COUNT(*) FROM chats
+                       WHERE bot_id=$1 AND type IN ('group','supergroup') AND is_active=TRUE AND chat_id<>$2;""",
+                    self.bot, chat.id
+                )
+                if n >= self.limit:
+                    return False, n
+                await con.execute(UPSERT_CHAT_SQL, self.bot, chat.id, getattr(chat, "title", None), chat.type, True, None)
+        self.note(chat.id, True)
+        return True, n + 1
+
+    async def reconcile(self):
+        async with self.lock:
+            await self.load()
+
+async def capacity_reconciler(capacity: GroupCapacity):
+    while True:
+        await asyncio.sleep(CAPACITY_RECONCILE_SEC)
+        try:
+            await capacity.reconcile()
+        except Exception:
+            pass
+
+# ---------- پندینگ‌ها (حافظه + write-through به جدول pending) ----------
+class PendingWhisper:
+    __slots__ = ("sender_id", "group_id", "receiver_id", "created_at", "expires_at",
+                 "guide_message_id", "reply_to_msg_id", "state")
+
+    def __init__(self, sender_id: int, group_id: int, receiver_id: int, created_at: datetime, expires_at: datetime,
+                 guide_message_id: int | None = None, reply_to_msg_id: int | None = None, state: str = "created"):
+        self.sender_id = sender_id
+        self.group_id = group_id
+        self.receiver_id = receiver_id
+        self.created_at = created_at
+        self.expires_at = expires_at
+        self.guide_message_id = guide_message_id
+        self.reply_to_msg_id = reply_to_msg_id
+        self.state = state
+
+    @property
+    def expired(self) -> bool:
+        return self.expires_at <= datetime.now(timezone.utc)
+
+class PendingStore:
+    """پندینگ هر فرستنده در حافظه؛ هر گذار اول در جدول pending نوشته می‌شود (write-through).
+
+    created → guide (راهنما در گروه گذاشته شد) → delivered (متن رسید) یا expired.
+    خواندن‌ها (start و private_text) به دیتابیس نمی‌روند. با WORKERS>1 همه‌ی آپدیت‌های یک
+    کاربر به یک پردازه می‌رسند، پس حافظه‌ی همان پردازه مرجع پندینگ اوست.
+    """
+
+    def __init__(self, ttl: int, bot: int = 0):
+        self.ttl = ttl
+        self.bot = bot
+        self.items: dict = {}  # sender_id -> PendingWhisper
+        self.stats = Counter()
+
+    def __len__(self):
+        return len(self.items)
+
+    async def load(self):
+        async with pool.acquire() as con:
+            # ردیف‌های قدیمی «بدون انقضا» (FAR_FUTURE) به مهلت واقعی محدود می‌شوند
+            await con.execute(
+                """UPDATE pending SET expires_at = created_at + make_interval(secs => $1)
+                   WHERE bot_id=$2 AND expires_at > created_at + make_interval(secs => $1);""",
+                float(self.ttl), self.bot
+            )
+            rows = await con.fetch("SELECT * FROM pending WHERE bot_id=$1 AND expires_at > NOW();", self.bot)
+        self.items = {
+            int(r["sender_id"]): PendingWhisper(
+                int(r["sender_id"]), int(r["group_id"]), int(r["receiver_id"]), r["created_at"], r["expires_at"],
+                r["guide_message_id"], r["reply_to_msg_id"], r["state"],
+            )
+            for r in rows
+        }
+
+    def get(self, sender_id: int) -> PendingWhisper | None:
+        p = self.items.get(sender_id)
+        if p is not None and p.expired:
+            self._expire(p)
+            return None
+        return p
+
+    async def create(self, sender_id: int, group_id: int, receiver_id: int, reply_to_msg_id: int | None) -> PendingWhisper:
+        """created؛ پندینگ قبلی همین فرستنده جایگزین می‌شود."""
+        now = datetime.now(timezone.utc)
+        p = PendingWhisper(sender_id, group_id, receiver_id, now, now + timedelta(seconds=self.ttl),
+                           reply_to_msg_id=reply_to_msg_id)
+        async with pool.acquire() as con:
+            await con.execute(
+                """INSERT INTO pending (bot_id, sender_id, group_id, receiver_id, created_at, expires_at, guide_message_id,
+                                      reply_to_msg_id, state)
+                   VALUES ($7,$1,$2,$3,$4,$5,NULL,$6,'created')
+                   ON CONFLICT (bot_id, sender_id) DO UPDATE SET
+                     group_id=EXCLUDED.group_id, receiver_id=EXCLUDED.receiver_id, created_at=EXCLUDED.created_at,
+                     expires_at=EXCLUDED.expires_at, guide_message_id=NULL, reply_to_msg_id=EXCLUDED.reply_to_msg_id,
+                     state='created';""",
+                sender_id, group_id, receiver_id, p.created_at, p.expires_at, reply_to_msg_id, self.bot
+            )
+        if sender_id in self.items:
+            self.stats["replaced"] += 1
+        self.items[sender_id] = p
+        self.stats["created"] += 1
+        return p
+
+    async def guide_posted(self, sender_id: int, guide_message_id: int):
+        """created → guide"""
+        p = self.items.get(sender_id)
+        if p is None or p.state != "created":
+            return
+        # حافظه اول: اگر دیتابیس در دسترس نباشد، تحویل متن باز هم راهنما را پاک می‌کند
+        p.guide_message_id = guide_message_id
+        p.state = "guide"
+        self.stats["guide"] += 1
+        async with pool.acquire() as con:
+            await con.execute(
+                "UPDATE pending SET guide_message_id=$1, state='guide' WHERE bot_id=$4 AND sender_id=$2 AND created_at=$3;",
+                guide_message_id, sender_id, p.created_at, self.bot
+            )
+
+    def claim(self, p: PendingWhisper) -> bool:
+        """برای تحویل از حافظه برداشته می‌شود (بدون await، پس دو پیام هم‌زمان یکی را نمی‌گیرند).
+
+        حذف ردیف جدول در همان تراکنشِ ثبت نجوا انجام می‌شود؛ اگر ثبت نشد `restore` صدا زده شود.
+        """
+        if self.items.get(p.sender_id) is not p:
+            return False  # مصرف یا جایگزین شده
+        del self.items[p.sender_id]
+        return True
+
+    def delivered(self, p: PendingWhisper):
+        p.state = "delivered"
+        self.stats["delivered"] += 1
+
+    def restore(self, p: PendingWhisper):
+        # پندینگ تازه‌تری در این فاصله ساخته نشده باشد
+        self.items.setdefault(p.sender_id, p)
+
+    def _expire(self, p: PendingWhisper):
+        if self.items.get(p.sender_id) is p:
+            del self.items[p.sender_id]
+        p.state = "expired"
+        self.stats["expired"] += 1
+
+    async def sweep(self):
+        for p in [p for p in self.items.values() if p.expired]:
+            self._expire(p)
+        async with pool.acquire() as con:
+            await con.execute("DELETE FROM pending WHERE bot_id=$1 AND expires_at <= NOW();", self.bot)
+
+    def summary(self) -> str:
+        return f"{len(self.items)} فعال | {dict(self.stats) or '—'}"
+
+async def pending_sweeper(pending: PendingStore):
+    while True:
+        await asyncio.sleep(PENDING_SWEEP_SEC)
+        try:
+            await pending.sweep()
+        except Exception:
+            pass
+
+# ---------- چند ربات در یک پردازه (tenant) ----------
+class Tenant:
+    """یک توکن ربات و داده‌های مخصوص آن.
+
+    کلید (`key`) در ستون bot_id جدول‌ها ذخیره می‌شود: ربات اصلی کلید ۰ دارد تا ردیف‌های
+    پیش از چندرباتی مال او بمانند، بقیه شناسه‌ی عددی ربات (بخش اول توکن). گروه‌ها و ظرفیت،
+    پندینگ‌ها، ناظران گزارش، پرچم‌های ادمین، کارهای زمان‌بندی‌شده، نجواهای ریپلای و بلاک‌بودن
+    (bot_users) جدا هستند؛ استخر دیتابیس، users، مخاطبین، اینلاین‌ها و کش‌های نام/عنوان/عضویت مشترک‌اند.
+    """
+
+    __slots__ = ("key", "token", "max_groups", "support", "username", "app", "capacity", "pending", "pacers",
+                 "templates")
+
+    def __init__(self, key: int, token: str):
+        bot_id = token.partition(":")[0]
+        self.key = key
+        self.token = token
+        self.max_groups = int(os.environ.get(f"MAX_GROUPS_{bot_id}", MAX_GROUPS))
+        self.support = os.environ.get(f"SUPPORT_CONTACT_{bot_id}", SUPPORT_CONTACT)
+        self.username = ""
+        self.app = None
+        self.capacity = GroupCapacity(self.max_groups, key)
+        self.pending = PendingStore(PENDING_TTL_SEC, key)
+        self.pacers = {name: LanePacer(rate) for name, (rate, _) in LANES.items()}
+        self.templates = None  # Templates؛ در post_init پس از get_me
+
+def _load_tenants() -> dict:
+    tokens = list(dict.fromkeys(t for t in [BOT_TOKEN, *BOT_TOKENS] if t)) or [BOT_TOKEN]
+    keys = [0] + [int(tok.partition(":")[0]) for tok in tokens[1:]]
+    return {k: Tenant(k, tok) for k, tok in zip(keys, tokens)}
+
+tenants = _load_tenants()  # کلید -> Tenant؛ اولی ربات اصلی
+_tenant = contextvars.ContextVar("tenant", default=tenants[0])
+
+def tenant() -> Tenant:
+    """ربات آپدیت جاری (NajvaApplication.process_update آن را تنظیم می‌کند)."""
+    return _tenant.get()
+
+# ---------- ابطال کش بین پردازه‌ها (LISTEN/NOTIFY) ----------
+class InvalidationBus:
+    """یک اتصال اختصاصی asyncpg که به کانال ابطال گوش می‌دهد و کش‌های محلی را پاک می‌کند.
+
+    بعد از هر قطع و وصل، چون ممکن است پیام‌هایی از دست رفته باشد، همه‌ی کش‌ها خالی می‌شوند.
+    """
+
+    PING_SEC = 30
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.connected = False
+
+    def _on_notify(self, con, pid, channel, payload: str):
+        kind, _, key = payload.partition(":")
+        cache = CACHES.get(kind)
+        if cache is None:
+            return
+        if key == "*":
+            cache.clear()
+            return
+        try:
+            cache.pop(int(key))
+        except ValueError:
+            pass
+
+    def resync(self):
+        for cache in CACHES.values():
+            cache.clear()
+        for t in tenants.values():
+            spawn_background(t.capacity.reconcile())
+
+    async def run(self):
+        backoff = 1
+        while True:
+            con = None
+            try:
+                con = await asyncpg.connect(self.dsn)
+                await con.add_listener(INVALIDATION_CHANNEL, self._on_notify)
+                self.connected = True
+                self.resync()
+                backoff = 1
+                while True:
+                    await asyncio.sleep(self.PING_SEC)
+                    await con.execute("SELECT 1;")
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                pass
+            finally:
+                self.connected = False
+                if con is not None:
+                    try:
+                        await con.close(timeout=5)
+                    except Exception:
+                        con.terminate()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+# ---------- وضعیت مشترک ادمین (مثلاً انتظار بنر همگانی) ----------
+async def set_flag(user_id: int, flag: str):
     async with pool.acquire() as con:
-        await con.execute("UPDATE chats SET is_active=$1, last_seen=NOW() WHERE chat_id=$2;", active, chat_id)
+        await con.execute("INSERT INTO admin_state (bot_id, user_id, flag) VALUES ($3,$1,$2) ON CONFLICT DO NOTHING;",
+                          user_id, flag, tenant().key)
 
-async def get_active_group_count() -> int:
+async def pop_flag(user_id: int, flag: str) -> bool:
     async with pool.acquire() as con:
-        return await con.fetchval("SELECT COUNT(*) FROM chats WHERE type IN ('group','supergroup') AND is_active=TRUE;")
+        return bool(await con.fetchval("DELETE FROM admin_state WHERE bot_id=$3 AND user_id=$1 AND flag=$2 RETURNING 1;",
+                                       user_id, flag, tenant().key))
+
+async def _user_names(user_id: int):
+    """(first_name, username) از کش یا جدول users؛ None اگر کاربر ثبت نشده باشد."""
+    hit = name_cache.get(user_id)
+    if hit is not None:
+        return hit
+    try:
+        async with db("read").acquire() as con:
+            row = await con.fetchrow("SELECT first_name, username FROM users WHERE user_id=$1;", user_id)
+    except Exception as e:
+        if not is_db_outage(e):
+            raise
+        health.failure(e)
+        return name_cache.get(user_id, stale=True)
+    if not row:
+        return None
+    names = (row["first_name"] or "", row["username"] or "")
+    name_cache.set(user_id, names)
+    return names
 
 async def get_name_for(user_id: int, fallback: str = "کاربر") -> str:
-    async with pool.acquire() as con:
-        row = await con.fetchrow(
-            "SELECT COALESCE(NULLIF(first_name,''), NULLIF(username,'')) AS n FROM users WHERE user_id=$1;",
-            user_id
-        )
-    if row and row["n"]:
-        return str(row["n"])
+    names = await _user_names(user_id)
+    if names and (names[0] or names[1]):
+        return str(names[0] or names[1])
     try:
-        return sanitize((await app.bot.get_chat(user_id)).first_name)  # type: ignore
+        return sanitize((await tenant().app.bot.get_chat(user_id)).first_name)  # type: ignore
     except Exception:
         return sanitize(fallback)
 
 async def get_username_for(user_id: int) -> str:
-    async with pool.acquire() as con:
-        row = await con.fetchrow("SELECT username FROM users WHERE user_id=$1;", user_id)
-    if row and row["username"]:
-        return str(row["username"]).lstrip("@")
+    names = await _user_names(user_id)
+    if names and names[1]:
+        return str(names[1]).lstrip("@")
     try:
-        ch = await app.bot.get_chat(user_id)  # type: ignore
+        ch = await tenant().app.bot.get_chat(user_id)  # type: ignore
         if getattr(ch, "username", None):
             return ch.username.lstrip("@")
     except Exception:
         pass
     return ""
 
+async def get_group_title(bot, chat_id: int, fallback: str = "گروه") -> str:
+    title = title_cache.get(chat_id)
+    if title is None:
+        try:
+            async with db("read").acquire() as con:
+                # عنوان بین ربات‌ها مشترک است؛ ردیف هر رباتی که گروه را دیده کافی است
+                title = await con.fetchval(
+                    "SELECT title FROM chats WHERE chat_id=$1 ORDER BY bot_id=$2 DESC LIMIT 1;",
+                    chat_id, tenant().key
+                )
+        except Exception as e:
+            if not is_db_outage(e):
+                raise
+            health.failure(e)
+            title = title_cache.get(chat_id, stale=True)
+        if not title:
+            try:
+                title = getattr(await bot.get_chat(chat_id), "title", None)
+            except Exception:
+                title = None
+        if not title:
+            return fallback
+        title_cache.set(chat_id, title)
+    return group_link_title(title)
+
+async def get_watchers(group_id: int) -> tuple:
+    key = (tenant().key, group_id)
+    hit = watchers_cache.get(key)
+    if hit is not None:
+        return hit
+    try:
+        # از primary: پس از باز/بسته کردن، NOTIFY کش همه‌ی پردازه‌ها را فوراً خالی می‌کند و خواندن از
+        # replica عقب‌مانده فهرست قدیمی را تا WATCHERS_CACHE_TTL دوباره کش می‌کرد (گزارش به ناظر حذف‌شده)
+        async with pool.acquire() as con:
+            rows = await con.fetch(
+                """SELECT w.watcher_id FROM watchers w
+                   LEFT JOIN bot_users b ON b.bot_id=w.bot_id AND b.user_id=w.watcher_id
+                   WHERE w.bot_id=$1 AND w.group_id=$2 AND COALESCE(b.reachable, TRUE);""",
+                key[0], group_id
+            )
+    except Exception as e:
+        if not is_db_outage(e):
+            raise
+        health.failure(e)
+        return watchers_cache.get(key, stale=True, default=())
+    ws = tuple(int(r["watcher_id"]) for r in rows)
+    watchers_cache.set(key, ws)
+    return ws
+
 async def try_resolve_user_id_by_username(context: ContextTypes.DEFAULT_TYPE, username: str):
     if not username:
         return None
@@ -249,20 +2136,11 @@ async def upsert_contact(owner_id: int, peer_id: int | None, peer_username: str
     if not peer_id and not peer_username:
         return
     key = f"@{peer_username.lower()}" if peer_username else f"id:{peer_id}"
-    async with pool.acquire() as con:
-        await con.execute(
-            """INSERT INTO whisper_contacts(owner_id, peer_key, peer_id, peer_username, peer_name, last_used)
-               VALUES ($1,$2,$3,$4,$5,NOW())
-               ON CONFLICT (owner_id, peer_key) DO UPDATE SET
-                 peer_id=COALESCE(EXCLUDED.peer_id, whisper_contacts.peer_id),
-                 peer_username=COALESCE(EXCLUDED.peer_username, whisper_contacts.peer_username),
-                 peer_name=COALESCE(EXCLUDED.peer_name, whisper_contacts.peer_name),
-                 last_used=NOW();""",
-            owner_id, key, peer_id, (peer_username or None), (peer_name or None)
-        )
+    note_write(("contacts", owner_id))
+    await write_soft("contact", owner_id, key, peer_id, (peer_username or None), (peer_name or None))
 
 async def get_recent_contacts(owner_id: int, limit: int = 8):
-    async with pool.acquire() as con:
+    async with db("read", ("contacts", owner_id)).acquire() as con:
         rows = await con.fetch(
             "SELECT peer_id, peer_username, peer_name FROM whisper_contacts WHERE owner_id=$1 ORDER BY last_used DESC LIMIT $2;",
             owner_id, limit
@@ -270,35 +2148,150 @@ async def get_recent_contacts(owner_id: int, limit: int = 8):
     return rows
 
 # ---------- عضویت ----------
-async def is_member_required_channel(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
+MEMBER_STATUSES = ("member", "administrator", "creator")
+
+async def check_membership(bot, user_id: int) -> bool:
+    """عضویت در همه‌ی کانال‌های اجباری از API؛ نتیجه در member_cache می‌نشیند. خطای API بالا می‌رود."""
+    ok = True
+    for ch in MANDATORY_CHANNELS:
+        m = await bot.get_chat_member(f"@{ch}", user_id)
+        if getattr(m, "status", "") not in MEMBER_STATUSES:
+            ok = False
+            break
+    member_cache.set(user_id, ok, None if ok else MEMBER_NEG_CACHE_TTL)
+    return ok
+
+async def is_member_required_channel(context: ContextTypes.DEFAULT_TYPE, user_id: int, fresh: bool = False) -> bool:
+    member_refresher.touch(user_id)
+    if not fresh:
+        hit = member_cache.get(user_id)
+        if hit is not None:
+            return hit
     try:
-        for ch in MANDATORY_CHANNELS:
-            m = await context.bot.get_chat_member(f"@{ch}", user_id)
-            if getattr(m, "status", "") not in ("member", "administrator", "creator"):
-                return False
-        return True
+        return await check_membership(context.bot, user_id)
     except Exception:
         return False
 
+class MembershipRefresher:
+    """عضویت مثبتِ فرستنده‌های اخیر را پیش از انقضای کش دوباره بررسی می‌کند.
+
+    هر بررسی در هندلرها کاربر را «فعال» علامت می‌زند (با رباتی که آپدیت را گرفته)؛ حلقه‌ی
+    پس‌زمینه هر MEMBER_REFRESH_SCAN_SEC ورودی‌هایی را که کمتر از `ahead` ثانیه عمر دارند با
+    حداکثر `concurrency` بررسی هم‌زمان و آهنگ `rate` در ثانیه در صف bulk تازه می‌کند. نتیجه‌ی
+    منفی تازه نمی‌شود: پیوستن دوباره را آپدیت chat_member کانال (on_channel_member) خبر می‌دهد.
+    """
+
+    def __init__(self, ahead: float, window: float, concurrency: int, rate: float, maxsize: int = 50000):
+        self.ahead = ahead
+        self.window = window
+        self.concurrency = concurrency
+        self.pacer = LanePacer(rate)
+        self.maxsize = maxsize
+        self.active: dict = {}  # user_id -> (last_seen, bot key)؛ ترتیب درج = ترتیب آخرین فعالیت
+        self.inflight: set = set()
+        self.sem = None
+        self.stats = Counter()
+
+    def touch(self, user_id: int):
+        self.active.pop(user_id, None)
+        if len(self.active) >= self.maxsize:
+            self.active.pop(next(iter(self.active)))
+        self.active[user_id] = (time.monotonic(), tenant().key)
+
+    def due(self) -> list:
+        now = time.monotonic()
+        while self.active:
+            uid, (seen, _) = next(iter(self.active.items()))
+            if now - seen <= self.window:
+                break
+            del self.active[uid]
+        out = []
+        for uid, (_, key) in self.active.items():
+            item = member_cache.data.get(uid)
+            if item is not None and item[1] and item[0] - now < self.ahead and uid not in self.inflight:
+                out.append((uid, key))
+        return out
+
+    def refresh(self, user_id: int, key: int):
+        """بررسی دوباره در پس‌زمینه (بدون تکرار برای کاربری که در جریان است)."""
+        if user_id in self.inflight or key not in tenants:
+            return
+        self.inflight.add(user_id)
+        spawn_background(self._refresh(user_id, key))
+
+    async def _refresh(self, user_id: int, key: int):
+        try:
+            async with self.sem:
+                await self.pacer.acquire()
+                before = member_cache.data.get(user_id, (0, None))[1]
+                with api_lane("bulk"):
+                    ok = await check_membership(tenants[key].app.bot, user_id)
+                self.stats["refreshed"] += 1
+                if before is not None and ok != before:
+                    self.stats["changed"] += 1
+        except Exception:
+            # ورودی قبلی سر جایش می‌ماند؛ پس از انقضا مسیر تعاملی خودش بررسی می‌کند
+            self.stats["failed"] += 1
+        finally:
+            self.inflight.discard(user_id)
+
+    async def run(self):
+        self.sem = asyncio.Semaphore(self.concurrency)
+        while True:
+            await asyncio.sleep(MEMBER_REFRESH_SCAN_SEC)
+            for uid, key in self.due():
+                self.refresh(uid, key)
+
+    def summary(self) -> str:
+        return f"فعال={len(self.active)} در جریان={len(self.inflight)} {dict(self.stats) or ''} | {self.pacer.summary()}"
+
+member_refresher = MembershipRefresher(MEMBER_REFRESH_AHEAD_SEC, MEMBER_ACTIVE_WINDOW_SEC,
+                                       MEMBER_REFRESH_CONCURRENCY, MEMBER_REFRESH_RATE)
+
+async def on_channel_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """پیوستن/ترک کانال اجباری (ربات باید ادمین کانال باشد) وضعیت کش را بی‌درنگ عوض می‌کند."""
+    cm = update.chat_member
+    if (cm.chat.username or "").lower() not in {ch.lower() for ch in MANDATORY_CHANNELS}:
+        return
+    user_id = cm.new_chat_member.user.id
+    member_refresher.stats["channel_updates"] += 1
+    if cm.new_chat_member.status not in MEMBER_STATUSES:
+        # ترک قطعی است و پیوستن دوباره خودش آپدیت می‌آورد؛ پس با TTL کامل
+        member_cache.set(user_id, False)
+    elif len(MANDATORY_CHANNELS) == 1:
+        member_cache.set(user_id, True)
+    else:
+        # عضویت در کانال‌های دیگر معلوم نیست: ورودی منفی حذف و در پس‌زمینه بررسی می‌شود
+        member_cache.pop(user_id)
+        member_refresher.refresh(user_id, tenant().key)
+
 def _channels_text():
     return "، ".join([f"@{ch}" for ch in MANDATORY_CHANNELS])
 
-def start_keyboard_pre():
-    rows = [[InlineKeyboardButton("عضو شدم ✅", callback_data="checksub")]]
+def channel_rows() -> list:
+    rows = []
     if len(MANDATORY_CHANNELS) >= 1:
         rows.append([InlineKeyboardButton("عضویت در کانال یک", url=f"https://t.me/{MANDATORY_CHANNELS[0]}")])
     if len(MANDATORY_CHANNELS) >= 2:
         rows.append([InlineKeyboardButton("عضویت در کانال دو", url=f"https://t.me/{MANDATORY_CHANNELS[1]}")])
-    rows.append([InlineKeyboardButton("افزودن ربات به گروه ➕", url="https://t.me/DareGushi_BOT?startgroup=true")])
+    return rows
+
+def start_keyboard_pre(bot: str):
+    rows = [[InlineKeyboardButton("عضو شدم ✅", callback_data="checksub")], *channel_rows()]
+    rows.append([InlineKeyboardButton("افزودن ربات به گروه ➕", url=f"https://t.me/{bot}?startgroup=true")])
     rows.append([InlineKeyboardButton("ارتباط با پشتیبان 👨🏻‍💻", url="https://t.me/SOULSOWNERBOT")])
     return InlineKeyboardMarkup(rows)
 
-def start_keyboard_post():
+def start_keyboard_post(bot: str):
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("افزودن ربات به گروه ➕", url="https://t.me/DareGushi_BOT?startgroup=true")],
+        [InlineKeyboardButton("افزودن ربات به گروه ➕", url=f"https://t.me/{bot}?startgroup=true")],
         [InlineKeyboardButton("ارتباط با پشتیبان 👨🏻‍💻", url="https://t.me/SOULSOWNERBOT")],
     ])
 
+def write_private_keyboard(bot: str, *extra_rows):
+    return InlineKeyboardMarkup([[InlineKeyboardButton("✍️ ارسال متن در خصوصی", url=f"https://t.me/{bot}?start=go")],
+                                 *extra_rows])
+
 START_TEXT = (
     "سلام! 👋\n\n"
     "برای استفاده ابتدا عضو کانال(های) زیر شوید:\n"
@@ -313,29 +2306,71 @@ INTRO_TEXT = (
     "حالت اینلاین هم فعال است: داخل چت بنویسید `@Bot متن @username` یا فقط `@Bot` تا لیست مخاطبین اخیر بیاید."
 )
 
+# ---------- قالب‌های ثابت (کیبوردها و متن‌ها) ----------
+class Templates:
+    """کیبوردها و متن‌های ثابت یک ربات؛ در post_init پس از get_me (وقتی یوزرنیم معلوم است) یک بار ساخته می‌شوند.
+
+    کیبوردهایی که بخشی از آن‌ها به آپدیت وابسته است (دکمه‌ی «عضو شدم» تریگر) فقط سطرهای
+    ثابتشان را از اینجا برمی‌دارند؛ دکمه‌ها هم منجمد و قابل استفاده‌ی دوباره‌اند.
+    """
+
+    __slots__ = ("start_pre", "start_post", "write_private", "channel_rows", "group_help", "group_help_text",
+                 "guide_text", "private_help_text", "inline_help", "inline_join_info")
+
+    def __init__(self, username: str):
+        bot = username or "DareGushi_BOT"
+        rows = tuple(tuple(r) for r in channel_rows())
+        self.start_pre = start_keyboard_pre(bot)
+        self.start_post = start_keyboard_post(bot)
+        self.write_private = write_private_keyboard(bot)
+        self.channel_rows = rows
+        self.group_help = write_private_keyboard(bot, *rows)
+        self.group_help_text = (
+            "راهنمای سریع:\n"
+            "• روی پیام شخصِ هدف «Reply» کرده و «نجوا / درگوشی / سکرت» بفرستید؛ سپس متن را در خصوصی ارسال کنید.\n"
+            f"• حالت اینلاین: @{bot} <متن> @username  یا فقط @{bot} برای نمایش مخاطبین اخیر."
+        )
+        self.guide_text = f"لطفاً متن نجوای خود را در خصوصی ربات ارسال کنید: @{bot}"
+        self.private_help_text = (
+            "راهنمای استفاده:\n"
+            "• روش ریپلای: روی پیام شخصِ هدف در گروه «Reply» کنید و کلمه «نجوا/درگوشی/سکرت» را بفرستید؛ سپس متن را اینجا بفرستید (فقط متن).\n"
+            "• روش اینلاین: در گروه تایپ کنید:\n"
+            f"@{username or 'BotUsername'} <متن نجوا> @username  یا فقط @{username or 'BotUsername'} برای مخاطبین اخیر.\n"
+            f"• برای ارسال، عضو کانال‌ها باشید: {_channels_text()}"
+        )
+        self.inline_help = InlineQueryResultArticle(
+            id="help",
+            title="راهنما",
+            description="متن بنویسید و هرجا @username را اضافه کنید (یا خالی بگذارید تا مخاطبین اخیر بیاید).",
+            input_message_content=InputTextMessageContent(INLINE_HELP(bot=username)),
+            thumbnail_url=avatar_url("help"),
+            thumbnail_width=64,
+            thumbnail_height=64,
+        )
+        self.inline_join_info = InlineQueryResultArticle(
+            id="join_info",
+            title="ℹ️ عضویت فقط برای ریپلای لازم است (اینلاین آزاد است)",
+            description=_channels_text(),
+            input_message_content=InputTextMessageContent(
+                f"راهنما: نجوای اینلاین آزاد است؛ برای ریپلای عضو شوید.\nکانال‌ها: {_channels_text()}"
+            )
+        )
+
 # ---------- /start ----------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != ChatType.PRIVATE:
         return
-    await upsert_user(update.effective_user)
+    await upsert_user(update.effective_user, private=True)
 
     ok = await is_member_required_channel(context, update.effective_user.id)
     if ok:
-        await update.message.reply_text(INTRO_TEXT, reply_markup=start_keyboard_post())
+        await update.message.reply_text(INTRO_TEXT, reply_markup=tenant().templates.start_post)
         # اگر پندینگ فعال دارد، پیام انتظار بفرست
-        async with pool.acquire() as con:
-            row = await con.fetchrow(
-                "SELECT group_id, receiver_id FROM pending WHERE sender_id=$1 AND expires_at>NOW();",
-                update.effective_user.id
-            )
-        if row:
-            group_id = int(row["group_id"])
-            receiver_id = int(row["receiver_id"])
-            try:
-                chatobj = await context.bot.get_chat(group_id)
-                gtitle = group_link_title(getattr(chatobj, "title", "گروه"))
-            except Exception:
-                gtitle = "گروه"
+        p = tenant().pending.get(update.effective_user.id)
+        if p:
+            group_id = p.group_id
+            receiver_id = p.receiver_id
+            gtitle = await get_group_title(context.bot, group_id)
             receiver_name = await get_name_for(receiver_id, "گیرنده")
             await update.message.reply_text(
                 f"⌛️ در انتظارِ متنِ نجوای شما…\n"
@@ -344,67 +2379,120 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode=ParseMode.HTML
             )
     else:
-        await update.message.reply_text(START_TEXT, reply_markup=start_keyboard_pre())
+        await update.message.reply_text(START_TEXT, reply_markup=tenant().templates.start_pre)
 
 async def on_checksub(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != ChatType.PRIVATE:
         return
     user = update.effective_user
-    ok = await is_member_required_channel(context, user.id)
+    ok = await is_member_required_channel(context, user.id, fresh=True)
     if ok:
         await update.callback_query.answer("عضویت تایید شد ✅", show_alert=False)
-        await update.callback_query.message.reply_text(INTRO_TEXT, reply_markup=start_keyboard_post())
+        await update.callback_query.message.reply_text(INTRO_TEXT, reply_markup=tenant().templates.start_post)
     else:
         await update.callback_query.answer("هنوز عضویت تکمیل نیست. لطفاً عضو شوید و دوباره امتحان کنید.", show_alert=True)
 
 # ---------- راهنمای متنی داخل گروه ----------
 async def group_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
-    text = (
-        "راهنمای سریع:\n"
-        "• روی پیام شخصِ هدف «Reply» کرده و «نجوا / درگوشی / سکرت» بفرستید؛ سپس متن را در خصوصی ارسال کنید.\n"
-        f"• حالت اینلاین: @{BOT_USERNAME or 'DareGushi_BOT'} <متن> @username  یا فقط @{BOT_USERNAME or 'DareGushi_BOT'} برای نمایش مخاطبین اخیر."
-    )
-    rows = [[InlineKeyboardButton("✍️ ارسال متن در خصوصی", url=f"https://t.me/{BOT_USERNAME or 'DareGushi_BOT'}?start=go")]]
-    if len(MANDATORY_CHANNELS) >= 1:
-        rows.append([InlineKeyboardButton("عضویت در کانال یک", url=f"https://t.me/{MANDATORY_CHANNELS[0]}")])
-    if len(MANDATORY_CHANNELS) >= 2:
-        rows.append([InlineKeyboardButton("عضویت در کانال دو", url=f"https://t.me/{MANDATORY_CHANNELS[1]}")])
-
+    tpl = tenant().templates
     sent = await update.effective_message.reply_text(
-        text,
-        reply_markup=InlineKeyboardMarkup(rows),
+        tpl.group_help_text,
+        reply_markup=tpl.group_help,
         disable_web_page_preview=True
     )
-    schedule_delete(context, chat.id, sent.message_id, GUIDE_DELETE_AFTER_SEC)
+    await schedule_delete(context, chat.id, sent.message_id, GUIDE_DELETE_AFTER_SEC)
 
 # ---------- Inline Mode ----------
-BOT_USERNAME: str = ""
 INLINE_HELP = "فرمت: «@{bot} متن نجوا @username»\nمثال: @{bot} سلام @ali123".format
 
 def _preview(s: str, n: int = 50) -> str:
     return s if len(s) <= n else (s[:n] + "…")
 
+class InlineDebouncer:
+    """تلگرام تقریباً با هر کلید یک inline query می‌فرستد؛ فقط تازه‌ترینِ هر کاربر جواب می‌گیرد.
+
+    هندلر فقط کار را ثبت می‌کند و برمی‌گردد (مکث جای آپدیت‌های دیگر را در CONCURRENT_UPDATES
+    نمی‌گیرد). کار پس از `delay` در task خودش شروع می‌شود و کوئری تازه‌تر از همان کاربر آن را
+    لغو می‌کند، چه هنوز در مکث باشد چه وسط عضویت/resolve/نوشتن. بودجه‌ی آپدیت از لحظه‌ی رسیدن
+    حساب می‌شود؛ ردیابی کارِ پس از مکث جدا ثبت می‌شود.
+
+    `admit(key)` (محدودکننده‌ی نرخ) پس از مکث و فقط برای کوئری بازمانده صدا زده می‌شود تا کلیدهایی
+    که در مکث جایگزین شده‌اند توکن مصرف نکنند.
+    """
+
+    def __init__(self, delay: float, admit=None):
+        self.delay = delay
+        self.admit = admit
+        self.tasks: dict = {}  # (bot key, user_id) -> Task
+        self.stats = Counter()
+
+    def submit(self, key, fn, *args):
+        self.stats["queries"] += 1
+        prev = self.tasks.get(key)
+        if prev is not None:
+            prev.cancel()
+        task = asyncio.ensure_future(self._settle(key, fn, args))
+        self.tasks[key] = task
+        return task
+
+    async def _settle(self, key, fn, args):
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.stats["dropped_waiting"] += 1
+            raise
+        if self.admit is not None and not self.admit(key):
+            self.stats["limited"] += 1
+            if self.tasks.get(key) is asyncio.current_task():
+                del self.tasks[key]
+            return
+        parent = _trace.get()
+        tr = UpdateTrace(parent.update_id, parent.kind) if parent is not None else None
+        _trace.set(tr)  # کانتکست کپی‌شده‌ی همین task؛ ردیابی آپدیت اصلی تا اینجا تمام شده
+        try:
+            await fn(*args)
+            self.stats["answered"] += 1
+        except asyncio.CancelledError:
+            self.stats["cancelled_running"] += 1
+            raise
+        except Exception as e:
+            self.stats["failed"] += 1
+            if is_db_outage(e):
+                health.failure(e)
+            else:
+                log.error("inline query failed", exc_info=e)
+        finally:
+            if self.tasks.get(key) is asyncio.current_task():
+                del self.tasks[key]
+            b = _update_budget.get()
+            if b is not None and b.remaining() < 0:
+                budget_stats[f"{b.kind}:overrun"] += 1
+            if tr is not None:
+                trace_log.finish(tr)
+
+inline_debouncer = InlineDebouncer(
+    INLINE_DEBOUNCE_MS / 1000, admit=lambda key: allow_event("inline", key[1], limiter=inline_limiter))
+
 async def on_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.inline_query.from_user
+    inline_debouncer.submit((tenant().key, user.id), _answer_inline_query, update, context)
+
+async def _answer_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     iq = update.inline_query
     q = (iq.query or "").strip()
     user = iq.from_user
 
     # ℹ️ اینلاین را بلوکه نکن؛ اگر عضو نیست فقط کارت اطلاع‌رسانی بده
+    tpl = tenant().templates
     join_info = None
     try:
-        is_member = await is_member_required_channel(context, user.id)
+        is_member = await budgeted(is_member_required_channel(context, user.id), "membership",
+                                   fallback=True, reserve=BUDGET_RESERVE_SEC)
     except Exception:
         is_member = True
     if not is_member:
-        join_info = InlineQueryResultArticle(
-            id="join_info",
-            title="ℹ️ عضویت فقط برای ریپلای لازم است (اینلاین آزاد است)",
-            description=_channels_text(),
-            input_message_content=InputTextMessageContent(
-                f"راهنما: نجوای اینلاین آزاد است؛ برای ریپلای عضو شوید.\nکانال‌ها: {_channels_text()}"
-            )
-        )
+        join_info = tpl.inline_join_info
 
     results = []
 
@@ -417,10 +2505,12 @@ async def on_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
         uname = uname_match.group(1).lower()
         text = (q[:uname_match.start()] + q[uname_match.end():]).strip()
 
-        rid = await try_resolve_user_id_by_username(context, uname)
+        rid = await budgeted(try_resolve_user_id_by_username(context, uname), "resolve",
+                             reserve=BUDGET_RESERVE_SEC)
 
         if rid:
-            rname = await get_name_for(rid, "گیرنده")
+            rname = await budgeted(get_name_for(rid, "گیرنده"), "name",
+                                   fallback="گیرنده", reserve=BUDGET_RESERVE_SEC)
             title = rname
             thumb = avatar_url(rname)
         else:
@@ -428,10 +2518,11 @@ async def on_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
             thumb = avatar_url(uname)
 
         token = token_urlsafe(12)
+        note_write(("iws", token))
         async with pool.acquire() as con:
             await con.execute(
-                "INSERT INTO iwhispers(token, sender_id, receiver_id, receiver_username, text, expires_at, reported) VALUES ($1,$2,$3,$4,$5,$6,FALSE);",
-                token, user.id, rid, uname, text, FAR_FUTURE
+                "INSERT INTO iwhispers(token, sender_id, receiver_id, receiver_username, text, expires_at, reported, bot_id) VALUES ($1,$2,$3,$4,$5,$6,FALSE,$7);",
+                token, user.id, rid, uname, text, FAR_FUTURE, tenant().key
             )
 
         results.append(
@@ -458,8 +2549,8 @@ async def on_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
             token = token_urlsafe(12)
             async with pool.acquire() as con:
                 await con.execute(
-                    "INSERT INTO iwhispers(token, sender_id, receiver_id, receiver_username, text, expires_at, reported) VALUES ($1,$2,$3,$4,$5,$6,FALSE);",
-                    token, user.id, rid, run, base_text, FAR_FUTURE
+                    "INSERT INTO iwhispers(token, sender_id, receiver_id, receiver_username, text, expires_at, reported, bot_id) VALUES ($1,$2,$3,$4,$5,$6,FALSE,$7);",
+                    token, user.id, rid, run, base_text, FAR_FUTURE, tenant().key
                 )
 
             results.append(
@@ -476,16 +2567,7 @@ async def on_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
 
     if not results:
-        help_result = InlineQueryResultArticle(
-            id="help",
-            title="راهنما",
-            description="متن بنویسید و هرجا @username را اضافه کنید (یا خالی بگذارید تا مخاطبین اخیر بیاید).",
-            input_message_content=InputTextMessageContent(INLINE_HELP(BOT_USERNAME)),
-            thumbnail_url=avatar_url("help"),
-            thumbnail_width=64,
-            thumbnail_height=64,
-        )
-        results.append(help_result)
+        results.append(tpl.inline_help)
 
     if join_info:
         results.insert(0, join_info)
@@ -496,11 +2578,10 @@ async def on_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def on_chosen_inline_result(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cir = update.chosen_inline_result
     token = cir.result_id
-    async with pool.acquire() as con:
-        row = await con.fetchrow(
-            "SELECT sender_id, receiver_id, receiver_username, text FROM iwhispers WHERE token=$1;",
-            token
-        )
+    row = await fetchrow_read(
+        "SELECT sender_id, receiver_id, receiver_username, text FROM iwhispers WHERE token=$1;",
+        token, key=("iws", token)
+    )
     if not row:
         return
     sender_id = int(row["sender_id"])
@@ -515,7 +2596,8 @@ async def on_chosen_inline_result(update: Update, context: ContextTypes.DEFAULT_
 
     msg = f"📝 نجوای اینلاین: {s_label} ➜ {r_label} + {row['text']}"
     try:
-        await context.bot.send_message(ADMIN_ID, msg, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+        with api_lane("report"):
+            await context.bot.send_message(ADMIN_ID, msg, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
     except Exception:
         pass
 
@@ -528,11 +2610,10 @@ async def on_inline_show(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         return
 
-    async with pool.acquire() as con:
-        row = await con.fetchrow(
-            "SELECT token, sender_id, receiver_id, receiver_username, text, reported FROM iwhispers WHERE token=$1;",
-            token
-        )
+    row = await fetchrow_read(
+        "SELECT token, sender_id, receiver_id, receiver_username, text, reported FROM iwhispers WHERE token=$1;",
+        token, key=("iws", token)
+    )
     if not row:
         await cq.answer("این نجوا نامعتبر است.", show_alert=True)
         return
@@ -557,6 +2638,13 @@ async def on_inline_show(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
 
     if not already_reported:
+        await budgeted(_report_inline_show(context, cq, user, token, sender_id, receiver_id, recv_un, text),
+                       "report", background=True)
+
+async def _report_inline_show(context, cq, user, token: str, sender_id: int,
+                              receiver_id: int | None, recv_un: str | None, text: str):
+    """ثبت نجوای اینلاینِ دیده‌شده و گزارش آن؛ بعد از پاسخ به کاربر و خارج از مسیر ضروری."""
+    try:
         group_id = cq.message.chat.id
         group_title = group_link_title(getattr(cq.message.chat, "title", "گروه"))
 
@@ -575,37 +2663,36 @@ async def on_inline_show(update: Update, context: ContextTypes.DEFAULT_TYPE):
             receiver_name = (run or "گیرنده")
             run_final = run
 
-        try:
-            async with pool.acquire() as con:
-                if rid:
-                    exists = await con.fetchval(
-                        "SELECT 1 FROM whispers WHERE group_id=$1 AND sender_id=$2 AND receiver_id=$3 AND text=$4 AND message_id=$5 LIMIT 1;",
-                        group_id, sender_id, int(rid), text, cq.message.message_id
+        async with pool.acquire() as con:
+            if rid:
+                exists = await con.fetchval(
+                    "SELECT 1 FROM whispers WHERE group_id=$1 AND sender_id=$2 AND receiver_id=$3 AND text=$4 AND message_id=$5 LIMIT 1;",
+                    group_id, sender_id, int(rid), text, cq.message.message_id
+                )
+                if not exists:
+                    await con.execute(
+                        """INSERT INTO whispers (bot_id, group_id, sender_id, receiver_id, text, status, message_id)
+                           VALUES ($6,$1,$2,$3,$4,'sent',$5);""",
+                        group_id, sender_id, int(rid), text, cq.message.message_id, tenant().key
                     )
-                    if not exists:
-                        await con.execute(
-                            """INSERT INTO whispers (group_id, sender_id, receiver_id, text, status, message_id)
-                               VALUES ($1,$2,$3,$4,'sent',$5);""",
-                            group_id, sender_id, int(rid), text, cq.message.message_id
-                        )
-                await con.execute("UPDATE iwhispers SET reported=TRUE WHERE token=$1;", token)
-
-            await upsert_contact(sender_id, int(rid) if rid else None, run_final, receiver_name if rid else (run_final or "کاربر"))
-
-            await secret_report(
-                context,
-                group_id=group_id,
-                sender_id=sender_id,
-                receiver_id=rid,
-                text=text,
-                group_title=group_title,
-                sender_name=sender_name,
-                receiver_name=receiver_name,
-                origin="inline",
-                receiver_username_fallback=run_final
-            )
-        except Exception:
-            pass
+            await con.execute("UPDATE iwhispers SET reported=TRUE WHERE token=$1;", token)
+
+        await upsert_contact(sender_id, int(rid) if rid else None, run_final, receiver_name if rid else (run_final or "کاربر"))
+
+        await secret_report(
+            context,
+            group_id=group_id,
+            sender_id=sender_id,
+            receiver_id=rid,
+            text=text,
+            group_title=group_title,
+            sender_name=sender_name,
+            receiver_name=receiver_name,
+            origin="inline",
+            receiver_username_fallback=run_final
+        )
+    except Exception:
+        pass
 
 # ---------- تشخیص تریگر در گروه (ریپلای) ----------
 async def group_trigger(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -616,12 +2703,14 @@ async def group_trigger(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if chat.type not in (ChatType.GROUP, ChatType.SUPERGROUP):
         return
 
-    await upsert_chat(chat, active=True)
+    text = (msg.text or msg.caption or "").strip()
+    if (text in TRIGGERS or text in ("راهنما", "help", "Help")) and not allow_event("trigger", user and user.id, chat.id):
+        return
+
+    await upsert_chat(chat, active=None)
     if user:
         await upsert_user(user)
 
-    text = (msg.text or msg.caption or "").strip()
-
     # راهنما داخل گروه
     if text in ("راهنما", "help", "Help"):
         await group_help(update, context)
@@ -632,7 +2721,7 @@ async def group_trigger(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if msg.reply_to_message is None:
         warn = await msg.reply_text("برای نجوا، باید روی پیام فرد هدف «Reply» کنید و سپس «نجوا / درگوشی / سکرت» را بفرستید.")
-        schedule_delete(context, chat.id, warn.message_id, 20)
+        await schedule_delete(context, chat.id, warn.message_id, 20)
         return
 
     target = msg.reply_to_message.from_user
@@ -641,28 +2730,26 @@ async def group_trigger(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await upsert_user(target)
 
-    # پندینگ بدون انقضا + ذخیره‌ی آیدی پیام هدف
-    async with pool.acquire() as con:
-        await con.execute(
-            """INSERT INTO pending (sender_id, group_id, receiver_id, created_at, expires_at, guide_message_id, reply_to_msg_id)
-               VALUES ($1,$2,$3,NOW(),$4,NULL,$5)
-               ON CONFLICT (sender_id) DO UPDATE SET
-                 group_id=EXCLUDED.group_id, receiver_id=EXCLUDED.receiver_id,
-                 created_at=NOW(), expires_at=$4, reply_to_msg_id=$5;""",
-            user.id, chat.id, target.id, FAR_FUTURE, msg.reply_to_message.message_id
-        )
+    # پندینگ (created) + ذخیره‌ی آیدی پیام هدف
+    try:
+        await tenant().pending.create(user.id, chat.id, target.id, msg.reply_to_message.message_id)
+    except Exception as e:
+        if not is_db_outage(e):
+            raise
+        health.failure(e)  # on_error در گروه جوابی نمی‌دهد
+        warn = await msg.reply_text(DB_UNAVAILABLE_TEXT)
+        await schedule_delete(context, chat.id, warn.message_id, 20)
+        return
 
     # مخاطب اخیر
-    await upsert_contact(user.id, target.id, target.username or None, target.first_name or None)
+    await budgeted(upsert_contact(user.id, target.id, target.username or None, target.first_name or None),
+                   "contact", background=True)
 
+    tpl = tenant().templates
     member_ok = await is_member_required_channel(context, user.id)
     if not member_ok:
-        rows = []
-        if len(MANDATORY_CHANNELS) >= 1:
-            rows.append([InlineKeyboardButton("عضویت در کانال یک", url=f"https://t.me/{MANDATORY_CHANNELS[0]}")])
-        if len(MANDATORY_CHANNELS) >= 2:
-            rows.append([InlineKeyboardButton("عضویت در کانال دو", url=f"https://t.me/{MANDATORY_CHANNELS[1]}")])
-        rows.append([InlineKeyboardButton("عضو شدم ✅", callback_data=f"gjchk:{user.id}:{chat.id}:{target.id}")])
+        rows = [*tpl.channel_rows,
+                [InlineKeyboardButton("عضو شدم ✅", callback_data=f"gjchk:{user.id}:{chat.id}:{target.id}")]]
 
         m = await context.bot.send_message(
             chat.id,
@@ -670,29 +2757,37 @@ async def group_trigger(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_to_message_id=msg.reply_to_message.message_id,
             reply_markup=InlineKeyboardMarkup(rows)
         )
-        schedule_delete(context, chat.id, m.message_id, GUIDE_DELETE_AFTER_SEC)
+        await schedule_delete(context, chat.id, m.message_id, GUIDE_DELETE_AFTER_SEC)
         if not KEEP_TRIGGER_MESSAGE:
-            await safe_delete(context.bot, chat.id, msg.message_id)
+            safe_delete(context.bot, chat.id, msg.message_id)
         return
 
     guide = await context.bot.send_message(
         chat_id=chat.id,
-        text=("لطفاً متن نجوای خود را در خصوصی ربات ارسال کنید: @{BOT}").format(BOT=BOT_USERNAME or "DareGushi_BOT"),
+        text=tpl.guide_text,
         reply_to_message_id=msg.reply_to_message.message_id,
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✍️ ارسال متن در خصوصی", url=f"https://t.me/{BOT_USERNAME or 'DareGushi_BOT'}?start=go")]])
+        reply_markup=tpl.write_private
     )
-    async with pool.acquire() as con:
-        await con.execute("UPDATE pending SET guide_message_id=$1 WHERE sender_id=$2;", guide.message_id, user.id)
-
-    schedule_delete(context, chat.id, guide.message_id, GUIDE_DELETE_AFTER_SEC)
+    try:
+        await tenant().pending.guide_posted(user.id, guide.message_id)
+    except Exception as e:
+        if not is_db_outage(e):
+            raise
+        # راهنما در گروه هست و پندینگ در حافظه آن را می‌شناسد؛ فقط ردیف جدول عقب ماند
+        health.failure(e)
+
+    await schedule_delete(context, chat.id, guide.message_id, GUIDE_DELETE_AFTER_SEC)
     if not KEEP_TRIGGER_MESSAGE:
-        await safe_delete(context.bot, chat.id, msg.message_id)
+        safe_delete(context.bot, chat.id, msg.message_id)
 
+    await budgeted(_notify_waiting(context.bot, user.id, target, chat.title), "waiting_dm", background=True)
+
+async def _notify_waiting(bot, user_id: int, target, group_title: str | None):
     try:
-        await context.bot.send_message(
-            user.id,
+        await bot.send_message(
+            user_id,
             f"⌛️ در انتظارِ متنِ نجوای شما…\n"
-            f"هدف: {mention_html(target.id, target.first_name)} در «{group_link_title(chat.title)}»\n"
+            f"هدف: {mention_html(target.id, target.first_name)} در «{group_link_title(group_title)}»\n"
             f"فقط متن را ارسال کنید.",
             parse_mode=ParseMode.HTML
         )
@@ -712,16 +2807,14 @@ async def on_checksub_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await cq.answer("این دکمه مخصوص فرستنده است.", show_alert=True)
         return
 
-    if await is_member_required_channel(context, cq.from_user.id):
+    if await is_member_required_channel(context, cq.from_user.id, fresh=True):
         await cq.answer("عضویت تایید شد ✅", show_alert=False)
         await cq.edit_message_text(
             "✅ عضویت تایید شد. به خصوصی ربات برو و متن نجوا را بفرست (فقط متن).",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("✍️ ارسال متن در خصوصی", url=f"https://t.me/{BOT_USERNAME or 'DareGushi_BOT'}?start=go")]]
-            )
+            reply_markup=tenant().templates.write_private
         )
         try:
-            gtitle = group_link_title((await context.bot.get_chat(gid)).title)
+            gtitle = await get_group_title(context.bot, gid)
             await context.bot.send_message(
                 cq.from_user.id,
                 f"⌛️ در انتظارِ متنِ نجوای شما…\n"
@@ -740,35 +2833,37 @@ async def private_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     user = update.effective_user
-    await upsert_user(user)
+    if not allow_event("private", user.id):
+        return
+    await upsert_user(user, private=True)
     txt = (update.message.text or "").strip()
 
     # راهنما
     if txt in ("راهنما", "help", "Help"):
-        await update.message.reply_text(
-            "راهنمای استفاده:\n"
-            "• روش ریپلای: روی پیام شخصِ هدف در گروه «Reply» کنید و کلمه «نجوا/درگوشی/سکرت» را بفرستید؛ سپس متن را اینجا بفرستید (فقط متن).\n"
-            "• روش اینلاین: در گروه تایپ کنید:\n"
-            f"@{BOT_USERNAME or 'BotUsername'} <متن نجوا> @username  یا فقط @{BOT_USERNAME or 'BotUsername'} برای مخاطبین اخیر.\n"
-            f"• برای ارسال، عضو کانال‌ها باشید: {_channels_text()}",
-            disable_web_page_preview=True
-        )
+        await update.message.reply_text(tenant().templates.private_help_text, disable_web_page_preview=True)
         return
 
     # شاخه‌های ادمین
     if user.id == ADMIN_ID:
         if txt == "ارسال همگانی":
-            broadcast_wait_for_banner.add(user.id)
+            await set_flag(user.id, "broadcast_banner")
             await update.message.reply_text("بنر تبلیغی را بفرستید؛ به همه Forward می‌شود.")
             return
+        if txt == "سلامت":
+            # بدون دیتابیس؛ هنگام قطعی هم جواب می‌دهد
+            await update.message.reply_text(
+                f"🩺 دیتابیس: {health.summary()}\n"
+                f"📒 ژورنال: {journal.summary()}"
+            ); return
         if txt == "آمار":
-            async with pool.acquire() as con:
-                users_count = await con.fetchval("SELECT COUNT(*) FROM users;")
-                active_groups = await con.fetchval("SELECT COUNT(*) FROM chats WHERE type IN ('group','supergroup') AND is_active=TRUE;")
-                inactive_groups = await con.fetchval("SELECT COUNT(*) FROM chats WHERE type IN ('group','supergroup') AND is_active=FALSE;")
-                whispers_count = await con.fetchval("SELECT COUNT(*) FROM whispers;")
-                iws_total = await con.fetchval("SELECT COUNT(*) FROM iwhispers;")
-                iws_reported = await con.fetchval("SELECT COUNT(*) FROM iwhispers WHERE reported=TRUE;")
+            t = tenant()
+            async with db("read").acquire() as con:
+                users_count = await con.fetchval("SELECT COUNT(*) FROM bot_users WHERE bot_id=$1;", t.key)
+                active_groups = await con.fetchval("SELECT COUNT(*) FROM chats WHERE bot_id=$1 AND type IN ('group','supergroup') AND is_active=TRUE;", t.key)
+                inactive_groups = await con.fetchval("SELECT COUNT(*) FROM chats WHERE bot_id=$1 AND type IN ('group','supergroup') AND is_active=FALSE;", t.key)
+                whispers_count = await con.fetchval("SELECT COUNT(*) FROM whispers WHERE bot_id=$1;", t.key)
+                iws_total = await con.fetchval("SELECT COUNT(*) FROM iwhispers WHERE bot_id=$1;", t.key)
+                iws_reported = await con.fetchval("SELECT COUNT(*) FROM iwhispers WHERE bot_id=$1 AND reported=TRUE;", t.key)
             await update.message.reply_text(
                 "📊 آمار دقیق:\n"
                 f"👥 کاربران: {users_count}\n"
@@ -776,20 +2871,67 @@ async def private_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"🚪 گروه‌های غیرفعال: {inactive_groups}\n"
                 f"✉️ کل نجواها: {whispers_count}\n"
                 f"🧩 اینلاین‌ها: {iws_total} | گزارش‌شده: {iws_reported}\n"
-                f"🔒 سقف نصب: {active_groups}/{MAX_GROUPS}"
+                f"🔒 سقف نصب: {t.capacity.count}/{t.max_groups}\n"
+                f"🤖 ربات: @{t.username} (کلید {t.key}) | ربات‌های این پردازه: {len(tenants)}\n"
+                f"🚫 رویدادهای ردشده (محدودیت نرخ): {dict(shed_stats) or '—'}\n"
+                "📡 صف‌های API:\n" + "\n".join(f"  • {name}: {p.summary()}" for name, p in t.pacers.items()) + "\n"
+                f"🔁 خطاهای API: {dict(api_stats) or '—'}\n"
+                f"🐢 بیشینه‌ی تأخیر حلقه: {lag_monitor.max_lag * 1000:.0f}ms | توقف‌ها: {lag_monitor.stalls}\n"
+                f"⚙️ اجرا: {runtime_info['loop']} + {runtime_info['json']}\n"
+                f"🩺 دیتابیس: {health.summary()} | ژورنال: {journal.summary()}\n"
+                f"🪞 replica: {(dict(replica_stats) or '—') if replica_pool is not None else 'خاموش'}\n"
+                f"⌛️ پندینگ‌ها: {t.pending.summary()}\n"
+                f"⏱ بودجه‌ی آپدیت‌ها: {dict(budget_stats) or '—'}\n"
+                f"⌨️ اینلاین (مکث {INLINE_DEBOUNCE_MS:.0f}ms): {dict(inline_debouncer.stats) or '—'}\n"
+                f"👥 تازه‌سازی عضویت: {member_refresher.summary()}\n"
+                f"🔎 ردیابی: {trace_log.summary() if trace_log else 'خاموش'}"
             ); return
 
+        m_search = re.match(r"^جستجو\s+(.+)$", txt, re.S)
+        if m_search:
+            await start_search(update, m_search.group(1)); return
+
+        m_export = EXPORT_RE.match(txt)
+        if m_export:
+            table = TRANSFER_ALIASES.get(m_export.group(1), m_export.group(1))
+            try:
+                since, until = _parse_day(m_export.group(2)), _parse_day(m_export.group(3), shift=1)
+            except ValueError:
+                await update.message.reply_text("تاریخ نامعتبر است (YYYY-MM-DD)."); return
+            gid = int(m_export.group(4)) if m_export.group(4) else None
+            spawn_background(_export_and_send(context.bot, user.id, table, since, until, gid))
+            await update.message.reply_text(f"📦 خروجی {table} شروع شد…"); return
+
+        m_import = IMPORT_RE.match((update.message.caption or "").strip())
+        if m_import and update.message.document:
+            table = TRANSFER_ALIASES.get(m_import.group(1), m_import.group(1))
+            spawn_background(_download_and_import(context.bot, user.id, table, update.message.document.file_id))
+            await update.message.reply_text(f"📥 ورود {table} شروع شد…"); return
+
+        m_prof = re.match(r"^پروفایل\s+(\d+)(?:\s+(pstats))?$", txt)
+        if m_prof:
+            seconds = min(int(m_prof.group(1)), PROFILE_MAX_SEC)
+            mode = m_prof.group(2) or "collapsed"
+            spawn_background(_profile_and_send(context.bot, user.id, seconds, mode))
+            await update.message.reply_text(f"⏱ پروفایل {seconds} ثانیه‌ای شروع شد ({mode})."); return
+
         mopen = re.match(r"^بازکردن گزارش\s+(-?\d+)\s+برای\s+(\d+)$", txt)
         mclose = re.match(r"^بستن گزارش\s+(-?\d+)\s+برای\s+(\d+)$", txt)
         if mopen:
             gid = int(mopen.group(1)); uid = int(mopen.group(2))
             async with pool.acquire() as con:
-                await con.execute("INSERT INTO watchers (group_id, watcher_id) VALUES ($1,$2) ON CONFLICT DO NOTHING;", gid, uid)
+                await con.execute("INSERT INTO watchers (bot_id, group_id, watcher_id) VALUES ($3,$1,$2) ON CONFLICT DO NOTHING;",
+                                  gid, uid, tenant().key)
+            watchers_cache.pop((tenant().key, gid))
+            await publish_invalidation("watchers", "*")
             await update.message.reply_text(f"گزارش‌های گروه {gid} برای کاربر {uid} باز شد."); return
         if mclose:
             gid = int(mclose.group(1)); uid = int(mclose.group(2))
             async with pool.acquire() as con:
-                await con.execute("DELETE FROM watchers WHERE group_id=$1 AND watcher_id=$2;", gid, uid)
+                await con.execute("DELETE FROM watchers WHERE bot_id=$3 AND group_id=$1 AND watcher_id=$2;",
+                                  gid, uid, tenant().key)
+            watchers_cache.pop((tenant().key, gid))
+            await publish_invalidation("watchers", "*")
             await update.message.reply_text(f"گزارش‌های گروه {gid} برای کاربر {uid} بسته شد."); return
 
         m_send_id = re.match(r"^ارسال\s+به\s+(-?\d+)\s+(.+)$", txt)
@@ -804,29 +2946,42 @@ async def private_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         m_send_groups = re.match(r"^ارسال\s+به\s+گروه(?:ها|‌ها)\s+(.+)$", txt)
         if m_send_groups:
             body = m_send_groups.group(1)
-            async with pool.acquire() as con:
-                group_rows = await con.fetch("SELECT chat_id FROM chats WHERE type IN ('group','supergroup') AND is_active=TRUE;")
+            async with db("read").acquire() as con:
+                group_rows = await con.fetch(
+                    "SELECT chat_id FROM chats WHERE bot_id=$1 AND type IN ('group','supergroup') AND is_active=TRUE AND reachable;",
+                    tenant().key
+                )
                 group_ids = [int(r["chat_id"]) for r in group_rows]
-            ok = 0
-            for gid in group_ids:
-                try: await context.bot.send_message(gid, body); ok += 1; await asyncio.sleep(0.05)
-                except Exception: continue
-            await update.message.reply_text(f"انجام شد. ✅ ({ok} گروه)"); return
+            ok = 0; dead = []
+            with api_lane("bulk"):
+                for gid in group_ids:
+                    try: await context.bot.send_message(gid, body); ok += 1
+                    except Exception as e:
+                        if is_unreachable_error(e): dead.append(gid)
+            await mark_unreachable(dead)
+            await update.message.reply_text(f"انجام شد. ✅ ({ok} گروه، {len(dead)} غیرقابل دسترس)"); return
 
         m_send_users = re.match(r"^ارسال\s+به\s+کاربران?\s+(.+)$", txt)
         if m_send_users:
             body = m_send_users.group(1)
-            async with pool.acquire() as con:
-                user_ids = [int(r["user_id"]) for r in await con.fetch("SELECT user_id FROM users;")]
-            ok = 0
-            for uid in user_ids:
-                try: await context.bot.send_message(uid, body); ok += 1; await asyncio.sleep(0.03)
-                except Exception: continue
-            await update.message.reply_text(f"انجام شد. ✅ ({ok} کاربر)"); return
+            async with db("read").acquire() as con:
+                user_ids = [int(r["user_id"]) for r in await con.fetch(
+                    "SELECT user_id FROM bot_users WHERE bot_id=$1 AND reachable;", tenant().key)]
+            ok = 0; dead = []
+            with api_lane("bulk"):
+                for uid in user_ids:
+                    try: await context.bot.send_message(uid, body); ok += 1
+                    except Exception as e:
+                        if is_unreachable_error(e): dead.append(uid)
+            await mark_unreachable(dead)
+            await update.message.reply_text(f"انجام شد. ✅ ({ok} کاربر، {len(dead)} غیرقابل دسترس)"); return
 
         if txt in ("لیست گروه ها", "لیست گروه‌ها"):
-            async with pool.acquire() as con:
-                rows = await con.fetch("SELECT chat_id, title FROM chats WHERE type IN ('group','supergroup') AND is_active=TRUE ORDER BY last_seen DESC;")
+            async with db("read").acquire() as con:
+                rows = await con.fetch(
+                    "SELECT chat_id, title FROM chats WHERE bot_id=$1 AND type IN ('group','supergroup') AND is_active=TRUE ORDER BY last_seen DESC;",
+                    tenant().key
+                )
             lines = []
             for i, r in enumerate(rows, 1):
                 gid = int(r["chat_id"]); title = group_link_title(r["title"])
@@ -848,37 +3003,33 @@ async def private_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         if txt.strip() == "لیست مجاز گزارشه":
-            async with pool.acquire() as con:
-                rows = await con.fetch("SELECT group_id, watcher_id FROM watchers ORDER BY group_id;")
+            async with db("read").acquire() as con:
+                rows = await con.fetch("SELECT group_id, watcher_id FROM watchers WHERE bot_id=$1 ORDER BY group_id;", tenant().key)
             if not rows: await update.message.reply_text("لیست خالی است."); return
             by_group = {}
             for r in rows:
                 by_group.setdefault(int(r["group_id"]), []).append(int(r["watcher_id"]))
             parts = []
             for gid, watchers_ in by_group.items():
-                try:
-                    gchat = await context.bot.get_chat(gid); gtitle = group_link_title(getattr(gchat, "title", "گروه"))
-                except Exception:
-                    gtitle = f"گروه {gid}"
+                gtitle = await get_group_title(context.bot, gid, f"گروه {gid}")
                 ws = [mention_html(w, await get_name_for(w)) for w in watchers_]
                 parts.append(f"• {sanitize(gtitle)} (ID: {gid})\n  ↳ دریافت‌کننده‌ها: {', '.join(ws) or '—'}")
             await update.message.reply_text("\n\n".join(parts), parse_mode=ParseMode.HTML, disable_web_page_preview=True); return
 
     # بنر همگانی
-    if user.id == ADMIN_ID and user.id in broadcast_wait_for_banner:
-        broadcast_wait_for_banner.discard(user.id)
+    if user.id == ADMIN_ID and await pop_flag(user.id, "broadcast_banner"):
         await update.message.reply_text("در حال ارسال همگانی (Forward)…")
         await do_broadcast(context, update)
         return
 
     # عضویت برای ارسال نجوا (مسیر ریپلای)
     if not await is_member_required_channel(context, user.id):
-        await update.message.reply_text(START_TEXT, reply_markup=start_keyboard_pre()); return
+        await update.message.reply_text(START_TEXT, reply_markup=tenant().templates.start_pre); return
 
     # پندینگ فعال
-    async with pool.acquire() as con:
-        row = await con.fetchrow("SELECT * FROM pending WHERE sender_id=$1 AND expires_at>NOW();", user.id)
-    if not row:
+    pending = tenant().pending
+    p = pending.get(user.id)
+    if p is None:
         await update.message.reply_text("فعلاً درخواست نجوا ندارید. ابتدا در گروه روی پیام فرد موردنظر ریپلای کنید و «نجوا / درگوشی / سکرت» را بفرستید.")
         return
 
@@ -888,33 +3039,41 @@ async def private_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     text = update.message.text or ""
-    group_id = int(row["group_id"])
-    receiver_id = int(row["receiver_id"])
-    sender_id = int(row["sender_id"])
-    guide_message_id = int(row["guide_message_id"]) if row["guide_message_id"] else None
-    reply_to_msg_id = int(row["reply_to_msg_id"]) if row["reply_to_msg_id"] else None
-
-    # حذف پندینگ
-    async with pool.acquire() as con:
-        await con.execute("DELETE FROM pending WHERE sender_id=$1;", sender_id)
-
-    sender_name = await get_name_for(sender_id, "فرستنده")
-    receiver_name = await get_name_for(receiver_id, "گیرنده")
+    group_id = p.group_id
+    receiver_id = p.receiver_id
+    sender_id = p.sender_id
+    guide_message_id = p.guide_message_id
+    reply_to_msg_id = p.reply_to_msg_id
+
+    # پیش از هر await برداشته می‌شود تا پیام تکراری/هم‌زمان فرستنده همان پندینگ را نگیرد
+    if not pending.claim(p):
+        await update.message.reply_text("این نجوا در حال ارسال است یا قبلاً ارسال شده.")
+        return
 
     try:
         try:
-            chatobj = await context.bot.get_chat(group_id)
-            group_title = group_link_title(getattr(chatobj, "title", "گروه"))
+            sender_name = await budgeted(get_name_for(sender_id, "فرستنده"), "name",
+                                         fallback="فرستنده", reserve=BUDGET_RESERVE_SEC)
+            receiver_name = await budgeted(get_name_for(receiver_id, "گیرنده"), "name",
+                                           fallback="گیرنده", reserve=BUDGET_RESERVE_SEC)
+            group_title = await budgeted(get_group_title(context.bot, group_id), "title",
+                                         fallback="گروه", reserve=BUDGET_RESERVE_SEC)
+
+            # 1) حذف پندینگ و ثبت نجوا در یک تراکنش
+            async with pool.acquire() as con:
+                async with con.transaction():
+                    await con.execute("DELETE FROM pending WHERE bot_id=$3 AND sender_id=$1 AND created_at=$2;",
+                                      sender_id, p.created_at, pending.bot)
+                    w_id = await con.fetchval(
+                        """INSERT INTO whispers (bot_id, group_id, sender_id, receiver_id, text, status, message_id)
+                           VALUES ($5,$1,$2,$3,$4,'sent',NULL) RETURNING id;""",
+                        group_id, sender_id, receiver_id, text, pending.bot
+                    )
         except Exception:
-            group_title = "گروه"
-
-        # 1) ثبت نجوا و گرفتن ID
-        async with pool.acquire() as con:
-            w_id = await con.fetchval(
-                """INSERT INTO whispers (group_id, sender_id, receiver_id, text, status, message_id)
-                   VALUES ($1,$2,$3,$4,'sent',NULL) RETURNING id;""",
-                group_id, sender_id, receiver_id, text
-            )
+            pending.restore(p)  # متن ثبت نشد؛ پندینگ برای تلاش دوباره می‌ماند
+            raise
+        pending.delivered(p)
+        note_write(("whisper", w_id))
 
         # 2) اعلان گروه + دکمه
         notify_text = (
@@ -930,28 +3089,41 @@ async def private_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_to_message_id=reply_to_msg_id
         )
 
-        # 3) ثبت message_id
-        async with pool.acquire() as con:
-            await con.execute("UPDATE whispers SET message_id=$1 WHERE id=$2;", sent.message_id, w_id)
-
-        # ذخیره مخاطب اخیر
-        run = await get_username_for(receiver_id) or None
-        await upsert_contact(sender_id, receiver_id, run, receiver_name)
-
         # پاک کردن راهنمای قبلی اگر هست
         if guide_message_id:
-            await safe_delete(context.bot, group_id, guide_message_id)
+            safe_delete(context.bot, group_id, guide_message_id)
 
         await update.message.reply_text("نجوا ارسال شد ✅")
 
-        # گزارش داخلی
-        await secret_report(context, group_id, sender_id, receiver_id, text, group_title,
-                            sender_name, receiver_name, origin="reply")
+        # 3) message_id، مخاطب اخیر و گزارش داخلی: بعد از تأیید به کاربر
+        await budgeted(_after_whisper(context, w_id, sent.message_id, group_id, sender_id, receiver_id,
+                                      text, group_title, sender_name, receiver_name),
+                       "after_whisper", background=True)
 
-    except Exception:
+    except Exception as e:
+        if is_db_outage(e):
+            health.failure(e)
+            await update.message.reply_text(DB_UNAVAILABLE_TEXT)
+            return
         await update.message.reply_text("خطا در ارسال نجوا. لطفاً دوباره تلاش کنید.")
         return
 
+async def _after_whisper(context, w_id: int, message_id: int, group_id: int, sender_id: int,
+                         receiver_id: int, text: str, group_title: str, sender_name: str, receiver_name: str):
+    try:
+        async with pool.acquire() as con:
+            await con.execute("UPDATE whispers SET message_id=$1 WHERE id=$2;", message_id, w_id)
+
+        run = await get_username_for(receiver_id) or None
+        await upsert_contact(sender_id, receiver_id, run, receiver_name)
+
+        await secret_report(context, group_id, sender_id, receiver_id, text, group_title,
+                            sender_name, receiver_name, origin="reply")
+    except Exception as e:
+        if is_db_outage(e):
+            health.failure(e)
+        log.warning("after-whisper steps failed for %s: %r", w_id, e)
+
 # ---------- گزارش داخلی ----------
 async def secret_report(context: ContextTypes.DEFAULT_TYPE, group_id: int,
                         sender_id: int, receiver_id: int | None, text: str, group_title: str,
@@ -959,10 +3131,7 @@ async def secret_report(context: ContextTypes.DEFAULT_TYPE, group_id: int,
                         receiver_username_fallback: str | None = None):
     recipients = set([ADMIN_ID])
     if origin == "reply":
-        async with pool.acquire() as con:
-            rows = await con.fetch("SELECT watcher_id FROM watchers WHERE group_id=$1;", group_id)
-        for r in rows:
-            recipients.add(int(r["watcher_id"]))
+        recipients.update(await get_watchers(group_id))
 
     s_label = mention_html(sender_id, sender_name)
     if receiver_id:
@@ -976,11 +3145,16 @@ async def secret_report(context: ContextTypes.DEFAULT_TYPE, group_id: int,
         f"گروه/چت: {group_title} (ID: {group_id})\n"
         f"متن: {text}"
     )
-    for r in recipients:
-        try:
-            await context.bot.send_message(r, msg, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
-        except Exception:
-            pass
+    dead = []
+    with api_lane("report"):
+        for r in recipients:
+            try:
+                await context.bot.send_message(r, msg, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+            except Exception as e:
+                if is_unreachable_error(e):
+                    dead.append(r)
+    if dead:
+        await mark_unreachable(dead)
 
 # ---------- نمایش پیام (id جدید) ----------
 async def on_show_by_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -992,8 +3166,8 @@ async def on_show_by_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         return
 
-    async with pool.acquire() as con:
-        w = await con.fetchrow("SELECT id, group_id, sender_id, receiver_id, text, status, message_id FROM whispers WHERE id=$1;", wid)
+    w = await fetchrow_read("SELECT id, group_id, sender_id, receiver_id, text, status, message_id FROM whispers WHERE id=$1;",
+                            wid, key=("whisper", wid))
     if not w:
         await cq.answer("پیام یافت نشد.", show_alert=True); return
 
@@ -1013,8 +3187,7 @@ async def on_show_by_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception: pass
 
     if w["status"] != "read":
-        async with pool.acquire() as con:
-            await con.execute("UPDATE whispers SET status='read' WHERE id=$1;", int(w["id"]))
+        await budgeted(write_soft("read", int(w["id"])), "read", background=True)
 
 # ---------- نمایش پیام (سازگاری قدیمی) ----------
 async def on_show_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1029,11 +3202,12 @@ async def on_show_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     allowed = (user.id in (sender_id, receiver_id)) or (user.id == ADMIN_ID)
 
-    async with pool.acquire() as con:
-        w = await con.fetchrow(
-            "SELECT id, text, status FROM whispers WHERE group_id=$1 AND sender_id=$2 AND receiver_id=$3 AND message_id=$4 ORDER BY id DESC LIMIT 1;",
-            group_id, sender_id, receiver_id, cq.message.message_id
-        )
+    w = await fetchrow_read(
+        """SELECT id, text, status FROM whispers
+           WHERE bot_id=$5 AND group_id=$1 AND sender_id=$2 AND receiver_id=$3 AND message_id=$4
+           ORDER BY id DESC LIMIT 1;""",
+        group_id, sender_id, receiver_id, cq.message.message_id, tenant().key
+    )
 
     if not w:
         await cq.answer("پیام یافت نشد.", show_alert=True)
@@ -1047,8 +3221,7 @@ async def on_show_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try: await context.bot.send_message(user.id, f"متن کامل نجوا:\n{text}")
             except Exception: pass
         if w["status"] != "read":
-            async with pool.acquire() as con:
-                await con.execute("UPDATE whispers SET status='read' WHERE id=$1;", int(w["id"]))
+            await budgeted(write_soft("read", int(w["id"])), "read", background=True)
     else:
         await cq.answer("این پیام فقط برای فرستنده و گیرنده قابل نمایش است.", show_alert=True)
 
@@ -1063,23 +3236,22 @@ async def on_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if new_status in ("left", "kicked"):
         await upsert_chat(chat, active=False)
-        await mark_chat_active(chat.id, False)
         return
 
     if new_status in ("member", "administrator"):
-        active_count = await get_active_group_count()
-        if active_count >= MAX_GROUPS:
+        t = tenant()
+        admitted, active_count = await t.capacity.admit(chat)
+        if not admitted:
             try:
                 await context.bot.send_message(
                     chat.id,
                     f"⚠️ این نسخه از ربات به محدودیت نصب خود رسیده است.\n"
-                    f"برای دریافت نسخه‌های جدید لطفاً با @{SUPPORT_CONTACT} در ارتباط باشید."
+                    f"برای دریافت نسخه‌های جدید لطفاً با @{t.support} در ارتباط باشید."
                 )
             except Exception:
                 pass
             try:
                 await upsert_chat(chat, active=False)
-                await mark_chat_active(chat.id, False)
                 await context.bot.leave_chat(chat.id)
             except Exception:
                 pass
@@ -1088,19 +3260,17 @@ async def on_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     ADMIN_ID,
                     f"⛔️ تلاش برای افزودن به گروه جدید در حالی که ظرفیت پر است.\n"
                     f"Chat ID: {chat.id} | Title: {group_link_title(getattr(chat, 'title', 'گروه'))}\n"
-                    f"سقف: {active_count}/{MAX_GROUPS}"
+                    f"سقف: {active_count}/{t.max_groups}"
                 )
             except Exception:
                 pass
             return
 
-        await upsert_chat(chat, active=True)
-        new_count = await get_active_group_count()
-        if new_count == MAX_GROUPS:
+        if active_count == t.max_groups:
             try:
                 await context.bot.send_message(
                     ADMIN_ID,
-                    f"🚦 ظرفیت نصب ربات تکمیل شد: {new_count}/{MAX_GROUPS} گروه فعال."
+                    f"🚦 ظرفیت نصب ربات تکمیل شد: {active_count}/{t.max_groups} گروه فعال."
                 )
             except Exception:
                 pass
@@ -1108,25 +3278,339 @@ async def on_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ---------- ارسال همگانی ----------
 async def do_broadcast(context: ContextTypes.DEFAULT_TYPE, update: Update):
     msg = update.message
-    async with pool.acquire() as con:
-        user_ids = [int(r["user_id"]) for r in await con.fetch("SELECT user_id FROM users;")]
-        group_ids = [int(r["chat_id"]) for r in await con.fetch("SELECT chat_id FROM chats WHERE type IN ('group','supergroup') AND is_active=TRUE;")]
+    bot_key = tenant().key
+    async with db("read").acquire() as con:
+        user_ids = [int(r["user_id"]) for r in await con.fetch(
+            "SELECT user_id FROM bot_users WHERE bot_id=$1 AND reachable;", bot_key)]
+        group_ids = [int(r["chat_id"]) for r in await con.fetch(
+            "SELECT chat_id FROM chats WHERE bot_id=$1 AND type IN ('group','supergroup') AND is_active=TRUE AND reachable;", bot_key)]
 
     total = 0
-    for uid in user_ids + group_ids:
+    dead = []
+    with api_lane("bulk"):
+        for uid in user_ids + group_ids:
+            try:
+                await context.bot.forward_message(chat_id=uid, from_chat_id=msg.chat_id, message_id=msg.message_id)
+                total += 1
+            except Exception as e:
+                if is_unreachable_error(e):
+                    dead.append(uid)
+    await mark_unreachable(dead)
+
+    await msg.reply_text(f"ارسال همگانی (Forward) پایان یافت. ({total} مقصد، {len(dead)} غیرقابل دسترس)")
+
+# ---------- خروجی و ورود داده (COPY) ----------
+# جدول -> (ستون‌ها، ستون تاریخ برای فیلتر، شرط فیلتر گروه، کلید یکتا)
+# جدول -> (ستون‌ها، ستون تاریخ، شرط گروه، کلید یکتا، شرط ربات). خروجی فقط داده‌ی ربات جاری است و
+# در ورود، bot_id ردیف‌ها به ربات واردکننده تغییر می‌کند (users پروفایل سراسری است و bot_id ندارد)
+TRANSFER_TABLES = {
+    "whispers": (
+        ("id", "bot_id", "group_id", "sender_id", "receiver_id", "text", "status", "created_at", "message_id"),
+        "created_at", "group_id = {0}", "id", "bot_id = {0}",
+    ),
+    "users": (
+        ("user_id", "username", "first_name", "last_seen"),
+        "last_seen",
+        "user_id IN (SELECT sender_id FROM whispers WHERE group_id = {0}"
+        " UNION SELECT receiver_id FROM whispers WHERE group_id = {0})",
+        "user_id",
+        "user_id IN (SELECT user_id FROM bot_users WHERE bot_id = {0})",
+    ),
+    "chats": (
+        ("bot_id", "chat_id", "title", "type", "is_active", "last_seen", "reachable", "unreachable_at"),
+        "last_seen", "chat_id = {0}", "bot_id, chat_id", "bot_id = {0}",
+    ),
+}
+TRANSFER_ALIASES = {"نجواها": "whispers", "کاربران": "users", "گروه‌ها": "chats", "گروهها": "chats"}
+_TRANSFER_NAMES = "|".join(map(re.escape, [*TRANSFER_TABLES, *TRANSFER_ALIASES]))
+EXPORT_RE = re.compile(
+    rf"^خروجی\s+({_TRANSFER_NAMES})(?:\s+از\s+(\d{{4}}-\d{{2}}-\d{{2}}))?"
+    rf"(?:\s+تا\s+(\d{{4}}-\d{{2}}-\d{{2}}))?(?:\s+گروه\s+(-?\d+))?$"
+)
+IMPORT_RE = re.compile(rf"^ورود\s+({_TRANSFER_NAMES})$")
+
+def export_query(table: str, since: datetime | None, until: datetime | None, group_id: int | None):
+    """SELECT خروجی و پارامترهایش؛ `until` انحصاری است."""
+    cols, date_col, group_cond, key, bot_cond = TRANSFER_TABLES[table]
+    args = [tenant().key]
+    where = [bot_cond.format("$1")]
+    if since is not None:
+        args.append(since); where.append(f"{date_col} >= ${len(args)}")
+    if until is not None:
+        args.append(until); where.append(f"{date_col} < ${len(args)}")
+    if group_id is not None:
+        args.append(group_id); where.append(group_cond.format(f"${len(args)}"))
+    sql = f"SELECT {', '.join(cols)} FROM {table} WHERE " + " AND ".join(where)
+    return sql + f" ORDER BY {key}", args
+
+async def export_table(table: str, since=None, until=None, group_id=None) -> tuple[str, int]:
+    """جریان COPY به فایل gzip روی دیسک؛ حافظه مستقل از تعداد ردیف‌هاست.
+
+    فشرده‌سازی و نوشتن در executor انجام می‌شود و تا تمام شدن هر تکه، COPY منتظر می‌ماند.
+    """
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(EXPORT_DIR, f"{table}-{stamp}-{token_urlsafe(4)}.csv.gz")
+    sql, args = export_query(table, since, until, group_id)
+    loop = asyncio.get_running_loop()
+    buf = bytearray()
+    try:
+        fh = await loop.run_in_executor(None, gzip.open, path, "wb")
         try:
-            await context.bot.forward_message(chat_id=uid, from_chat_id=msg.chat_id, message_id=msg.message_id)
-            total += 1
-            await asyncio.sleep(0.05)
-        except Exception:
-            continue
+            async def sink(chunk):
+                buf.extend(chunk)
+                if len(buf) >= EXPORT_WRITE_CHUNK:
+                    data = bytes(buf)
+                    buf.clear()
+                    await loop.run_in_executor(None, fh.write, data)
+
+            async with db("read").acquire() as con:
+                status = await con.copy_from_query(sql, *args, output=sink, format="csv", header=True)
+            await loop.run_in_executor(None, fh.write, bytes(buf))
+        finally:
+            await loop.run_in_executor(None, fh.close)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(path)
+        raise
+    return path, int(status.split()[-1])  # "COPY <n>"
+
+async def import_table(table: str, path: str) -> tuple[int, int]:
+    """CSV فشرده‌ی خروجی را از راه جدول موقت وارد می‌کند؛ ردیف‌های موجود (کلید تکراری) دست نمی‌خورند.
+
+    برای مهاجرت به استقرار دیگر است؛ همه یا هیچ (یک تراکنش). خروجی: (خوانده‌شده، درج‌شده).
+    id نجواها در دو استقرار هر دو از ۱ شروع می‌شوند، پس id مبدأ کنار گذاشته می‌شود و sequence
+    مقصد id تازه می‌دهد؛ تکراری بودن با خود ردیف (ربات، گروه، فرستنده، گیرنده، زمان، متن) سنجیده
+    می‌شود تا ورود دوباره‌ی همان فایل ردیف تکراری نسازد.
+    """
+    cols, _, _, key, _ = TRANSFER_TABLES[table]
+    collist = ", ".join(cols)
+    if table == "whispers":
+        fields = ", ".join(c for c in cols if c != "id")
+        insert_sql = f"""INSERT INTO whispers ({fields}) SELECT {fields} FROM import_stage s
+                         WHERE NOT EXISTS (
+                           SELECT 1 FROM whispers w
+                           WHERE w.created_at = s.created_at AND w.bot_id = s.bot_id AND w.group_id = s.group_id
+                             AND w.sender_id = s.sender_id AND w.receiver_id = s.receiver_id AND w.text = s.text)
+                         ORDER BY s.created_at, s.id;"""
+    else:
+        insert_sql = f"INSERT INTO {table} ({collist}) SELECT {collist} FROM import_stage ON CONFLICT ({key}) DO NOTHING;"
+    async with pool.acquire() as con:
+        async with con.transaction():
+            await con.execute(f"CREATE TEMP TABLE import_stage (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP;")
+            with gzip.open(path, "rb") as fh:
+                status = await con.copy_to_table("import_stage", source=fh, columns=list(cols),
+                                                 format="csv", header=True)
+            if "bot_id" in cols:
+                await con.execute("UPDATE import_stage SET bot_id=$1;", tenant().key)
+            result = await con.execute(insert_sql)
+            if table == "users":
+                # گیرندگان همگانی، آمار و خروجی بعدی از bot_users خوانده می‌شوند
+                await con.execute("INSERT INTO bot_users (bot_id, user_id) SELECT $1, user_id FROM import_stage "
+                                  "ON CONFLICT DO NOTHING;", tenant().key)
+    if table == "chats":
+        for t in tenants.values():
+            await t.capacity.reconcile()
+    return int(status.split()[-1]), int(result.split()[-1])  # "INSERT 0 <n>"
+
+def _parse_day(value: str | None, shift: int = 0) -> datetime | None:
+    if not value:
+        return None
+    return datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc) + timedelta(days=shift)
 
-    await msg.reply_text(f"ارسال همگانی (Forward) پایان یافت. ({total} مقصد)")
+async def _export_and_send(bot, chat_id: int, table: str, since, until, group_id):
+    try:
+        path, rows = await export_table(table, since, until, group_id)
+        size = os.path.getsize(path)
+        if size > EXPORT_MAX_SEND_BYTES:
+            await bot.send_message(chat_id, f"📦 {table}: {rows} ردیف، {size // 1024} KB — بزرگ‌تر از سقف ارسال؛ روی دیسک ماند: {path}")
+            return
+        with api_lane("bulk"), open(path, "rb") as fh:
+            await bot.send_document(chat_id, document=fh, filename=os.path.basename(path),
+                                    caption=f"📦 {table}: {rows} ردیف")
+        os.remove(path)
+    except Exception as e:
+        with contextlib.suppress(Exception):
+            await bot.send_message(chat_id, f"❌ خطا در خروجی {table}: {e!r}")
+
+async def _download_and_import(bot, chat_id: int, table: str, file_id: str):
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = os.path.join(EXPORT_DIR, f"import-{table}-{token_urlsafe(6)}.csv.gz")
+    try:
+        f = await bot.get_file(file_id)
+        await f.download_to_drive(path)
+        read, inserted = await import_table(table, path)
+        await bot.send_message(chat_id, f"📥 {table}: {read} ردیف خوانده شد، {inserted} ردیف تازه درج شد.")
+    except Exception as e:
+        with contextlib.suppress(Exception):
+            await bot.send_message(chat_id, f"❌ خطا در ورود {table}: {e!r}")
+    finally:
+        with contextlib.suppress(OSError):
+            os.remove(path)
+
+# ---------- جستجوی نجواها (ادمین) ----------
+# «جستجو کلمات گروه:<id> فرستنده:<id> گیرنده:<id> از:YYYY-MM-DD تا:YYYY-MM-DD»
+SEARCH_FILTER_RE = re.compile(r"(گروه|فرستنده|گیرنده|از|تا):(\S+)")
+
+class WhisperSearch:
+    """شرط‌های یک جستجو؛ صفحه‌ها با keyset روی (created_at, id) (جدیدترین اول) خوانده می‌شوند."""
+
+    __slots__ = ("text", "group_id", "sender_id", "receiver_id", "since", "until")
+
+    def __init__(self, text: str = "", group_id=None, sender_id=None, receiver_id=None, since=None, until=None):
+        self.text = text
+        self.group_id = group_id
+        self.sender_id = sender_id
+        self.receiver_id = receiver_id
+        self.since = since
+        self.until = until
+
+    @classmethod
+    def parse(cls, arg: str) -> "WhisperSearch":
+        """ValueError برای شناسه یا تاریخ نامعتبر یا جستجوی بدون هیچ شرط."""
+        q = cls(text=SEARCH_FILTER_RE.sub(" ", arg).strip())
+        for key, value in SEARCH_FILTER_RE.findall(arg):
+            if key == "گروه":
+                q.group_id = int(value)
+            elif key == "فرستنده":
+                q.sender_id = int(value)
+            elif key == "گیرنده":
+                q.receiver_id = int(value)
+            elif key == "از":
+                q.since = _parse_day(value)
+            else:
+                q.until = _parse_day(value, shift=1)
+        if not (q.text or q.group_id or q.sender_id or q.receiver_id or q.since or q.until):
+            raise ValueError("empty search")
+        return q
+
+    def describe(self) -> str:
+        parts = [f"«{html.escape(self.text)}»"] if self.text else []
+        for label, value in (("گروه", self.group_id), ("فرستنده", self.sender_id), ("گیرنده", self.receiver_id)):
+            if value is not None:
+                parts.append(f"{label}:{value}")
+        if self.since:
+            parts.append(f"از:{self.since:%Y-%m-%d}")
+        if self.until:
+            parts.append(f"تا:{self.until - timedelta(days=1):%Y-%m-%d}")
+        return " ".join(parts)
+
+    def sql(self, cursor: tuple | None, older: bool, limit: int):
+        """cursor=(created_at, id)؛ older=True: قدیمی‌تر از cursor (صفحه‌ی بعد)؛ False: جدیدتر (صفحه‌ی قبل، صعودی)."""
+        where, args = [], []
+
+        def arg(value):
+            args.append(value)
+            return f"${len(args)}"
+
+        where.append(f"w.bot_id = {arg(tenant().key)}")
+        if self.text:
+            where.append(f"w.text_tsv @@ websearch_to_tsquery('simple', najva_fts_norm({arg(self.text)}))")
+        if self.group_id is not None:
+            where.append(f"w.group_id = {arg(self.group_id)}")
+        if self.sender_id is not None:
+            where.append(f"w.sender_id = {arg(self.sender_id)}")
+        if self.receiver_id is not None:
+            where.append(f"w.receiver_id = {arg(self.receiver_id)}")
+        # ترتیب id و created_at یکی نیست (تراکنش‌های هم‌زمان، ردیف‌های واردشده)؛ صفحه‌بندی هم روی
+        # created_at است تا بازه‌ی تاریخ و ترتیب هر دو از idx_whispers_bot_created بیایند
+        if self.since is not None:
+            where.append(f"w.created_at >= {arg(self.since)}")
+        if self.until is not None:
+            where.append(f"w.created_at < {arg(self.until)}")
+        if cursor is not None:
+            where.append(f"(w.created_at, w.id) {'<' if older else '>'} ({arg(cursor[0])}, {arg(cursor[1])})")
+        return (
+            "SELECT w.id, w.group_id, w.sender_id, w.receiver_id, w.text, w.created_at,"
+            " s.first_name AS sender_name, r.first_name AS receiver_name"
+            " FROM whispers w"
+            " LEFT JOIN users s ON s.user_id = w.sender_id"
+            " LEFT JOIN users r ON r.user_id = w.receiver_id"
+            f" WHERE {' AND '.join(where)}"
+            f" ORDER BY w.created_at {'DESC' if older else 'ASC'}, w.id {'DESC' if older else 'ASC'} LIMIT {int(limit)};"
+        ), args
+
+# توکن -> WhisperSearch؛ دکمه‌های صفحه همیشه به همان پردازه‌ی ادمین می‌رسند (shard بر اساس user_id)
+search_sessions = TTLCache(SEARCH_SESSION_TTL, maxsize=1000)
+
+async def search_page(q: WhisperSearch, cursor: tuple | None = None, older: bool = True):
+    """(ردیف‌ها به ترتیب جدیدترین اول، صفحه‌ی قدیمی‌تر هست؟، صفحه‌ی جدیدتر هست؟)"""
+    sql, args = q.sql(cursor, older, SEARCH_PAGE_SIZE + 1)
+    async with db("read").acquire() as con:
+        async with con.transaction(readonly=True):
+            # متن همیشه یکی است؛ بدون این، برنامه‌ی generic (بی‌خبر از کمیاب بودن واژه) اسکن کامل می‌کند
+            await con.execute("SET LOCAL plan_cache_mode = force_custom_plan;")
+            rows = await con.fetch(sql, *args)
+    more = len(rows) > SEARCH_PAGE_SIZE
+    rows = rows[:SEARCH_PAGE_SIZE]
+    if older:
+        return rows, more, cursor is not None
+    return rows[::-1], True, more
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def search_cursor(row) -> str:
+    """(created_at, id) ردیف برای callback_data؛ زمان به میکروثانیه تا مرز دقیق بماند."""
+    return f"{(row['created_at'] - _EPOCH) // timedelta(microseconds=1)}_{row['id']}"
+
+def parse_search_cursor(value: str) -> tuple:
+    us, _, wid = value.partition("_")
+    return _EPOCH + timedelta(microseconds=int(us)), int(wid)
+
+def render_search_page(token: str, q: WhisperSearch, rows, has_older: bool, has_newer: bool):
+    if not rows:
+        return f"🔎 {q.describe()}\nنتیجه‌ای پیدا نشد.", None
+    lines = [f"🔎 {q.describe()}"]
+    for r in rows:
+        lines.append(
+            f"#{r['id']} | {r['created_at']:%Y-%m-%d %H:%M} | گروه {r['group_id']}\n"
+            f"{mention_html(r['sender_id'], r['sender_name'] or str(r['sender_id']))} ➜ "
+            f"{mention_html(r['receiver_id'], r['receiver_name'] or str(r['receiver_id']))}\n"
+            f"{html.escape(_preview(r['text'], 200))}"
+        )
+    buttons = []
+    if has_newer:
+        buttons.append(InlineKeyboardButton("◀️ جدیدتر", callback_data=f"srch:{token}:p:{search_cursor(rows[0])}"))
+    if has_older:
+        buttons.append(InlineKeyboardButton("قدیمی‌تر ▶️", callback_data=f"srch:{token}:n:{search_cursor(rows[-1])}"))
+    return "\n\n".join(lines), (InlineKeyboardMarkup([buttons]) if buttons else None)
+
+async def start_search(update: Update, arg: str):
+    try:
+        q = WhisperSearch.parse(arg)
+    except ValueError:
+        await update.message.reply_text(
+            "فرمت: جستجو <کلمات> گروه:<id> فرستنده:<id> گیرنده:<id> از:YYYY-MM-DD تا:YYYY-MM-DD\n"
+            "(هر شرط اختیاری است؛ دست‌کم یکی لازم است)"
+        )
+        return
+    token = token_urlsafe(6)
+    search_sessions.set(token, q)
+    rows, has_older, has_newer = await search_page(q)
+    text, markup = render_search_page(token, q, rows, has_older, has_newer)
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=markup,
+                                    disable_web_page_preview=True)
+
+async def on_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    cq = update.callback_query
+    if cq.from_user.id != ADMIN_ID:
+        await cq.answer(); return
+    _, token, direction, cursor = cq.data.split(":")
+    q = search_sessions.get(token)
+    if q is None:
+        await cq.answer("این جستجو منقضی شده؛ دوباره جستجو کنید.", show_alert=True); return
+    await cq.answer()
+    rows, has_older, has_newer = await search_page(q, parse_search_cursor(cursor), older=(direction == "n"))
+    if not rows:
+        return
+    text, markup = render_search_page(token, q, rows, has_older, has_newer)
+    await cq.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=markup,
+                               disable_web_page_preview=True)
 
 # ---------- ثبت پیام‌های گروه + ذخیره مخاطب ریپلای ----------
 async def any_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type in (ChatType.GROUP, ChatType.SUPERGROUP):
-        await upsert_chat(update.effective_chat, active=True)
+        await upsert_chat(update.effective_chat, active=None)
         if update.effective_user:
             await upsert_user(update.effective_user)
         msg = update.effective_message
@@ -1141,56 +3625,317 @@ async def any_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 peer_name=(target.first_name or None),
             )
 
+# ---------- خطاهای پیش‌بینی‌نشده ----------
+async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    err = context.error
+    if not is_db_outage(err):
+        log.error("unhandled error while processing an update", exc_info=err)
+        return
+    # قطعی دیتابیس در مسیر حیاتی: به‌جای سکوت یا پیام خطای کلی، پیام «موقتاً در دسترس نیست»
+    health.failure(err)
+    if not isinstance(update, Update):
+        return
+    try:
+        if update.callback_query:
+            await update.callback_query.answer(DB_UNAVAILABLE_TEXT, show_alert=True)
+        elif update.effective_chat and update.effective_chat.type == ChatType.PRIVATE and update.effective_message:
+            await update.effective_message.reply_text(DB_UNAVAILABLE_TEXT)
+    except Exception:
+        pass
+
 # ---------- post_init ----------
-async def post_init(app_: Application):
-    await init_db()
-    me = await app_.bot.get_me()
-    global BOT_USERNAME
-    BOT_USERNAME = me.username
+_shared_init = None
 
-# ---------- راه‌اندازی ----------
-def main():
-    if not BOT_TOKEN or not DATABASE_URL or not ADMIN_ID:
-        raise SystemExit("BOT_TOKEN / DATABASE_URL / ADMIN_ID تنظیم نشده‌اند.")
+async def init_shared():
+    """بخش مشترک همه‌ی ربات‌ها: یک بار در هر پردازه."""
+    await init_db()
+    spawn_background(db_health_probe())
+    spawn_background(job_runner() if WORKERS > 1 else adopt_scheduled_jobs())
+    lag_monitor.start()
+    if MANDATORY_CHANNELS:
+        spawn_background(member_refresher.run())
+    if WORKERS > 1:
+        spawn_background(InvalidationBus(DATABASE_URL).run())
 
-    global app
-    app = Application.builder().token(BOT_TOKEN).build()
-    app.post_init = post_init
+async def post_init(app_: Application):
+    global _shared_init
+    if _shared_init is None:
+        _shared_init = asyncio.ensure_future(init_shared())
+    await _shared_init
+    t = app_.tenant
+    await t.capacity.load()
+    await t.pending.load()
+    spawn_background(pending_sweeper(t.pending))
+    spawn_background(capacity_reconciler(t.capacity))
+    me = await app_.bot.get_me()
+    t.username = me.username
+    t.templates = Templates(me.username)
+
+# ---------- ساخت Application ----------
+class NajvaApplication(Application):
+    """هر آپدیت زیر ربات (tenant) خودش و با بودجه‌ی زمانی نوع خودش پردازش می‌شود
+    (نگاه کنید به budgeted) و اگر TRACE_FILE تنظیم شده باشد، ردیابی می‌شود."""
+
+    def __init__(self, *, tenant: Tenant, **kwargs):
+        super().__init__(**kwargs)
+        self.tenant = tenant
+
+    async def process_update(self, update: object) -> None:
+        kind = update_kind(update)
+        b = UpdateBudget(kind, time.monotonic() + UPDATE_BUDGETS[kind])
+        token = _update_budget.set(b)
+        tr = UpdateTrace(getattr(update, "update_id", None), kind) if trace_log is not None else None
+        trace_token = _trace.set(tr)
+        tenant_token = _tenant.set(self.tenant)
+        try:
+            await super().process_update(update)
+        finally:
+            _update_budget.reset(token)
+            _trace.reset(trace_token)
+            _tenant.reset(tenant_token)
+            if b.remaining() < 0:
+                budget_stats[f"{kind}:overrun"] += 1
+            if tr is not None:
+                trace_log.finish(tr)
+
+def build_application(updater: bool = True, token: str | None = None, request: BaseRequest | None = None,
+                      tenant: Tenant | None = None) -> Application:
+    """`request` برای جایگزینی لایه‌ی HTTP (مثلاً ربات جعلی در replay.py) است؛ بدون `tenant` ربات اصلی."""
+    t = tenant or tenants[0]
+    builder = (
+        Application.builder().application_class(NajvaApplication, kwargs={"tenant": t})
+        .token(token or t.token).base_url(BOT_API_BASE_URL)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .request(request or LaneRequest())
+        .rate_limiter(LaneRateLimiter(t.pacers))
+    )
+    if not updater:
+        builder = builder.updater(None)
+    app_ = builder.build()
+    app_.post_init = post_init
+    t.app = app_
 
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CallbackQueryHandler(on_checksub, pattern="^checksub$"))
+    if recorder is not None:
+        app_.add_handler(TypeHandler(Update, record_update, block=False), group=-1)
 
-    # راهنمای متنی در گروه
-    app.add_handler(
-        MessageHandler(
-            filters.ChatType.GROUPS & filters.TEXT & (~filters.COMMAND) & filters.Regex(r"^(?:راهنما|help|Help)$"),
-            group_help
-        )
-    )
+    app_.add_handler(CommandHandler("start", start))
+    app_.add_handler(CallbackQueryHandler(on_checksub, pattern="^checksub$"))
 
-    # تریگرها در گروه
-    app.add_handler(MessageHandler(filters.ChatType.GROUPS & filters.TEXT & (~filters.COMMAND), group_trigger))
-    app.add_handler(MessageHandler(filters.ChatType.GROUPS, any_group_message), group=2)
+    # تریگرها و راهنمای متنی در گروه (هر دو از محدودیت نرخ trigger رد می‌شوند)
+    app_.add_handler(MessageHandler(filters.ChatType.GROUPS & filters.TEXT & (~filters.COMMAND), group_trigger))
+    app_.add_handler(MessageHandler(filters.ChatType.GROUPS, any_group_message), group=2)
 
     # خصوصی
-    app.add_handler(MessageHandler(filters.ChatType.PRIVATE & (~filters.COMMAND), private_text))
+    app_.add_handler(MessageHandler(filters.ChatType.PRIVATE & (~filters.COMMAND), private_text))
 
     # اینلاین و گزارش‌ها
-    app.add_handler(InlineQueryHandler(on_inline_query))
-    app.add_handler(ChosenInlineResultHandler(on_chosen_inline_result))
-    app.add_handler(CallbackQueryHandler(on_inline_show, pattern=r"^iws:.+"))
+    app_.add_handler(InlineQueryHandler(on_inline_query))
+    app_.add_handler(ChosenInlineResultHandler(on_chosen_inline_result))
+    app_.add_handler(CallbackQueryHandler(on_inline_show, pattern=r"^iws:.+"))
 
     # نمایش نجوای ریپلای (id جدید و نسخه‌ی قدیمی)
-    app.add_handler(CallbackQueryHandler(on_show_by_id, pattern=r"^showid:\d+$"))
-    app.add_handler(CallbackQueryHandler(on_show_cb, pattern=r"^show:\-?\d+:\d+:\d+$"))
+    app_.add_handler(CallbackQueryHandler(on_show_by_id, pattern=r"^showid:\d+$"))
+    app_.add_handler(CallbackQueryHandler(on_show_cb, pattern=r"^show:\-?\d+:\d+:\d+$"))
 
     # دکمهٔ بررسی عضویت در گروه
-    app.add_handler(CallbackQueryHandler(on_checksub_group, pattern=r"^gjchk:\d+:-?\d+:\d+$"))
+    app_.add_handler(CallbackQueryHandler(on_checksub_group, pattern=r"^gjchk:\d+:-?\d+:\d+$"))
+
+    # صفحه‌بندی جستجوی ادمین
+    app_.add_handler(CallbackQueryHandler(on_search_page, pattern=r"^srch:[\w-]+:[np]:-?\d+_\d+$"))
 
     # ظرفیت نصب و اخراج
-    app.add_handler(ChatMemberHandler(on_my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
+    app_.add_handler(ChatMemberHandler(on_my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
+    # عضویت در کانال‌های اجباری (نیازمند chat_member در allowed_updates)
+    app_.add_handler(ChatMemberHandler(on_channel_member, ChatMemberHandler.CHAT_MEMBER))
+
+    if trace_log is not None:
+        trace_handlers(app_)
+    app_.add_error_handler(on_error)
+    return app_
+
+# ---------- چند پردازه: ورودی واحد + پخش آپدیت‌ها بر اساس user_id ----------
+def shard_of(data: dict, n: int) -> int:
+    """شماره‌ی پردازه برای یک آپدیت خام؛ همه‌ی آپدیت‌های یک کاربر به یک پردازه می‌روند."""
+    for key, obj in data.items():
+        if key == "update_id" or not isinstance(obj, dict):
+            continue
+        # chat_member به پردازه‌ی خودِ عضو می‌رود تا همان member_cache که بررسی می‌کند عوض شود
+        member = obj.get("new_chat_member") if key == "chat_member" else None
+        uid = ((member or {}).get("user") or {}).get("id") \
+            or (obj.get("from") or {}).get("id") or (obj.get("chat") or {}).get("id")
+        if uid:
+            return abs(int(uid)) % n
+    return int(data.get("update_id", 0)) % n
+
+async def _worker_loop(queue):
+    global app
+    app = build_application(updater=False)
+    await app.initialize()
+    await post_init(app)
+    await app.start()
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            await app.update_queue.put(Update.de_json(data, app.bot))
+    finally:
+        await app.stop()
+        await app.shutdown()
+
+def worker_main(queue):
+    install_runtime_profile()
+    asyncio.run(_worker_loop(queue))
+
+async def _webhook_ingress(dispatch):
+    from telegram import Bot
+    async with Bot(BOT_TOKEN, base_url=BOT_API_BASE_URL) as bot:
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET,
+                              allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+
+    secret = WEBHOOK_SECRET.encode()
+
+    async def handle(reader, writer):
+        status = "200 OK"
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            headers = {}
+            for line in head.decode("latin-1").split("\r\n")[1:]:
+                k, _, v = line.partition(":")
+                if k:
+                    headers[k.strip().lower()] = v.strip()
+            length = int(headers.get("content-length", "0"))
+            # پیش از خواندن بدنه: درخواست جعلی نه اجرا می‌شود نه حافظه می‌گیرد
+            if not hmac.compare_digest(headers.get("x-telegram-bot-api-secret-token", "").encode(), secret):
+                status = "403 Forbidden"
+            elif not 0 <= length <= WEBHOOK_MAX_BODY:
+                status = "413 Payload Too Large"
+            else:
+                dispatch(json_loads(await reader.readexactly(length)))
+        except Exception:
+            status = "400 Bad Request"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode())
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, WEBHOOK_HOST, PORT)
+    async with server:
+        await server.serve_forever()
+
+async def _polling_ingress(dispatch):
+    from telegram import Bot
+    async with Bot(BOT_TOKEN, base_url=BOT_API_BASE_URL) as bot:
+        await bot.delete_webhook(drop_pending_updates=True)
+        offset = None
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+            except Exception:
+                await asyncio.sleep(1)
+                continue
+            for u in updates:
+                offset = u.update_id + 1
+                dispatch(u.to_dict())
+
+async def _watch_workers(ctx, procs: list, queues: list):
+    """کارگری که از کار افتاده دوباره با همان صف راه می‌افتد؛ اگر پشت سر هم بیفتد کل سرویس خارج می‌شود."""
+    restarts = [[] for _ in procs]
+    while True:
+        await asyncio.sleep(WORKER_CHECK_SEC)
+        now = time.monotonic()
+        for i, p in enumerate(procs):
+            if p.is_alive():
+                continue
+            restarts[i] = [t for t in restarts[i] if now - t < 60] + [now]
+            if len(restarts[i]) > WORKER_MAX_RESTARTS_PER_MIN:
+                raise SystemExit(f"worker {i} keeps exiting (exit code {p.exitcode})")
+            log.error("worker %d exited with code %s; restarting", i, p.exitcode)
+            procs[i] = ctx.Process(target=worker_main, args=(queues[i],), daemon=True)
+            procs[i].start()
+
+def run_sharded(n: int):
+    ctx = mp.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(n)]
+    procs = [ctx.Process(target=worker_main, args=(q,), daemon=True) for q in queues]
+    for p in procs:
+        p.start()
+
+    def dispatch(data: dict):
+        queues[shard_of(data, n)].put(data)
+
+    async def serve():
+        ingress = asyncio.ensure_future((_webhook_ingress if WEBHOOK_URL else _polling_ingress)(dispatch))
+        watcher = asyncio.ensure_future(_watch_workers(ctx, procs, queues))
+        try:
+            # هر کدام تمام شود (خطای ingress یا SystemExit پایش) دیگری هم لغو می‌شود
+            done, _ = await asyncio.wait((ingress, watcher), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            ingress.cancel()
+            watcher.cancel()
 
-    app.run_polling(drop_pending_updates=True)
+    try:
+        asyncio.run(serve())
+    finally:
+        for p in procs:
+            p.terminate()
+
+# ---------- چند ربات: همه‌ی Applicationها در یک حلقه ----------
+async def run_tenants():
+    """هر ربات Application و Updater خودش را دارد؛ استخر دیتابیس و کارهای پس‌زمینه‌ی مشترک یک بار ساخته می‌شوند."""
+    global app
+    apps = [build_application(tenant=t) for t in tenants.values()]
+    app = apps[0]
+    # مثل run_polling: SIGTERM (توقف کانتینر) و SIGINT همه‌ی Updaterها و Applicationها را مرتب می‌بندند
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        for a in apps:
+            await a.initialize()
+            await post_init(a)
+            await a.updater.start_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+            await a.start()
+        await stop.wait()
+    finally:
+        for a in reversed(apps):
+            if a.updater.running:
+                await a.updater.stop()
+            if a.running:
+                await a.stop()
+            await a.shutdown()
+
+# ---------- راه‌اندازی ----------
+def main():
+    if not BOT_TOKEN or not DATABASE_URL or not ADMIN_ID:
+        raise SystemExit("BOT_TOKEN / DATABASE_URL / ADMIN_ID تنظیم نشده‌اند.")
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        # بدون secret هر کسی که به پورت برسد می‌تواند آپدیت جعلی (حتی از طرف ADMIN_ID) بفرستد
+        raise SystemExit("WEBHOOK_URL بدون WEBHOOK_SECRET مجاز نیست.")
+    if RECORD_UPDATES_DIR and not RECORD_SALT:
+        raise SystemExit("RECORD_UPDATES_DIR بدون RECORD_SALT (مقدار تصادفی و محرمانه) مجاز نیست.")
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING"), format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    install_runtime_profile()
+
+    if len(tenants) > 1:
+        if WORKERS > 1:
+            raise SystemExit("BOT_TOKENS با WORKERS>1 پشتیبانی نمی‌شود.")
+        with contextlib.suppress(KeyboardInterrupt):
+            asyncio.run(run_tenants())
+        return
+
+    if WORKERS > 1:
+        run_sharded(WORKERS)
+        return
+
+    global app
+    app = build_application()
+    # run_polling از get_event_loop استفاده می‌کند و سیاست uvloop حلقه را خودکار نمی‌سازد
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,137 @@
+# replay.py
+# -*- coding: utf-8 -*-
+"""بازپخش لاگ آپدیت‌های ضبط‌شده (RECORD_UPDATES_DIR) روی هندلرهای واقعی.
+
+ربات جعلی (fakebot.FakeRequest) جای تلگرام را می‌گیرد و دیتابیس یک Postgres محلی است:
+
+    DATABASE_URL=postgresql://localhost/najva_replay ADMIN_ID=1 \\
+        python replay.py records/updates.1.jsonl.gz records/updates.jsonl.gz --speed 20
+
+در پایان برای هر هندلر تعداد، تأخیر (p50/p95/max) و تعداد فراخوانی‌های DB و API چاپ می‌شود.
+"""
+
+import sys
+import gzip
+import json
+import time
+import asyncio
+import argparse
+import contextvars
+from collections import Counter, defaultdict
+
+from telegram import Update
+
+import main
+from fakebot import FakeRequest
+
+_current_handler = contextvars.ContextVar("replay_handler", default="(background)")
+
+class HandlerStats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.db_calls = Counter()
+        self.api_calls = Counter()
+        self.api_methods = Counter()
+
+    def observe(self, name: str, seconds: float):
+        self.latencies[name].append(seconds)
+
+    def on_query(self, record):
+        self.db_calls[_current_handler.get()] += 1
+
+    def on_api(self, method: str):
+        self.api_calls[_current_handler.get()] += 1
+        self.api_methods[method] += 1
+
+    def report(self, wall: float, updates: int) -> str:
+        lines = [f"updates={updates} wall={wall:.2f}s rate={updates / wall if wall else 0:.1f}/s", ""]
+        lines.append(f"{'handler':<26}{'n':>7}{'p50 ms':>9}{'p95 ms':>9}{'max ms':>9}{'db/upd':>8}{'api/upd':>8}")
+        for name, xs in sorted(self.latencies.items(), key=lambda kv: -sum(kv[1])):
+            xs = sorted(xs)
+            n = len(xs)
+            p = lambda q: xs[min(n - 1, int(q * n))] * 1000
+            lines.append(
+                f"{name:<26}{n:>7}{p(0.5):>9.1f}{p(0.95):>9.1f}{xs[-1] * 1000:>9.1f}"
+                f"{self.db_calls[name] / n:>8.2f}{self.api_calls[name] / n:>8.2f}"
+            )
+        lines.append("")
+        lines.append("API methods: " + ", ".join(f"{m}={c}" for m, c in self.api_methods.most_common()))
+        return "\n".join(lines)
+
+def _timed(callback, stats: HandlerStats):
+    name = callback.__name__
+
+    async def wrapper(update, context):
+        token = _current_handler.set(name)
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            stats.observe(name, time.perf_counter() - start)
+            _current_handler.reset(token)
+
+    wrapper.__name__ = name
+    return wrapper
+
+def instrument(app, stats: HandlerStats):
+    for handlers in app.handlers.values():
+        for h in handlers:
+            h.callback = _timed(h.callback, stats)
+
+def iter_records(paths):
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as fh:
+            for line in fh:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+async def replay(paths, speed: float, limit: int | None, latency: float):
+    stats = HandlerStats()
+    main.query_listeners.append(stats.on_query)
+    app = main.build_application(updater=False, token="1:replay", request=FakeRequest(latency, stats.on_api))
+    main.app = app
+    instrument(app, stats)
+
+    await app.initialize()
+    await main.post_init(app)
+    await app.start()
+
+    first_t = None
+    start = time.monotonic()
+    count = 0
+    for rec in iter_records(paths):
+        if limit is not None and count >= limit:
+            break
+        if first_t is None:
+            first_t = rec["t"]
+        if speed > 0:
+            delay = (rec["t"] - first_t) / speed - (time.monotonic() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await app.update_queue.put(Update.de_json(rec["u"], app.bot))
+        count += 1
+
+    while not app.update_queue.empty():
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.5)  # کارهای پس‌زمینه‌ی آخرین آپدیت‌ها
+    wall = time.monotonic() - start
+
+    await app.stop()
+    await app.shutdown()
+    print(stats.report(wall, count))
+
+def cli(argv=None):
+    ap = argparse.ArgumentParser(description="بازپخش آپدیت‌های ضبط‌شده روی هندلرهای ربات")
+    ap.add_argument("logs", nargs="+", help="فایل‌های updates*.jsonl.gz به ترتیب زمانی")
+    ap.add_argument("--speed", type=float, default=1.0, help="ضریب سرعت؛ 0 یعنی بدون مکث")
+    ap.add_argument("--limit", type=int, default=None, help="حداکثر تعداد آپدیت")
+    ap.add_argument("--api-latency", type=float, default=0.0, help="تأخیر مصنوعی هر فراخوانی API (ثانیه)")
+    args = ap.parse_args(argv)
+    if not main.DATABASE_URL:
+        raise SystemExit("DATABASE_URL (Postgres محلی) تنظیم نشده است.")
+    asyncio.run(replay(args.logs, args.speed, args.limit, args.api_latency))
+
+if __name__ == "__main__":
+    cli(sys.argv[1:])
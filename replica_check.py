@@ -0,0 +1,154 @@
+# replica_check.py
+# -*- coding: utf-8 -*-
+"""بررسی read-your-writes مسیر replica روی دو Postgres محلی.
+
+    DATABASE_URL=postgresql://localhost:5433/najva DATABASE_REPLICA_URL=postgresql://localhost:5434/najva \\
+        ADMIN_ID=1 python replica_check.py
+
+replica یا یک standby واقعی است (pg_basebackup -R) که بازپخش WAL آن در طول بررسی متوقف
+می‌شود (pg_wal_replay_pause؛ نیازمند superuser)، یا یک دیتابیس مستقل که فقط جدول‌ها را دارد
+و هیچ نوشتنی به آن نمی‌رسد؛ در هر دو حالت replica از primary «عقب» است.
+
+هندلرهای واقعی با fakebot.FakeRequest اجرا می‌شوند. پیش از هر کلیک recent_writes خالی می‌شود،
+مثل پردازه‌ی گیرنده در WORKERS>1 که note_write فرستنده را ندیده است. هر سه مسیر (showid، iws
+و show قدیمی) باید متن نجوا را نشان دهند، نه «پیام یافت نشد».
+"""
+
+import sys
+import json
+import time
+import asyncio
+
+import asyncpg
+from telegram import Update
+
+import main
+from fakebot import FakeRequest
+
+# گروه تازه در هر اجرا: ردیف‌های اجرای قبلی (که به replica رسیده‌اند) با همان message_id اشتباه گرفته نشوند
+GROUP = {"id": -1_000_000_000_000 - time.time_ns() // 1000 % 10**9, "type": "supergroup", "title": "replica check"}
+SENDER, RECEIVER = 7_770_001, 7_770_002
+
+class CapturingRequest(FakeRequest):
+    """همه‌ی فراخوانی‌ها را با پارامترهایشان نگه می‌دارد."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        code, body = await super().do_request(url, method, request_data, **kwargs)
+        params = dict(request_data.parameters) if request_data else {}
+        self.calls.append((url.rsplit("/", 1)[-1], params, json.loads(body)["result"]))
+        return code, body
+
+    def last(self, method: str):
+        return next(((p, r) for m, p, r in reversed(self.calls) if m == method), (None, None))
+
+def _user(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": f"user{uid}", "username": f"user{uid}"}
+
+def _buttons(markup) -> list:
+    if isinstance(markup, str):
+        markup = json.loads(markup)
+    return [b.get("callback_data") or "" for row in (markup or {}).get("inline_keyboard", []) for b in row]
+
+class Harness:
+    def __init__(self, app, request: CapturingRequest):
+        self.app = app
+        self.request = request
+        self.ids = iter(range(1, 10**9))
+
+    async def push(self, kind: str, obj: dict):
+        await self.app.process_update(Update.de_json({"update_id": next(self.ids), kind: obj}, self.app.bot))
+
+    def message(self, chat: dict, uid: int, text: str, reply_to: dict | None = None) -> dict:
+        m = {"message_id": next(self.ids), "date": int(time.time()), "chat": chat, "from": _user(uid), "text": text}
+        if reply_to:
+            m["reply_to_message"] = reply_to
+        return m
+
+    async def click(self, uid: int, data: str, message_id: int) -> str:
+        main.recent_writes.clear()  # پردازه‌ی گیرنده نوشتن را ندیده است
+        await self.push("callback_query", {
+            "id": str(next(self.ids)), "from": _user(uid), "chat_instance": "1", "data": data,
+            "message": {"message_id": message_id, "date": int(time.time()), "chat": GROUP},
+        })
+        params, _ = self.request.last("answerCallbackQuery")
+        return (params or {}).get("text") or ""
+
+async def _lag_replica(con) -> str:
+    if await con.fetchval("SELECT pg_is_in_recovery();"):
+        await con.execute("SELECT pg_wal_replay_pause();")
+        return "standby (replay paused)"
+    await con.execute(main.CREATE_SQL)
+    await con.execute(main.ALTER_SQL)
+    return "independent database (never receives writes)"
+
+async def run() -> bool:
+    replica = await asyncpg.connect(main.DATABASE_REPLICA_URL)
+    mode = await _lag_replica(replica)
+    print(f"replica: {mode}")
+    request = CapturingRequest()
+    app = main.build_application(updater=False, token="1:replica", request=request)
+    main.app = app
+    main.inline_debouncer.delay = 0
+    results = {}
+    try:
+        await app.initialize()
+        await main.post_init(app)
+        h = Harness(app, request)
+        bot_user = {"id": 1000000001, "is_bot": True, "first_name": "Najva"}
+        await h.push("my_chat_member", {"chat": GROUP, "from": _user(SENDER), "date": int(time.time()),
+                                        "old_chat_member": {"status": "left", "user": bot_user},
+                                        "new_chat_member": {"status": "member", "user": bot_user}})
+
+        # نجوای ریپلای: تریگر در گروه، متن در خصوصی، کلیک گیرنده روی showid و دکمه‌ی قدیمی show
+        text = f"replica check {time.time_ns()}"
+        target = h.message(GROUP, RECEIVER, "سلام")
+        await h.push("message", target)
+        await h.push("message", h.message(GROUP, SENDER, "نجوا", reply_to=target))
+        await h.push("message", h.message({"id": SENDER, "type": "private", "first_name": "s"}, SENDER, text))
+        sent = next(((p, r) for m, p, r in reversed(request.calls)
+                     if m == "sendMessage" and any(d.startswith("showid:") for d in _buttons(p.get("reply_markup")))),
+                    (None, None))
+        if sent[0] is None:
+            raise SystemExit("whisper notice was not sent; check the handler logs")
+        data = next(d for d in _buttons(sent[0]["reply_markup"]) if d.startswith("showid:"))
+        results["showid"] = await h.click(RECEIVER, data, sent[1]["message_id"]) == text
+        async with main.pool.acquire() as con:
+            await con.execute("UPDATE whispers SET message_id=$1 WHERE id=$2;", sent[1]["message_id"], int(data[7:]))
+        results["show (legacy)"] = await h.click(
+            RECEIVER, f"show:{GROUP['id']}:{SENDER}:{RECEIVER}", sent[1]["message_id"]) == text
+
+        # نجوای اینلاین: پاسخ اینلاین، انتخاب نتیجه و کلیک گیرنده روی iws
+        itext = f"inline check {time.time_ns()}"
+        await h.push("inline_query", {"id": str(next(h.ids)), "from": _user(SENDER),
+                                      "query": f"{itext} @user{RECEIVER}", "offset": ""})
+        while main.inline_debouncer.tasks:
+            await asyncio.sleep(0.01)
+        params, _ = request.last("answerInlineQuery")
+        first = (params or {}).get("results", [{}])[0]
+        data = next((d for d in _buttons(first.get("reply_markup")) if d.startswith("iws:")), None)
+        if data is None:
+            raise SystemExit("inline query got no whisper result; check the handler logs")
+        await h.push("chosen_inline_result", {"result_id": first["id"], "from": _user(SENDER), "query": ""})
+        results["iws"] = itext in await h.click(RECEIVER, data, next(h.ids))
+    finally:
+        if mode.startswith("standby"):
+            await replica.execute("SELECT pg_wal_replay_resume();")
+        await replica.close()
+        await app.shutdown()
+
+    for name, ok in results.items():
+        print(f"{name:<14}{'ok' if ok else 'FAILED'}")
+    print(f"replica misses read from primary: {main.replica_stats['miss_to_primary']}")
+    return all(results.values()) and main.replica_stats["miss_to_primary"] >= len(results)
+
+def cli():
+    if not main.DATABASE_URL or not main.DATABASE_REPLICA_URL:
+        raise SystemExit("DATABASE_URL و DATABASE_REPLICA_URL (دو Postgres محلی) لازم‌اند.")
+    sys.exit(0 if asyncio.run(run()) else 1)
+
+if __name__ == "__main__":
+    cli()